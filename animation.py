@@ -0,0 +1,537 @@
+from collections import OrderedDict
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtCore import QPoint, QRect, QRectF, QSize
+from PyQt5.QtGui import QBitmap, QImage, QImageReader, QPainter, QPixmap, QRegion, QTransform
+
+# Delta encoded animations keep a whole frame at least this often, so a player that has to start
+# in the middle of one never has to draw more than this many patches to get there
+KEYFRAME_INTERVAL = 8
+BAND = 16  # Rows per band, every band of a frame that changed gets its own rectangle
+KEYFRAME_SHARE = 0.75  # Frames where more than this share changed are kept whole
+
+
+# Rectangles holding every pixel that differs between two images of the same size and format, one per band of
+# rows, none if they're the same. A walking buddy moves its arms and legs at once, a rectangle around both
+# would be most of the frame. Rows are compared as bytes, and the columns of a row that changed are found
+# from the lowest and highest bit of the two rows XORed together as one big integer
+def changed_rects(image, previous):
+    stride = image.bytesPerLine()
+    width = image.width() * 4
+    data = image.constBits().asstring(image.sizeInBytes())
+    old = previous.constBits().asstring(previous.sizeInBytes())
+
+    bands = {}  # Band -> [left, right, top, bottom]
+    for row in range(image.height()):
+        start = row * stride
+        line = data[start:start + width]
+        old_line = old[start:start + width]
+        if line == old_line:
+            continue
+        difference = int.from_bytes(line, "little") ^ int.from_bytes(old_line, "little")
+        left = ((difference & -difference).bit_length() - 1) // 32  # 32 bits per pixel
+        right = (difference.bit_length() - 1) // 32
+
+        band = bands.get(row // BAND)
+        if band is None:
+            bands[row // BAND] = [left, right, row, row]
+        else:
+            band[0] = min(band[0], left)
+            band[1] = max(band[1], right)
+            band[3] = row
+    return [QRect(left, top, right - left + 1, bottom - top + 1) for left, right, top, bottom in bands.values()]
+
+
+# What changed in every frame since the one before it, the first frame is a whole frame
+# images have to be premultiplied, otherwise invisible pixels with different colors count as changes
+def frame_changes(images):
+    return [[images[0].rect()]] + [changed_rects(image, previous) for previous, image in zip(images, images[1:])]
+
+
+# Where the patches of a frame go in the pixmap that holds them: left to right in rows as wide as the frame
+# Returns the top left corner of every patch, and the size the pixmap needs
+def patch_layout(rects, width):
+    positions = []
+    x = y = row_height = used_width = 0
+    for rect in rects:
+        if x + rect.width() > width:
+            x = 0
+            y += row_height
+            row_height = 0
+        positions.append(QPoint(x, y))
+        x += rect.width()
+        row_height = max(row_height, rect.height())
+        used_width = max(used_width, x)
+    return positions, QSize(used_width, y + row_height)
+
+
+# Pixels of the rectangles of an image, packed in one pixmap
+def pack_patches(image, rects):
+    if not rects:
+        return QPixmap()
+    if len(rects) == 1 and rects[0] == image.rect():
+        return QPixmap.fromImage(image)
+
+    positions, size = patch_layout(rects, image.width())
+    patches = QImage(size, QImage.Format_ARGB32_Premultiplied)
+    painter = QPainter(patches)
+    painter.setCompositionMode(QPainter.CompositionMode_Source)
+    for rect, position in zip(rects, positions):
+        painter.drawImage(position, image, rect)
+    painter.end()
+    return QPixmap.fromImage(patches)
+
+
+# Delta encode decoded frames: keyframes, and for every other frame only the pixels in the rectangles
+# that changed since the frame before it. Frames that didn't change at all have no pixels.
+# Returns the frames and the rectangles every frame covers, a keyframe covers the whole frame
+def delta_frames(images, changes, ratio=1.0):
+    full = images[0].rect()
+    frames = []
+    rects = []
+    since_keyframe = 0
+    for image, changed in zip(images, changes):
+        since_keyframe += 1
+        # Patches covering most of the frame aren't worth the extra drawing, it might as well be a keyframe
+        area = sum(rect.width() * rect.height() for rect in changed)
+        if not frames or since_keyframe >= KEYFRAME_INTERVAL or area > KEYFRAME_SHARE * full.width() * full.height():
+            changed = [full]
+            since_keyframe = 0
+
+        frame = pack_patches(image, changed)
+        if changed == [full]:
+            frame.setDevicePixelRatio(ratio)  # Patches are drawn by pixels, only keyframes are shown as they are
+        frames.append(frame)
+        rects.append(changed)
+    return frames, rects
+
+
+# Decoded animation: every frame of a sprite plus how long each frame stays on screen
+# PNG sprites are stored the same way, as an animation with a single frame
+# Frames are cropped to the visible part of the whole animation, offset is where that part starts in the file
+#
+# Delta encoded animations have rects: frames are then either keyframes or patches, the pixels of the rectangles
+# in rects (in frame pixels) that changed since the frame before, packed in one pixmap. A player keeps the frame
+# it shows and only draws the patches on it, so only those rectangles have to be repainted
+class Animation:
+    def __init__(self, path, frames, delays, offset=QPoint(), mask=None, rects=None):
+        self.path = path
+        self.frames = frames  # List of QPixmap, one per frame
+        self.delays = delays  # List of delays in milliseconds, one per frame
+        self.offset = offset
+        self.mask = mask if mask is not None else QRegion()  # Pixels visible in any frame, in cropped coordinates
+        self.rects = rects  # List of rectangles per frame, None for whole frames
+        self.whole_frames = None  # Frames of a delta encoded animation put back together, only made when needed
+        self.cached = None  # (cache, key) of the ScaledAnimationCache that made it, told when whole frames are made
+
+    def frame_count(self):
+        return len(self.frames)
+
+    # Size on screen, frames of HiDPI animations have more pixels than that
+    def size(self):
+        return self.frames[0].size() / self.frames[0].devicePixelRatio()
+
+    # Memory used by the frames and whole frames, repeated frames are only counted once
+    def bytes(self):
+        frames = {frame.cacheKey(): frame for frame in self.frames + (self.whole_frames or [])}
+        return sum(frame.width() * frame.height() * 4 for frame in frames.values())
+
+    # Length of one loop in milliseconds
+    def duration(self):
+        return sum(self.delays)
+
+    def is_keyframe(self, index):
+        return self.rects is None or self.rects[index] == [self.frames[0].rect()]
+
+    # Areas that changed since the frame before, in the same coordinates as the animation's size
+    def repaint_rects(self, index):
+        if self.is_keyframe(index):
+            return [QRect(QPoint(), self.size())]
+        ratio = self.frames[0].devicePixelRatio()
+        return [QRectF(rect.x() / ratio, rect.y() / ratio, rect.width() / ratio, rect.height() / ratio).toAlignedRect()
+                for rect in self.rects[index]]
+
+    # Whole frame, for the few things that need any frame without playing up to it, like the simulated crowd
+    # The whole frames are kept until the animation is evicted from the scaled cache, which counts them
+    def frame(self, index):
+        if self.rects is None:
+            return self.frames[index]
+        frames = self.whole_frames
+        if frames is None:
+            ratio = self.frames[0].devicePixelRatio()
+            frames = self.whole_frames = [QPixmap.fromImage(image) for image in self.images()]
+            for frame in frames:
+                frame.setDevicePixelRatio(ratio)
+            if self.cached is not None:
+                cache, key = self.cached
+                cache.whole_frames_made(key, self)
+        return frames[index]
+
+    # Every frame as a whole premultiplied image
+    def images(self):
+        if self.rects is None:
+            return [frame.toImage().convertToFormat(QImage.Format_ARGB32_Premultiplied) for frame in self.frames]
+
+        canvas = QImage(self.frames[0].width(), self.frames[0].height(), QImage.Format_ARGB32_Premultiplied)
+        images = []
+        for frame, rects in zip(self.frames, self.rects):
+            draw_patches(canvas, frame, rects)
+            images.append(canvas.copy())
+        return images
+
+
+# Replace the pixels of rectangles of a whole frame, a pixmap or image, with the packed patches
+# Transparent pixels in the patches are copied too, they're pixels that disappeared
+def draw_patches(device, patches, rects):
+    if not rects:
+        return
+    painter = QPainter(device)
+    painter.setCompositionMode(QPainter.CompositionMode_Source)
+    for rect, position in zip(rects, patch_layout(rects, device.width())[0]):
+        painter.drawPixmap(rect, patches, QRect(position, rect.size()))
+    painter.end()
+
+
+# Same animation with its frames delta encoded, single frames are left as they are
+def encode(animation, images=None, ratio=1.0):
+    if animation.frame_count() < 2:
+        return animation
+    images = images if images is not None else animation.images()
+    frames, rects = delta_frames(images, frame_changes(images), ratio)
+    return Animation(animation.path, frames, animation.delays, animation.offset, animation.mask, rects)
+
+
+# Process-wide cache of decoded animations, keyed by sprite path
+# Every buddy instance shares the same frames, so each file is only opened and decoded once
+class AnimationCache:
+    def __init__(self):
+        self.animations = {}
+        self.hits = 0
+        self.misses = 0
+        self.frames_decoded = 0
+        self.bundle = None  # Pre-decoded sprite bundle, sprites missing from it are decoded from their files
+        self.delta = False  # Delta encode the frames of every animation, see Animation
+
+    def get(self, path):
+        animation = self.animations.get(path)
+        if animation is not None:
+            self.hits += 1
+            return animation
+
+        self.misses += 1
+        if self.bundle is not None:
+            animation = self.bundle.animation(path)
+        if animation is None:
+            self.put(path, self.build(path, *self.read_frames(path, self.delta)))
+        else:
+            self.animations[path] = encode(animation) if self.delta else animation
+        return self.animations[path]
+
+    # Store an animation decoded somewhere else, like the background loader
+    def put(self, path, animation):
+        self.frames_decoded += animation.frame_count()
+        self.animations[path] = animation
+
+    # True if the sprite can be loaded from the bundle instead of being decoded
+    def bundled(self, path):
+        return self.bundle is not None and self.bundle.contains(path)
+
+    @staticmethod
+    def decode(path):
+        return AnimationCache.build(path, *AnimationCache.read_frames(path))
+
+    # The slow part of decoding, only uses QImage so it's safe to run on another thread
+    # Returns the frames, their delays, the alpha mask of every frame, and with deltas what changed in every frame
+    @staticmethod
+    def read_frames(path, deltas=False):
+        images = []
+        delays = []
+
+        reader = QImageReader(path)
+        while True:
+            image = reader.read()
+            if image.isNull():
+                break
+            images.append(image)
+            # Same delay QMovie would use for this frame. Static images report 0, GIFs without a delay -1
+            delays.append(max(reader.nextImageDelay(), 0))
+            if not reader.supportsAnimation():
+                break
+
+        alpha_masks = [image.createAlphaMask() for image in images]
+        if not deltas or not images:
+            return images, delays, alpha_masks
+        images = [image.convertToFormat(QImage.Format_ARGB32_Premultiplied) for image in images]
+        return images, delays, alpha_masks, frame_changes(images)
+
+    # Crop the frames and turn them into pixmaps, has to run on the GUI thread
+    # With the changes from read_frames the frames are delta encoded
+    @staticmethod
+    def build(path, images, delays, alpha_masks, changes=None):
+        # Don't cache an empty animation if the file couldn't be read, use a null pixmap instead
+        if not images:
+            return Animation(path, [QPixmap()], [0])
+
+        # Union of the opaque pixels of every frame, so the window fits every frame of the animation
+        mask = QRegion()
+        for alpha_mask in alpha_masks:
+            mask += QRegion(QBitmap.fromImage(alpha_mask))
+        bounds = mask.boundingRect()
+        if bounds.isEmpty():
+            bounds = images[0].rect()
+
+        offset = bounds.topLeft()
+        if changes is not None and len(images) > 1:
+            # Nothing changes outside of the visible part, so the changes only have to be moved with the crop
+            visible = QRect(QPoint(), bounds.size())
+            frames, rects = delta_frames([image.copy(bounds) for image in images],
+                                         [[rect.translated(-offset).intersected(visible) for rect in changed
+                                           if rect.intersects(bounds)] for changed in changes])
+            return Animation(path, frames, delays, offset, mask.translated(-offset), rects)
+
+        frames = [QPixmap.fromImage(image.copy(bounds)) for image in images]
+        return Animation(path, frames, delays, offset, mask.translated(-offset))
+
+    def clear(self):
+        self.animations.clear()
+
+
+animation_cache = AnimationCache()
+
+
+# Frames already scaled for a (sprite, scale, device pixel ratio), so nothing gets scaled while painting
+# The cache has a memory budget, and the least recently played animations are dropped first
+# Native size animations come straight from the animation cache and don't count against the budget
+class ScaledAnimationCache:
+    def __init__(self, cache, budget=128 * 1024 * 1024):
+        self.cache = cache
+        self.budget = budget  # Bytes
+        self.animations = OrderedDict()  # (path, scale, ratio) -> Animation, least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, scale=1.0, ratio=1.0):
+        if scale == 1 and ratio == 1:
+            return self.cache.get(path)
+
+        key = (path, scale, ratio)
+        animation = self.animations.get(key)
+        if animation is not None:
+            self.hits += 1
+            self.animations.move_to_end(key)
+            return animation
+
+        self.misses += 1
+        animation = self.scale(self.cache.get(path), scale, ratio)
+        animation.cached = (self, key)
+        self.add(key, animation)
+        return animation
+
+    def add(self, key, animation):
+        self.animations[key] = animation
+        self.bytes += animation.bytes()
+        self.evict()
+
+    # Whole frames of a delta encoded animation count against the budget too
+    # An evicted animation that is still drawn and needs them again is put back, in place of any newer copy
+    def whole_frames_made(self, key, animation):
+        if self.animations.get(key) is animation:
+            self.animations.move_to_end(key)
+            self.bytes += sum(frame.width() * frame.height() * 4 for frame in animation.whole_frames)
+            self.evict()
+            return
+        replaced = self.animations.pop(key, None)
+        if replaced is not None:
+            self.bytes -= replaced.bytes()
+            replaced.whole_frames = None
+        self.add(key, animation)
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.evict()
+
+    # Players still showing an evicted animation keep their frames until they play something else,
+    # its whole frames are dropped right away
+    def evict(self):
+        # The newest animation is always kept, even if it doesn't fit in the budget on its own
+        while self.bytes > self.budget and len(self.animations) > 1:
+            _, animation = self.animations.popitem(last=False)
+            self.bytes -= animation.bytes()
+            animation.whole_frames = None
+            self.evictions += 1
+
+    @staticmethod
+    def scale(animation, scale, ratio):
+        factor = scale * ratio
+        offset = QPoint(round(animation.offset.x() * scale), round(animation.offset.y() * scale))
+        mask = QTransform.fromScale(scale, scale).map(animation.mask)
+
+        # Delta encoded frames are scaled whole and encoded again, a patch scaled on its own would blend
+        # with the transparent pixels around it instead of the frame's
+        if animation.rects is not None:
+            images = [image.scaled(round(image.width() * factor), round(image.height() * factor),
+                                   Qt.IgnoreAspectRatio, Qt.SmoothTransformation) for image in animation.images()]
+            scaled = encode(animation, images, ratio)
+            scaled.offset = offset
+            scaled.mask = mask
+            return scaled
+
+        scaled = {}  # Repeated frames share one scaled pixmap
+        for frame in animation.frames:
+            if frame.cacheKey() not in scaled:
+                pixmap = frame.scaled(round(frame.width() * factor), round(frame.height() * factor),
+                                      Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+                pixmap.setDevicePixelRatio(ratio)
+                scaled[frame.cacheKey()] = pixmap
+
+        frames = [scaled[frame.cacheKey()] for frame in animation.frames]
+        return Animation(animation.path, frames, animation.delays, offset, mask)
+
+    def clear(self):
+        for animation in self.animations.values():
+            animation.whole_frames = None
+        self.animations.clear()
+        self.bytes = 0
+
+
+scaled_cache = ScaledAnimationCache(animation_cache)
+
+
+# Plays a cached animation on a label
+# Changing animations only swaps the frame list and the frame index, nothing gets decoded again
+# Delta encoded animations are played on the player's own surface, and the label is only told which
+# part of the frame changed through update_frame
+class AnimationPlayer(QtCore.QObject):
+    animation_changed = pyqtSignal()
+
+    frame_callbacks = 0  # Python calls made to advance a frame, counted for every player
+    frame_pixels = 0  # Pixels of every frame shown, counted for every player
+    repaint_pixels = 0  # Pixels of those frames that changed and had to be repainted
+
+    def __init__(self, label, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.label = label
+        self.animation = None
+        self.current_frame = 0
+        self.scale = 1.0
+        self.ratio = 1.0  # Device pixel ratio of the screen the animation is shown on
+        self.paused = False
+        self.paused_delay = None  # Time left on the current frame when paused, None if there's no next frame
+        self.surface = None  # Frame being shown of a delta encoded animation, patched on every frame
+
+        self.frame_timer = QtCore.QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.next_frame)
+
+    def play(self, path):
+        self.frame_timer.stop()
+        animation = scaled_cache.get(path, self.scale, self.ratio)
+        if animation is not self.animation:
+            self.animation = animation
+            self.animation_changed.emit()
+        if animation.rects is None:
+            self.surface = None
+        self.current_frame = 0
+        self.show_frame()
+
+    def stop(self):
+        self.frame_timer.stop()
+        self.paused_delay = None
+
+    # Switch to the same animation at another size, without restarting it
+    def set_scale(self, scale, ratio=1.0):
+        if (scale, ratio) == (self.scale, self.ratio):
+            return
+        self.scale = scale
+        self.ratio = ratio
+
+        if self.animation is not None:
+            self.animation = scaled_cache.get(self.animation.path, scale, ratio)
+            self.animation_changed.emit()
+            if self.animation.rects is not None:
+                self.seek(self.current_frame)
+            self.label.setPixmap(self.current_pixmap())
+
+    # Freeze on the current frame without losing the time left on it, used while the buddy is hidden
+    def pause(self):
+        if self.paused:
+            return
+        self.paused = True
+        self.paused_delay = self.frame_timer.remainingTime() if self.frame_timer.isActive() else None
+        self.frame_timer.stop()
+
+    def resume(self):
+        if not self.paused:
+            return
+        self.paused = False
+        if self.paused_delay is not None:
+            self.frame_timer.start(self.paused_delay)
+            self.paused_delay = None
+
+    def frame_count(self):
+        if self.animation is None:
+            return 0
+        return self.animation.frame_count()
+
+    def current_frame_number(self):
+        return self.current_frame
+
+    def current_pixmap(self):
+        if self.animation is None:
+            return QPixmap()
+        if self.animation.rects is not None:
+            return self.surface
+        return self.animation.frames[self.current_frame]
+
+    def surface_bytes(self):
+        return self.surface.width() * self.surface.height() * 4 if self.surface is not None else 0
+
+    # Put the frame at index on the surface, from the last keyframe before it
+    def seek(self, index):
+        start = index
+        while not self.animation.is_keyframe(start):
+            start -= 1
+        for frame in range(start, index + 1):
+            self.draw(frame)
+
+    # Draw the patch of the frame at index on the surface, which has to show the frame before it
+    def draw(self, index):
+        keyframe = self.animation.frames[0]
+        if self.surface is None or self.surface.size() != keyframe.size():
+            self.surface = QPixmap(keyframe.size())
+            self.surface.fill(Qt.transparent)  # Gives it an alpha channel
+        self.surface.setDevicePixelRatio(1)  # Patches are drawn by pixels
+        draw_patches(self.surface, self.animation.frames[index], self.animation.rects[index])
+        self.surface.setDevicePixelRatio(keyframe.devicePixelRatio())
+
+    def next_frame(self):
+        AnimationPlayer.frame_callbacks += 1
+        self.current_frame = (self.current_frame + 1) % self.animation.frame_count()
+        self.show_frame()
+
+    def show_frame(self):
+        animation = self.animation
+        size = animation.size()
+        AnimationPlayer.frame_pixels += size.width() * size.height()
+        if animation.rects is None:
+            self.label.setPixmap(animation.frames[self.current_frame])
+            AnimationPlayer.repaint_pixels += size.width() * size.height()
+        else:
+            self.draw(self.current_frame)
+            rects = animation.repaint_rects(self.current_frame)
+            AnimationPlayer.repaint_pixels += sum(rect.width() * rect.height() for rect in rects)
+            if animation.is_keyframe(self.current_frame):
+                self.label.setPixmap(self.surface)
+            elif rects:
+                self.label.update_frame(rects)
+
+        # Only schedule the next frame if there is one, single frame sprites just stay on screen
+        delay = self.animation.delays[self.current_frame]
+        if self.animation.frame_count() > 1:
+            if self.paused:
+                self.paused_delay = delay
+            else:
+                self.frame_timer.start(delay)
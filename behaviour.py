@@ -0,0 +1,177 @@
+import random
+
+
+# Buddy states, stored as small integers in the model arrays
+# The core states are always there, the rest are registered by the behaviours that use them
+STATE_NAMES = ["IDLE", "WALK", "DRAG", "STOP"]
+STATES = {name: state for state, name in enumerate(STATE_NAMES)}
+IDLE, WALK, DRAG, STOP = range(4)
+
+
+# Id of a state, registering it the first time it's used
+def state_id(name):
+    state = STATES.get(name)
+    if state is None:
+        state = len(STATE_NAMES)
+        STATE_NAMES.append(name)
+        STATES[name] = state
+    return state
+
+
+# One state a buddy can randomly pick
+# weight: how likely it is to be picked, relative to the other states
+# delays: possible waits in milliseconds, after the pick and before the state starts
+# repeat: False if the state can't be picked twice in a row
+# walk: the buddy walks around for duration milliseconds
+# sprite: otherwise, the buddy attribute with the animation to play, loops times (min, max)
+class StateSpec:
+    def __init__(self, name, weight=1, delays=(0,), repeat=True, walk=False, duration=0, sprite=None, loops=(1, 1)):
+        self.name = name
+        self.state = state_id(name)
+        self.weight = weight
+        self.delays = tuple(delays)
+        self.repeat = repeat
+        self.walk = walk
+        self.duration = duration
+        self.sprite = sprite
+        self.loops = loops
+
+    def delay(self, rng=random):
+        return rng.choice(self.delays)
+
+    def loop_limit(self, rng=random):
+        return rng.randint(*self.loops)
+
+
+# Alias tables for sampling from a discrete distribution in constant time (Vose's method)
+def alias_table(weights):
+    count = len(weights)
+    total = float(sum(weights))
+    scaled = [weight * count / total for weight in weights]
+    probability = [1.0] * count
+    alias = list(range(count))
+
+    small = [i for i, value in enumerate(scaled) if value < 1.0]
+    large = [i for i, value in enumerate(scaled) if value >= 1.0]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        probability[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1.0 - scaled[less]
+        (small if scaled[more] < 1.0 else large).append(more)
+
+    return probability, alias
+
+
+# The states a character can pick and how it moves between them
+# For every previous state there's a precomputed table of what can come next, so picking the next
+# state takes two random numbers and never has to retry
+class Behaviour:
+    def __init__(self, specs):
+        self.specs = {spec.state: spec for spec in specs}
+
+        # Table used after any state that doesn't restrict the next pick
+        self.default_table = self.build_table(specs)
+
+        # Tables used after states that can't be repeated
+        self.tables = {}
+        for spec in specs:
+            if not spec.repeat:
+                self.tables[spec.state] = self.build_table([other for other in specs if other is not spec])
+
+    @staticmethod
+    def build_table(specs):
+        probability, alias = alias_table([spec.weight for spec in specs])
+        return tuple(specs), probability, alias
+
+    def spec(self, state):
+        return self.specs[state]
+
+    # Names of the pack sprites the states play
+    def sprites(self):
+        return [spec.sprite[:-len("_sprite")] for spec in self.specs.values() if spec.sprite is not None]
+
+    # Randomly pick the spec of the next state, given the previous state id
+    def next_spec(self, previous, rng=random):
+        specs, probability, alias = self.tables.get(previous, self.default_table)
+        column = int(rng.random() * len(specs))
+        if rng.random() >= probability[column]:
+            column = alias[column]
+        return specs[column]
+
+
+# What every kid does: walk around, or do their dance and "stupid" animations without repeating them
+DEFAULT_BEHAVIOUR = Behaviour([
+    StateSpec("WALK", delays=(500,), walk=True, duration=2000),
+    StateSpec("DANCE", delays=(1000, 2000), repeat=False, sprite="dance_sprite", loops=(2, 3)),
+    StateSpec("STUPID", delays=(1000, 2000), repeat=False, sprite="stupid_sprite", loops=(3, 5)),
+])
+
+TABLE_KEYS = {"state", "weight", "delays", "repeat", "duration", "sprite", "loops"}
+MAX_COUNT = 2 ** 31 - 1  # Delays, durations and loop counts go in timers and trace events, which take 32 bit ints
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_count(value, minimum=0):
+    return isinstance(value, int) and not isinstance(value, bool) and minimum <= value <= MAX_COUNT
+
+
+# Behaviour from a table like the "behaviour" section of a character pack's manifest, one object per state:
+#     {"state": "WALK", "delays": [500], "duration": 2000}
+#     {"state": "DANCE", "delays": [1000, 2000], "repeat": false, "sprite": "dance", "loops": [2, 3]}
+# WALK walks around for duration milliseconds, every other state plays the pack sprite named by "sprite".
+# weight, delays, repeat and loops are optional and mean the same as in StateSpec
+# Raises ValueError if the table isn't valid
+def parse_behaviour(table):
+    if not isinstance(table, list) or not table:
+        raise ValueError("a behaviour is a list of states")
+
+    specs = []
+    for entry in table:
+        if not isinstance(entry, dict):
+            raise ValueError("behaviour states are objects, not %r" % (entry,))
+        unknown = set(entry) - TABLE_KEYS
+        if unknown:
+            raise ValueError("unknown behaviour keys %s" % ", ".join(sorted(unknown)))
+
+        name = entry.get("state")
+        if not isinstance(name, str) or not name:
+            raise ValueError("behaviour state without a name")
+        if name in ("IDLE", "DRAG", "STOP"):
+            raise ValueError("%s can't be picked by a behaviour" % name)
+        if any(spec.name == name for spec in specs):
+            raise ValueError("%s is in the behaviour twice" % name)
+
+        weight = entry.get("weight", 1)
+        delays = entry.get("delays", [0])
+        loops = entry.get("loops", [1, 1])
+        repeat = entry.get("repeat", True)
+        if not is_number(weight) or weight <= 0:
+            raise ValueError("%s: weight has to be a positive number" % name)
+        if not isinstance(delays, list) or not delays or not all(is_count(delay) for delay in delays):
+            raise ValueError("%s: delays has to be a list of milliseconds" % name)
+        if (not isinstance(loops, list) or len(loops) != 2 or not all(is_count(loop, 1) for loop in loops)
+                or loops[0] > loops[1]):
+            raise ValueError("%s: loops has to be [min, max]" % name)
+        if not isinstance(repeat, bool):
+            raise ValueError("%s: repeat has to be true or false" % name)
+
+        if name == "WALK":
+            duration = entry.get("duration")
+            if not is_count(duration, 1) or "sprite" in entry:
+                raise ValueError("WALK needs a duration in milliseconds and plays the walk sprites")
+            specs.append(StateSpec(name, weight, delays, repeat, walk=True, duration=duration))
+        else:
+            sprite = entry.get("sprite")
+            if not isinstance(sprite, str) or not sprite or "duration" in entry:
+                raise ValueError("%s needs the name of the sprite it plays" % name)
+            specs.append(StateSpec(name, weight, delays, repeat, sprite=sprite + "_sprite", loops=tuple(loops)))
+
+    # A state that can't be repeated needs another state to go to
+    if len(specs) == 1 and not specs[0].repeat:
+        raise ValueError("%s can't be repeated and is the only state" % specs[0].name)
+    return Behaviour(specs)
@@ -0,0 +1,280 @@
+import heapq
+import random
+from array import array
+
+from behaviour import DEFAULT_BEHAVIOUR, IDLE, STOP
+
+# NumPy is optional, it's only needed for the batch step
+# It's slow to import, so it's only imported the first time there are enough walkers to need it
+np = None
+numpy_missing = False
+
+BATCH_THRESHOLD = 64  # With fewer walkers than this, a plain loop is faster than NumPy
+
+
+def load_numpy():
+    global np, numpy_missing
+    if np is None and not numpy_missing:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            numpy_missing = True
+    return np
+
+
+SPEED = 4  # Pixels per movement step, on both axes
+
+
+# Limits for a buddy's position so its visible sprite stays inside an area
+# Both are (x, y, width, height), the sprite is relative to the buddy's position
+def sprite_limits(area, sprite):
+    area_x, area_y, area_width, area_height = area
+    sprite_x, sprite_y, sprite_width, sprite_height = sprite
+    return (area_x - sprite_x, area_y - sprite_y,
+            area_x + area_width - sprite_x - sprite_width, area_y + area_height - sprite_y - sprite_height)
+
+
+# Behaviour and motion of every buddy, without any Qt in it
+# Each buddy is a slot index into compact arrays, so thousands of them can be stepped at once
+class BuddyModel:
+    def __init__(self):
+        self.x = array('i')
+        self.y = array('i')
+        self.dir_x = array('b')
+        self.dir_y = array('b')
+        self.state = array('B')
+        self.previous_state = array('B')
+        self.moving = array('B')  # 1 while the buddy is actually walking, after the walk delay
+
+        # Per buddy position limits, (left, top) to (right, bottom) inclusive
+        self.left = array('i')
+        self.top = array('i')
+        self.right = array('i')
+        self.bottom = array('i')
+
+        # Center of the visible sprite, relative to the position. Used to find buddies close to each other
+        self.center_x = array('h')
+        self.center_y = array('h')
+
+        self.free_slots = []
+
+        # Optional SpatialGrid of the buddies' centers, kept up to date whenever a buddy moves
+        self.grid = None
+
+    def __len__(self):
+        return len(self.x)
+
+    # Add a buddy and return its slot index, reusing the slot of a removed buddy if there is one
+    def add(self, x=0, y=0, bounds=(0, 0, 0, 0)):
+        if self.free_slots:
+            index = self.free_slots.pop()
+        else:
+            index = len(self.x)
+            for column in (self.x, self.y, self.left, self.top, self.right, self.bottom, self.center_x,
+                           self.center_y, self.dir_x, self.dir_y, self.state, self.previous_state, self.moving):
+                column.append(0)
+
+        self.add_at(index, x, y, bounds)
+        return index
+
+    # Reset a slot to a freshly spawned buddy: idle, facing left
+    def add_at(self, index, x, y, bounds=(0, 0, 0, 0)):
+        self.x[index] = x
+        self.y[index] = y
+        self.dir_x[index] = -SPEED
+        self.dir_y[index] = SPEED
+        self.state[index] = IDLE
+        self.previous_state[index] = IDLE
+        self.moving[index] = 0
+        self.set_bounds(index, *bounds)
+        self.moved(index)
+
+    def remove(self, index):
+        self.state[index] = STOP
+        self.moving[index] = 0
+        self.free_slots.append(index)
+        if self.grid is not None:
+            self.grid.remove(index)
+
+    # Update the buddy's cell in the grid after its position or center changed
+    def moved(self, index):
+        if self.grid is not None:
+            self.grid.move(index, self.x[index] + self.center_x[index], self.y[index] + self.center_y[index])
+
+    def set_center(self, index, x, y):
+        self.center_x[index] = x
+        self.center_y[index] = y
+        self.moved(index)
+
+    def set_bounds(self, index, left, top, right, bottom):
+        self.left[index] = left
+        self.top[index] = top
+        self.right[index] = right
+        self.bottom[index] = bottom
+
+    def place(self, index, x, y):
+        self.x[index] = x
+        self.y[index] = y
+        self.moved(index)
+
+    # Randomly choose a walking direction and start moving
+    def start_walk(self, index, rng=random):
+        self.dir_x[index] = rng.choice((SPEED, -SPEED))
+        self.dir_y[index] = rng.choice((SPEED, -SPEED))
+        self.moving[index] = 1
+
+    def stop_walk(self, index):
+        self.moving[index] = 0
+
+    # Move one step and bounce off the limits. Returns True if the buddy turned around horizontally
+    def step(self, index):
+        x = self.x[index] + self.dir_x[index]
+        y = self.y[index] + self.dir_y[index]
+        self.x[index] = x
+        self.y[index] = y
+        self.moved(index)
+
+        turned = False
+        if x < self.left[index] and self.dir_x[index] < 0:
+            self.dir_x[index] = -self.dir_x[index]
+            turned = True
+        elif x > self.right[index] and self.dir_x[index] > 0:
+            self.dir_x[index] = -self.dir_x[index]
+            turned = True
+
+        if y < self.top[index] and self.dir_y[index] < 0:
+            self.dir_y[index] = -self.dir_y[index]
+        elif y > self.bottom[index] and self.dir_y[index] > 0:
+            self.dir_y[index] = -self.dir_y[index]
+
+        return turned
+
+    # Move every walking buddy one step. Returns the set of buddies that turned around
+    # indices are the walking buddies if the caller already knows them
+    def step_walking(self, indices=None):
+        if indices is None or len(indices) >= BATCH_THRESHOLD:
+            if load_numpy() is not None:
+                return self.step_batch()
+        if indices is None:
+            indices = [i for i, moving in enumerate(self.moving) if moving]
+        return {i for i in indices if self.step(i)}
+
+    # Vectorized version of step for every walking buddy at once
+    def step_batch(self):
+        if load_numpy() is None:
+            raise ImportError("NumPy is needed for the batch step")
+
+        walking = np.flatnonzero(np.frombuffer(self.moving, dtype=np.uint8))
+        if walking.size == 0:
+            return set()
+
+        x = np.frombuffer(self.x, dtype=np.intc)
+        y = np.frombuffer(self.y, dtype=np.intc)
+        dir_x = np.frombuffer(self.dir_x, dtype=np.int8)
+        dir_y = np.frombuffer(self.dir_y, dtype=np.int8)
+
+        dx = dir_x[walking]
+        dy = dir_y[walking]
+        wx = x[walking] + dx
+        wy = y[walking] + dy
+        x[walking] = wx
+        y[walking] = wy
+
+        new_dx = np.where((wx < np.frombuffer(self.left, dtype=np.intc)[walking]) & (dx < 0), -dx, dx)
+        new_dx = np.where((wx > np.frombuffer(self.right, dtype=np.intc)[walking]) & (new_dx > 0), -new_dx, new_dx)
+        new_dy = np.where((wy < np.frombuffer(self.top, dtype=np.intc)[walking]) & (dy < 0), -dy, dy)
+        new_dy = np.where((wy > np.frombuffer(self.bottom, dtype=np.intc)[walking]) & (new_dy > 0), -new_dy, new_dy)
+        dir_x[walking] = new_dx
+        dir_y[walking] = new_dy
+
+        if self.grid is not None:
+            for index in walking.tolist():
+                self.moved(index)
+
+        return set(walking[new_dx != dx].tolist())
+
+    # Move to a dragged position, clamped to the limits
+    def drag_to(self, index, x, y):
+        self.x[index] = min(max(x, self.left[index]), self.right[index])
+        self.y[index] = min(max(y, self.top[index]), self.bottom[index])
+        self.moved(index)
+
+
+# Runs the whole buddy behaviour on a virtual clock, no display or event loop needed
+# Used to test and profile the behaviour logic at scale
+class Simulation:
+    TICK_INTERVAL = 20
+    LOOP_DURATION = 1000  # Length of one animation loop, for states missing from loop_durations
+
+    # loop_durations maps state names to how long one loop of their animation lasts
+    def __init__(self, model=None, rng=None, behaviour=DEFAULT_BEHAVIOUR, loop_durations=None):
+        self.model = model if model is not None else BuddyModel()
+        self.rng = rng if rng is not None else random.Random()
+        self.behaviour = behaviour
+        self.loop_durations = loop_durations or {}
+        self.now = 0
+        self.deadlines = []  # Heap of (due time, sequence number, buddy index, action)
+        self.pending = {}  # Buddy index -> sequence number of its only valid deadline
+        self.sequence = 0
+        self.transitions = 0
+
+    def spawn(self, x, y, bounds):
+        index = self.model.add(x, y, bounds)
+        self.end_state(index)
+        return index
+
+    def despawn(self, index):
+        self.pending.pop(index, None)
+        self.model.remove(index)
+
+    # Behaviour of one buddy, the same for all of them here
+    def behaviour_of(self, index):
+        return self.behaviour
+
+    def schedule(self, index, delay, action):
+        self.sequence += 1
+        self.pending[index] = self.sequence
+        heapq.heappush(self.deadlines, (self.now + delay, self.sequence, index, action))
+
+    # Same as HomestuckBuddy.end_state
+    def end_state(self, index):
+        model = self.model
+        spec = self.behaviour_of(index).next_spec(model.previous_state[index], self.rng)
+        model.state[index] = spec.state
+        model.previous_state[index] = spec.state
+        self.transitions += 1
+
+        if spec.walk:
+            self.schedule(index, spec.delay(self.rng), self.walk)
+        else:
+            self.schedule(index, spec.delay(self.rng), self.play_loops)
+
+    def walk(self, index):
+        self.model.start_walk(index, self.rng)
+        self.schedule(index, self.behaviour_of(index).spec(self.model.state[index]).duration, self.stop_walk)
+
+    def stop_walk(self, index):
+        self.model.stop_walk(index)
+        self.end_state(index)
+
+    def play_loops(self, index):
+        spec = self.behaviour_of(index).spec(self.model.state[index])
+        loop_duration = self.loop_durations.get(spec.name, self.LOOP_DURATION)
+        self.schedule(index, spec.loop_limit(self.rng) * loop_duration, self.end_state)
+
+    # Advance the clock by one tick
+    def tick(self):
+        self.now += self.TICK_INTERVAL
+        self.model.step_walking()
+
+        while self.deadlines and self.deadlines[0][0] <= self.now:
+            due, seq, index, action = heapq.heappop(self.deadlines)
+            if self.pending.get(index) != seq:
+                continue
+            del self.pending[index]
+            action(index)
+
+    def run(self, duration):
+        for _ in range(duration // self.TICK_INTERVAL):
+            self.tick()
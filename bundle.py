@@ -0,0 +1,144 @@
+import os
+import json
+import mmap
+import struct
+
+from PyQt5.QtCore import QPoint, QRect
+from PyQt5.QtGui import QImage, QPixmap, QRegion
+
+from animation import Animation, AnimationCache
+
+
+# Every sprite packed in one file, already decoded, so loading a sprite is a lookup in a memory map
+# instead of opening and decoding a GIF
+#
+# Layout: MAGIC, little endian uint32 length of the JSON index, the index, then the frames
+# Frames are premultiplied ARGB32 rows, each frame starting on a 16 byte boundary
+# The index has, per sprite path relative to the bundle's root: crop offset, size, frame delays,
+# the offset of every frame, the rectangles of the alpha mask, and the size and mtime of the source file
+MAGIC = b"HSBUNDL1"
+HEADER = struct.Struct("<8sI")
+ALIGN = 16
+BUNDLE_FILE = "graphics/sprites.bundle"
+
+
+def align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+# Decode every sprite and write them to a bundle, paths are relative to root
+def build_bundle(root, paths, output):
+    index = {}
+    frames = []
+    stored = {}  # Frame data -> its offset
+    offset = 0
+    for path in paths:
+        full_path = os.path.join(root, path)
+        animation = AnimationCache.decode(full_path)
+        source = os.stat(full_path)
+        entry = index[path.replace(os.sep, "/")] = {
+            "offset": [animation.offset.x(), animation.offset.y()],
+            "size": [animation.size().width(), animation.size().height()],
+            "delays": animation.delays,
+            "frames": [],
+            "mask": [[rect.x(), rect.y(), rect.width(), rect.height()] for rect in animation.mask.rects()],
+            "source": [source.st_size, source.st_mtime_ns],
+        }
+        for pixmap in animation.frames:
+            image = pixmap.toImage().convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            data = bytes(image.constBits().asarray(image.sizeInBytes()))
+            # Rows are stored without padding, the width is enough to find them again
+            width = image.width() * 4
+            data = b"".join(data[row * image.bytesPerLine():row * image.bytesPerLine() + width]
+                            for row in range(image.height()))
+
+            # GIFs often repeat frames, identical frames are only stored once
+            if data not in stored:
+                stored[data] = offset
+                frames.append((offset, data))
+                offset = align(offset + len(data))
+            entry["frames"].append(stored[data])
+
+    header = json.dumps(index, separators=(",", ":")).encode("utf-8")
+    start = align(HEADER.size + len(header))
+
+    # Written next to the old bundle and swapped in, so a running buddy never maps a half written file
+    temporary = output + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(HEADER.pack(MAGIC, len(header)))
+        file.write(header)
+        for frame_offset, data in frames:
+            file.seek(start + frame_offset)
+            file.write(data)
+        file.truncate(start + offset)
+    os.replace(temporary, output)
+    return len(index)
+
+
+# Read only memory map of a bundle
+# Pages are shared between processes and only read from disk when a sprite is first used
+class SpriteBundle:
+    def __init__(self, path, root):
+        self.root = root
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, length = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a sprite bundle" % path)
+        self.index = json.loads(self.map[HEADER.size:HEADER.size + length].decode("utf-8"))
+        self.start = align(HEADER.size + length)
+        self.frames_mapped = 0
+
+    # Bundle that's next to the sprites, None if it wasn't built or can't be read
+    @staticmethod
+    def open(root):
+        try:
+            return SpriteBundle(os.path.join(root, BUNDLE_FILE), root)
+        except (OSError, ValueError):
+            return None
+
+    def key(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    # Sprites that changed since the bundle was built are decoded from their files instead
+    def entry(self, path):
+        entry = self.index.get(self.key(path))
+        if entry is None or self.stale(path, entry):
+            return None
+        return entry
+
+    def contains(self, path):
+        return self.entry(path) is not None
+
+    def animation(self, path):
+        entry = self.entry(path)
+        if entry is None:
+            return None
+
+        width, height = entry["size"]
+        size = width * height * 4
+        pixmaps = {}  # Frame offset -> pixmap, repeated frames share one pixmap
+        for offset in entry["frames"]:
+            if offset not in pixmaps:
+                start = self.start + offset
+                # The image reads straight from the mapped pages, the pixmap is made from it without decoding
+                image = QImage(memoryview(self.map)[start:start + size], width, height, width * 4,
+                               QImage.Format_ARGB32_Premultiplied)
+                pixmaps[offset] = QPixmap.fromImage(image)
+                self.frames_mapped += 1
+        frames = [pixmaps[offset] for offset in entry["frames"]]
+
+        mask = QRegion()
+        for rect in entry["mask"]:
+            mask += QRect(*rect)
+        return Animation(path, frames, list(entry["delays"]), QPoint(*entry["offset"]), mask)
+
+    # A source file that's missing is fine, the packaged build only ships the bundle
+    @staticmethod
+    def stale(path, entry):
+        try:
+            source = os.stat(path)
+        except OSError:
+            return False
+        return [source.st_size, source.st_mtime_ns] != entry["source"]
@@ -0,0 +1,211 @@
+import json
+import time
+
+from PyQt5 import QtCore
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket
+
+from behaviour import STATES
+from stats import stats
+
+CONTROL_NAME = "homestuck-buddies"  # Name of the local socket, a named pipe on Windows
+
+
+class ControlError(Exception):
+    pass
+
+
+# Local control channel, so scripts can drive the buddies without clicking through the GUI
+#
+# Protocol: one JSON value per line. A line is either a command object, {"cmd": "spawn", "character": "dave"},
+# or a list of them, which is applied as one batch. Every line gets one reply line: the result object, or the
+# list of results for a batch. Results have "ok", and "error" when the command failed, the other commands of
+# a batch still run. An "id" in a command is copied to its result.
+#
+# Commands: ping, list, spawn (character, count), despawn, state (state), move (buddy, x, y), celebrate, stats.
+# list, despawn and state act on the buddies listed in "buddies", the ones of "character", or every active buddy
+#
+# Everything that arrived by the time the socket is read is applied in that same event loop turn, so the
+# buddies are never drawn halfway through a batch
+class ControlServer(QtCore.QObject):
+    MAX_LINE = 1 << 20  # Bytes, a client sending a longer line is disconnected
+    PROBE_TIMEOUT = 500  # Milliseconds to wait for another instance listening on the same name
+
+    def __init__(self, selection, name=CONTROL_NAME, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.selection = selection
+        self.clients = {}  # Socket -> bytes of the line that's still coming
+
+        self.server = QLocalServer(self)
+        self.server.setSocketOptions(QLocalServer.UserAccessOption)  # Only the user running the buddies
+        self.server.newConnection.connect(self.accept)
+        self.name = name
+
+        self.commands = {
+            "ping": self.ping,
+            "list": self.list_buddies,
+            "spawn": self.spawn,
+            "despawn": self.despawn,
+            "state": self.state,
+            "move": self.move,
+            "celebrate": self.celebrate,
+            "stats": self.snapshot,
+        }
+
+    def listen(self):
+        # A socket left behind by a buddy that crashed would make listening fail, but one that still answers
+        # belongs to another instance that's running
+        probe = QLocalSocket()
+        probe.connectToServer(self.name)
+        if probe.waitForConnected(self.PROBE_TIMEOUT):
+            probe.disconnectFromServer()
+            raise OSError("another instance is already listening on %s" % self.name)
+        QLocalServer.removeServer(self.name)
+        if not self.server.listen(self.name):
+            raise OSError("can't listen on %s: %s" % (self.name, self.server.errorString()))
+        return self.server.fullServerName()
+
+    def close(self):
+        self.server.close()
+        for socket in list(self.clients):
+            socket.disconnectFromServer()
+
+    def accept(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            self.clients[socket] = b""
+            socket.readyRead.connect(lambda socket=socket: self.read(socket))
+            socket.disconnected.connect(lambda socket=socket: self.drop(socket))
+
+    def drop(self, socket):
+        if self.clients.pop(socket, None) is not None:
+            socket.deleteLater()
+
+    def read(self, socket):
+        data = self.clients.get(socket)
+        if data is None:
+            return
+        data += bytes(socket.readAll())
+        *lines, data = data.split(b"\n")
+        if len(data) > self.MAX_LINE:
+            socket.abort()
+            return
+        self.clients[socket] = data
+
+        replies = [self.handle_line(line) for line in lines if line.strip()]
+        if replies:
+            socket.write(b"".join(json.dumps(reply, separators=(",", ":")).encode("utf-8") + b"\n"
+                                  for reply in replies))
+
+    def handle_line(self, line):
+        try:
+            request = json.loads(line.decode("utf-8"))
+        except ValueError as error:
+            return {"ok": False, "error": "invalid JSON: %s" % error}
+
+        stats.count("control_batches")
+        start = time.perf_counter()
+        if isinstance(request, list):
+            reply = [self.execute(command) for command in request]
+        else:
+            reply = self.execute(request)
+        stats.record("control_batch", (time.perf_counter() - start) * 1000)
+        return reply
+
+    def execute(self, command):
+        stats.count("control_commands")
+        if not isinstance(command, dict):
+            return {"ok": False, "error": "commands are JSON objects"}
+
+        handler = self.commands.get(command.get("cmd"))
+        try:
+            if handler is None:
+                raise ControlError("unknown command %r" % command.get("cmd"))
+            result = handler(command)
+            result["ok"] = True
+        except ControlError as error:
+            result = {"ok": False, "error": str(error)}
+        except (KeyError, TypeError, ValueError) as error:
+            result = {"ok": False, "error": "bad arguments: %r" % error}
+
+        if "id" in command:
+            result["id"] = command["id"]
+        return result
+
+    # Active buddies the command is about: the ones listed in "buddies", the ones of "character", or all of them
+    def targets(self, command):
+        selection = self.selection
+        if "buddies" in command:
+            active = set(selection.active_buddies)
+            buddies = []
+            for index in command["buddies"]:
+                buddy = selection.scheduler.buddies.get(index)
+                if buddy is None or buddy not in active:
+                    raise ControlError("no active buddy %r" % index)
+                buddies.append(buddy)
+            return buddies
+        character = command.get("character")
+        return [buddy for buddy in selection.active_buddies if character is None or buddy.character == character]
+
+    def ping(self, command):
+        return {}
+
+    def list_buddies(self, command):
+        buddies = []
+        for buddy in self.targets(command):
+            entry = buddy.session_entry()
+            entry["buddy"] = buddy.index
+            buddies.append(entry)
+        return {"buddies": buddies}
+
+    def spawn(self, command):
+        character = command["character"]
+        if character not in self.selection.buttons:
+            raise ControlError("unknown character %r" % character)
+        count = int(command.get("count", 1))
+        if count < 0:
+            raise ControlError("can't spawn %d buddies" % count)
+        return {"buddies": [buddy.index for buddy in self.selection.spawn(character, count)]}
+
+    # Crowd instances go back to their pool, the buddy of a character button gets its button unchecked
+    # Without a list of buddies only crowd instances are despawned, up to "count" of them
+    def despawn(self, command):
+        selection = self.selection
+        if "buddies" in command:
+            buddies = self.targets(command)
+        else:
+            crowd = set(selection.crowd)
+            buddies = [buddy for buddy in self.targets(command) if buddy in crowd]
+            if "count" in command:
+                buddies = buddies[max(0, len(buddies) - int(command["count"])):]  # The newest ones
+
+        for buddy in buddies:
+            if buddy in selection.crowd:
+                selection.despawn(buddy)
+            else:
+                selection.buttons[buddy.character].setChecked(False)
+        return {"despawned": len(buddies)}
+
+    # Force a state, like the buddies do when they celebrate an update, which goes in the trace when recording
+    def state(self, command):
+        name = command["state"]
+        buddies = self.targets(command)
+        for buddy in buddies:
+            if STATES.get(name) not in buddy.behaviour.specs:
+                raise ControlError("%s can't be in state %r" % (buddy.character, name))
+        for buddy in buddies:
+            buddy.force_state(name)
+        return {"buddies": len(buddies)}
+
+    def move(self, command):
+        buddy = self.targets({"buddies": [command["buddy"]]})[0]
+        if not buddy.teleport(int(command["x"]), int(command["y"])):
+            raise ControlError("(%d, %d) isn't on a monitor" % (command["x"], command["y"]))
+        buddy.session_changed.emit()
+        return {"x": buddy.model.x[buddy.index], "y": buddy.model.y[buddy.index]}
+
+    def celebrate(self, command):
+        self.selection.celebrate_update(command.get("update", {}))
+        return {"buddies": len(self.selection.active_buddies)}
+
+    def snapshot(self, command):
+        return {"stats": stats.snapshot()}
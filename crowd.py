@@ -0,0 +1,493 @@
+import time
+from bisect import bisect_right
+from collections import Counter
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import Qt, QPoint, QRect
+from PyQt5.QtGui import QPixmap, QRegion
+
+from animation import scaled_cache
+from behaviour import DRAG, WALK
+from buddy_model import load_numpy, sprite_limits
+from simulation import (THREAD, PROCESS, COLUMNS, FREE, LIMITS, LOOP, SPAWN, DESPAWN, GRAB, MOVE, DROP, Snapshot,
+                        SimulationWorker)
+from stats import stats
+
+TILE = 256  # Pixels, the batch refresh repaints at most one rectangle per tile of the desktop
+
+
+# Same sprite HomestuckBuddy would show for the state
+def pack_sprite(pack, state, dir_x, moving):
+    if state == DRAG and "abscond" in pack.sprites:
+        return pack.sprites["abscond"]
+    if state == WALK and moving:
+        return pack.sprites["front_walk_right" if dir_x > 0 else "front_walk_left"]
+    spec = pack.behaviour.specs.get(state)
+    if spec is not None and spec.sprite is not None:
+        return pack.sprites[spec.sprite[:-len("_sprite")]]
+    return pack.sprites["front_right" if dir_x > 0 else "front_left"]
+
+
+# A buddy simulated by the worker, drawn on the overlay from the newest frame the worker published
+# It has the parts of HomestuckBuddy the overlay uses, and its animation is played from the clock instead
+# of a frame timer, so a crowd of them costs no timers at all
+# With NumPy the crowd draws itself from its arrays, and these are only made for the buddies the user clicks
+class RemoteBuddy:
+    def __init__(self, crowd, slot, pack):
+        self.crowd = crowd
+        self.slot = slot  # Slot in the worker's model
+        self.pack = pack
+        self.character = pack.name
+        self.overlay = None
+        self.player = self  # The overlay asks the buddy's player for the frame and the mask
+        self.animation = None
+        self.timeline = None  # End time of every frame of the animation, in milliseconds
+        self.started = 0  # When the animation started
+        self.current_frame = 0
+        self.key = None  # What the animation was picked for: state, facing and walking
+        self.x = 0
+        self.y = 0
+
+    # Catch up with the worker's frame, returns True if the buddy has to be repainted
+    def update(self, x, y, state, dir_x, moving, now):
+        key = (state, dir_x > 0, bool(moving))
+        changed = key != self.key or x != self.x or y != self.y
+        if key != self.key:
+            self.key = key
+            self.animation, self.timeline = self.crowd.animation(pack_sprite(self.pack, state, dir_x, moving))
+            self.started = now
+        self.x = x
+        self.y = y
+
+        frame = 0
+        if len(self.timeline) > 1 and self.timeline[-1] > 0:
+            frame = min(bisect_right(self.timeline, (now - self.started) % self.timeline[-1]), len(self.timeline) - 1)
+        if frame != self.current_frame:
+            self.current_frame = frame
+            changed = True
+        return changed
+
+    def current_pixmap(self):
+        if self.animation is None:
+            return QPixmap()
+        return self.animation.frame(self.current_frame)
+
+    def frame_pos(self):
+        return QPoint(self.x, self.y)
+
+    def sprite_rect(self):
+        return QRect(self.frame_pos() + self.animation.offset, self.animation.size())
+
+    # The worker keeps simulating buddies nobody can see, there's nothing to pause here
+    def set_exposed(self, exposed):
+        pass
+
+    # Picking up and dragging is done by the worker, the buddy follows on the next frame
+    def press(self, pos):
+        self.crowd.grab(self, pos)
+
+    def drag_move(self, global_pos):
+        self.crowd.drag(self, global_pos)
+
+    def release(self):
+        self.crowd.drop(self)
+
+    # Simulated buddies can't be resized on their own, they all have the crowd's size
+    def show_menu(self, pos):
+        pass
+
+
+# Bounding rectangle of the rectangles (left, top, right, bottom arrays) that start in each tile, as QRects
+# Rectangles are never split, so a merged one can reach into the next tiles by up to one sprite
+def merge_rects(left, top, right, bottom):
+    np = load_numpy()
+    if not len(left):
+        return []
+    tiles = (left // TILE) * 65536 + top // TILE
+    order = np.argsort(tiles, kind="stable")
+    tiles = tiles[order]
+    starts = np.flatnonzero(np.concatenate(([True], tiles[1:] != tiles[:-1])))
+    merged = zip(np.minimum.reduceat(left[order], starts).tolist(),
+                 np.minimum.reduceat(top[order], starts).tolist(),
+                 np.maximum.reduceat(right[order], starts).tolist(),
+                 np.maximum.reduceat(bottom[order], starts).tolist())
+    return [QRect(x, y, r - x, b - y) for x, y, r, b in merged]
+
+
+# Crowd simulated by a worker thread or process, see simulation.py
+# The GUI thread only copies the newest frame out of the shared memory and repaints the buddies that changed,
+# so stepping the simulation never holds up painting, however many buddies there are
+#
+# With NumPy the crowd is one layer of the overlay: the frame is compared with the last one in bulk, and the
+# animation frame of every buddy is picked for all the buddies playing the same animation at once. Only the
+# buddies that changed are repainted, with their rectangles merged per tile, and nothing is kept per buddy
+# but a few arrays, so a refresh costs about the same however many buddies there are. Without NumPy every
+# buddy is a RemoteBuddy on the overlay, updated one at a time
+class SimulatedCrowd(QtCore.QObject):
+    FRAME_INTERVAL = 16  # Milliseconds between repaints
+    MASK_INTERVAL = 100  # Milliseconds between updates of the layer's input mask, they cost a lot with big crowds
+    DETAILED_MASK = 128  # Buddies on an overlay up to which the mask has their pixels, beyond it their rectangles
+    MASK_CELL = 16  # Pixels, rectangles are rounded out to cells of this size in the rougher mask
+
+    def __init__(self, selection, mode, *args, seed=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.selection = selection
+        self.packs = list(selection.packs.values())  # The worker knows characters by their index in here
+        self.characters = {pack.name: index for index, pack in enumerate(self.packs)}
+        self.scale = selection.scale
+        self.ratio = selection.desktop.ratio(selection.desktop.primary)
+        self.seed = seed
+
+        self.worker = SimulationWorker(mode, seed=seed, behaviours=[pack.behaviour for pack in self.packs])
+        self.snapshot = Snapshot()
+        self.population = 0  # Buddies out
+        self.buddies = {}  # Slot -> RemoteBuddy
+        self.sent = set()  # Characters whose limits and loop durations the worker has
+        self.timelines = {}  # Animation -> end time of every frame
+        self.grabbed = None  # (buddy, press position relative to it)
+
+        # Layer of the batch refresh, see reset_slots
+        self.slots = None
+        self.count = 0  # Slots in the last frame
+        self.masks = {}  # Overlay geometry -> input mask of the layer on it, until the next mask update
+        self.masked = 0  # When the masks were last dropped
+        self.masks_stale = False
+
+        self.clock = QtCore.QElapsedTimer()
+        self.clock.start()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.refresh)
+
+    def start(self):
+        self.worker.start()
+        self.timer.start(self.FRAME_INTERVAL)
+
+    def stop(self):
+        self.timer.stop()
+        self.worker.stop()
+
+    # Milliseconds the worker's last tick took and how many ticks it ran, zeros once it stopped
+    def timing(self):
+        if self.worker.view is None:
+            return 0, 0
+        return self.worker.frame.timing()
+
+    # Animation at the crowd's size and the frame timeline to play it with
+    def animation(self, path):
+        animation = scaled_cache.get(path, self.scale, self.ratio)
+        timeline = self.timelines.get(animation)
+        if timeline is None:
+            timeline = self.timelines[animation] = []
+            for delay in animation.delays:
+                timeline.append((timeline[-1] if timeline else 0) + delay)
+        return animation, timeline
+
+    def send(self, *message):
+        if not self.worker.inputs.put(*message):
+            stats.count("simulation_inputs_dropped")
+
+    # Spawn count buddies of a character on the primary monitor once its sprites are loaded
+    def spawn(self, character, count=1):
+        pack = self.packs[self.characters[character]]
+        self.selection.loader.request(list(pack.sprites.values()), lambda: self.send_spawn(pack, count))
+
+    def send_spawn(self, pack, count):
+        character = self.characters[pack.name]
+        if character not in self.sent:
+            self.sent.add(character)
+            animation = self.animation(pack.sprites["front_left"])[0]
+            sprite = (animation.offset.x(), animation.offset.y(), animation.size().width(), animation.size().height())
+            desktop = self.selection.desktop
+            self.send(LIMITS, character, 0, *sprite_limits(desktop.monitor(desktop.primary), sprite))
+            for spec in pack.behaviour.specs.values():
+                if spec.sprite is not None:
+                    duration = self.animation(pack.sprites[spec.sprite[:-len("_sprite")]])[0].duration()
+                    self.send(LOOP, character, 0, spec.state, duration)
+        self.send(SPAWN, character, 0, count)
+
+    def despawn(self, buddy):
+        self.send(DESPAWN, 0, buddy.slot)
+
+    def grab(self, buddy, pos):
+        self.grabbed = (buddy, pos)
+        self.send(GRAB, 0, buddy.slot)
+
+    def drag(self, buddy, global_pos):
+        if self.grabbed is not None and self.grabbed[0] is buddy:
+            pos = global_pos - self.grabbed[1]
+            self.send(MOVE, 0, buddy.slot, pos.x(), pos.y())
+
+    def drop(self, buddy):
+        self.grabbed = None
+        self.send(DROP, 0, buddy.slot)
+
+    # Copy the newest frame, if the worker published one, and repaint what moved or changed frames since
+    def refresh(self):
+        if not self.worker.alive():
+            self.worker_stopped()
+            return
+
+        start = time.perf_counter()
+        snapshot = self.worker.frame.read(self.snapshot.sequence)
+        if snapshot is not None:
+            self.snapshot = snapshot
+
+        overlay = self.selection.overlay_renderer()
+        now = self.clock.elapsed()
+        if load_numpy() is not None:
+            self.refresh_batch(self.snapshot, overlay, now)
+        else:
+            self.refresh_each(self.snapshot, overlay, now)
+        stats.record("simulation_frame", (time.perf_counter() - start) * 1000)
+
+    # One buddy at a time, when NumPy isn't there
+    def refresh_each(self, snapshot, overlay, now):
+        for slot, character in enumerate(snapshot.character):
+            buddy = self.buddies.get(slot)
+            if buddy is not None and (character == FREE or buddy.character != self.packs[character].name):
+                overlay.remove(buddy)
+                del self.buddies[slot]
+                buddy = None
+            if character == FREE:
+                continue
+
+            if buddy is None:
+                buddy = self.buddies[slot] = RemoteBuddy(self, slot, self.packs[character])
+                buddy.update(snapshot.x[slot], snapshot.y[slot], snapshot.state[slot], snapshot.dir_x[slot],
+                             snapshot.moving[slot], now)
+                overlay.add(buddy)
+            elif buddy.update(snapshot.x[slot], snapshot.y[slot], snapshot.state[slot], snapshot.dir_x[slot],
+                              snapshot.moving[slot], now):
+                overlay.invalidate(buddy)
+        self.population = len(self.buddies)
+
+    # Per slot arrays of the batch refresh, for at least count slots: the columns of the last frame, the animation
+    # every slot plays (-1 for none) since when, the frame it showed and the rectangle it was painted in.
+    # Animations are numbered, with their timelines and sprite rectangles
+    def reset_slots(self, count=0):
+        np = load_numpy()
+        size = max(count, 64)
+        slots = {name: np.zeros(size, dtype=code) for name, code in COLUMNS}
+        slots["character"][:] = FREE
+        slots.update(animation=np.full(size, -1, dtype=np.intc), started=np.zeros(size, dtype=np.int64),
+                     frame=np.zeros(size, dtype=np.intc),
+                     rect=np.zeros((4, size), dtype=np.intc))  # Left, top, right, bottom
+        old = self.slots
+        if old is not None:
+            for name, column in slots.items():
+                column[..., :old[name].shape[-1]] = old[name]
+        else:
+            self.key_animations = {}  # Key -> animation number, see key_animation
+            self.animation_ids = {}  # Animation -> number
+            self.animation_table = []  # Number -> (animation, timeline as an array, loop length)
+            self.animation_rects = np.zeros((4, 0), dtype=np.intc)  # Offset x, offset y, width, height by number
+        self.slots = slots
+
+    # Number of the animation for a key made of the character, state, facing right and walking
+    def key_animation(self, key):
+        number = self.key_animations.get(key)
+        if number is None:
+            path = pack_sprite(self.packs[key >> 10], (key >> 2) & 255, 1 if key & 2 else -1, key & 1)
+            number = self.key_animations[key] = self.animation_id(*self.animation(path))
+        return number
+
+    def animation_id(self, animation, timeline):
+        np = load_numpy()
+        number = self.animation_ids.get(animation)
+        if number is None:
+            number = self.animation_ids[animation] = len(self.animation_table)
+            length = timeline[-1] if timeline else 0
+            self.animation_table.append((animation, np.array(timeline, dtype=np.int64), length))
+            rect = [[animation.offset.x()], [animation.offset.y()], [animation.size().width()],
+                    [animation.size().height()]]
+            self.animation_rects = np.concatenate((self.animation_rects, np.array(rect, dtype=np.intc)), axis=1)
+        return number
+
+    def refresh_batch(self, snapshot, overlay, now):
+        np = load_numpy()
+        overlay.add_layer(self)
+        count = len(snapshot.character)
+        if self.slots is None or count > len(self.slots["character"]):
+            self.reset_slots(2 * count)
+        slots = self.slots
+        self.count = count
+        columns = {name: np.frombuffer(getattr(snapshot, name), dtype=code) for name, code in COLUMNS}
+        last = {name: slots[name][:count] for name, _ in COLUMNS}
+
+        character = columns["character"]
+        alive = character != FREE
+        painted = last["character"] != FREE  # Has a rectangle from the last refresh
+        replaced = last["character"] != character
+        keyed = alive & (replaced | (columns["state"] != last["state"]) | (columns["moving"] != last["moving"]) |
+                         ((columns["dir_x"] > 0) != (last["dir_x"] > 0)))
+        animation = slots["animation"][:count]
+        started = slots["started"][:count]
+        animation[~alive] = -1
+        for slot in np.flatnonzero(replaced & painted).tolist():
+            self.buddies.pop(slot, None)
+
+        # A new state, facing or walking means a new animation, looked up once for every different one
+        keyed_slots = np.flatnonzero(keyed)
+        if keyed_slots.size:
+            keys = (((character[keyed_slots].astype(np.int64) * 256 + columns["state"][keyed_slots]) * 2 +
+                     (columns["dir_x"][keyed_slots] > 0)) * 2 + (columns["moving"][keyed_slots] != 0))
+            keys, inverse = np.unique(keys, return_inverse=True)
+            numbers = np.array([self.key_animation(key) for key in keys.tolist()], dtype=np.intc)
+            animation[keyed_slots] = numbers[inverse.ravel()]
+            started[keyed_slots] = now
+
+        frame = np.zeros(count, dtype=np.intc)
+        elapsed = now - started
+        for number in np.unique(animation[alive]).tolist():
+            _, timeline, length = self.animation_table[number]
+            if len(timeline) > 1 and length > 0:
+                playing = np.flatnonzero(animation == number)
+                frame[playing] = np.minimum(np.searchsorted(timeline, elapsed[playing] % length, side="right"),
+                                            len(timeline) - 1)
+
+        moved = keyed | (alive & ((columns["x"] != last["x"]) | (columns["y"] != last["y"])))
+        changed = moved | (alive & (frame != slots["frame"][:count]))
+        gone = painted & ~alive
+
+        # Repaint where the changed buddies were and where they are now
+        rect = slots["rect"][:, :count]
+        areas = [rect[:, (changed & painted) | gone]]
+        changed_slots = np.flatnonzero(changed)
+        offset_x, offset_y, width, height = self.animation_rects[:, animation[changed_slots]]
+        left = columns["x"][changed_slots] + offset_x
+        top = columns["y"][changed_slots] + offset_y
+        rect[:, changed_slots] = (left, top, left + width, top + height)
+        areas.append(rect[:, changed_slots])
+        for area in merge_rects(*np.concatenate(areas, axis=1)):
+            overlay.repaint(area, masks=False)
+
+        slots["frame"][:count] = frame
+        for name, _ in COLUMNS:
+            last[name][:] = columns[name]
+        self.population = int(np.count_nonzero(alive))
+
+        # The input mask follows the buddies, but not on every frame
+        self.masks_stale |= bool(moved.any() or gone.any())
+        if self.masks_stale and now - self.masked >= self.MASK_INTERVAL:
+            self.masks.clear()
+            self.masks_stale = False
+            self.masked = now
+            overlay.masks_changed()
+
+    # Slots of the layer whose rectangle is inside the desktop rectangle, bottom one first
+    def slots_in(self, area):
+        np = load_numpy()
+        count = self.count
+        left, top, right, bottom = self.slots["rect"][:, :count]
+        return np.flatnonzero((self.slots["character"][:count] != FREE) & (left <= area.right()) &
+                              (right > area.left()) & (top <= area.bottom()) & (bottom > area.top()))
+
+    # Overlay layer: draw the buddies inside the repainted area, which is in desktop coordinates
+    def paint(self, painter, area, origin):
+        if self.slots is None:
+            return
+        slots = self.slots
+        inside = self.slots_in(area)
+        table = self.animation_table
+        for left, top, number, frame in zip((slots["rect"][0][inside] - origin.x()).tolist(),
+                                            (slots["rect"][1][inside] - origin.y()).tolist(),
+                                            slots["animation"][inside].tolist(), slots["frame"][inside].tolist()):
+            painter.drawPixmap(left, top, table[number][0].frame(frame))
+
+    # Overlay layer: input mask of the buddies on an overlay, in its coordinates
+    # Adding up the mask of every buddy costs too much for big crowds, they get the cells their rectangles cover
+    def mask(self, geometry):
+        key = (geometry.x(), geometry.y(), geometry.width(), geometry.height())
+        region = self.masks.get(key)
+        if region is None:
+            region = QRegion()
+            inside = self.slots_in(geometry) if self.slots is not None else ()
+            if len(inside) > self.DETAILED_MASK:
+                region = self.cell_mask(inside, geometry)
+            elif len(inside):
+                slots = self.slots
+                table = self.animation_table
+                for left, top, number in zip((slots["rect"][0][inside] - geometry.x()).tolist(),
+                                             (slots["rect"][1][inside] - geometry.y()).tolist(),
+                                             slots["animation"][inside].tolist()):
+                    region += table[number][0].mask.translated(left, top)
+            self.masks[key] = region
+        return region
+
+    # Cells of an overlay covered by the rectangles of the slots, marked all at once with a 2D difference array,
+    # then turned into one rectangle per run of covered cells in every row
+    def cell_mask(self, inside, geometry):
+        np = load_numpy()
+        cell = self.MASK_CELL
+        columns = -(-geometry.width() // cell)
+        rows = -(-geometry.height() // cell)
+        left, top, right, bottom = self.slots["rect"][:, inside]
+        x0 = np.clip((left - geometry.x()) // cell, 0, columns)
+        x1 = np.clip((right - geometry.x() - 1) // cell + 1, 0, columns)
+        y0 = np.clip((top - geometry.y()) // cell, 0, rows)
+        y1 = np.clip((bottom - geometry.y() - 1) // cell + 1, 0, rows)
+
+        edges = np.zeros((rows + 1, columns + 1), dtype=np.intc)
+        np.add.at(edges, (y0, x0), 1)
+        np.add.at(edges, (y0, x1), -1)
+        np.add.at(edges, (y1, x0), -1)
+        np.add.at(edges, (y1, x1), 1)
+        covered = np.zeros((rows, columns + 2), dtype=np.int8)
+        covered[:, 1:-1] = edges.cumsum(axis=0).cumsum(axis=1)[:rows, :columns] > 0
+        runs = np.diff(covered, axis=1)
+        row, start = np.nonzero(runs == 1)
+        end = np.nonzero(runs == -1)[1]
+
+        # One band per row, sorted by y then x and never overlapping, the way setRects needs them
+        region = QRegion()
+        region.setRects([QRect(x * cell, y * cell, (x_end - x) * cell, cell)
+                         for y, x, x_end in zip(row.tolist(), start.tolist(), end.tolist())])
+        return region
+
+    # Overlay layer: topmost buddy with a visible pixel at the desktop position
+    def buddy_at(self, pos):
+        if self.slots is None:
+            return None
+        slots = self.slots
+        for slot in reversed(self.slots_in(QRect(pos, pos)).tolist()):
+            pixmap = self.animation_table[slots["animation"][slot]][0].frame(slots["frame"][slot])
+            image = pixmap.toImage()
+            local = (pos - QPoint(slots["rect"][0][slot], slots["rect"][1][slot])) * pixmap.devicePixelRatio()
+            if image.valid(local) and image.pixelColor(local).alpha() > 0:
+                buddy = self.buddies.get(slot)
+                if buddy is None:
+                    buddy = self.buddies[slot] = RemoteBuddy(self, slot, self.packs[slots["character"][slot]])
+                buddy.x, buddy.y = int(slots["x"][slot]), int(slots["y"][slot])
+                return buddy
+        return None
+
+    # The worker process died, most likely killed or out of memory. The crowd carries on simulated on a thread,
+    # with as many buddies of every character as it had, a thread that died too leaves the crowd as it is
+    def worker_stopped(self):
+        stats.count("simulation_worker_stopped")
+        counts = Counter(character for character in self.snapshot.character if character != FREE)
+        print("The crowd simulation %s stopped%s" % (self.worker.mode, ", carrying on on a thread"
+                                                     if self.worker.mode == PROCESS else ""))
+        self.worker.stop()
+
+        overlay = self.selection.overlay_renderer()
+        for buddy in self.buddies.values():
+            overlay.remove(buddy)
+        if self.slots is not None:
+            overlay.remove_layer(self)
+        self.buddies.clear()
+        self.snapshot = Snapshot()
+        self.slots = None
+        self.count = self.population = 0
+        self.masks.clear()
+        self.grabbed = None
+        if self.worker.mode != PROCESS:
+            self.timer.stop()
+            return
+
+        self.worker = SimulationWorker(THREAD, seed=self.seed, behaviours=[pack.behaviour for pack in self.packs])
+        self.sent.clear()
+        self.worker.start()
+        for character, count in counts.items():
+            self.send_spawn(self.packs[character], count)
@@ -0,0 +1,60 @@
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtWidgets import QApplication
+
+
+# Monitor layout shared by every buddy
+# The monitors are only queried at startup and when Qt says a screen was added, removed or changed,
+# instead of every time a buddy spawns. Each monitor is kept as its own (x, y, width, height) rectangle
+class DesktopGeometry(QtCore.QObject):
+    changed = pyqtSignal()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.monitors = []
+        self.ratios = []  # Device pixel ratio of every monitor
+        self.primary = 0
+        self.queries = 0  # How many times the monitors were queried
+
+        app = QApplication.instance()
+        app.screenAdded.connect(self.screen_added)
+        app.screenRemoved.connect(self.refresh)
+        app.primaryScreenChanged.connect(self.refresh)
+        for screen in app.screens():
+            self.watch(screen)
+        self.refresh()
+
+    def watch(self, screen):
+        screen.geometryChanged.connect(self.refresh)
+        screen.logicalDotsPerInchChanged.connect(self.refresh)
+
+    def screen_added(self, screen):
+        self.watch(screen)
+        self.refresh()
+
+    def refresh(self):
+        self.queries += 1
+        app = QApplication.instance()
+        screens = app.screens()
+        self.monitors = [(g.x(), g.y(), g.width(), g.height()) for g in (screen.geometry() for screen in screens)]
+        self.ratios = [screen.devicePixelRatio() for screen in screens]
+        primary = app.primaryScreen()
+        self.primary = screens.index(primary) if primary in screens else 0
+        self.changed.emit()
+
+    # Index of the monitor containing the point, or None if it's in a dead zone between monitors
+    def monitor_at(self, x, y):
+        for index, (left, top, width, height) in enumerate(self.monitors):
+            if left <= x < left + width and top <= y < top + height:
+                return index
+        return None
+
+    def monitor(self, index):
+        if 0 <= index < len(self.monitors):
+            return self.monitors[index]
+        return self.monitors[self.primary] if self.monitors else (0, 0, 1920, 1080)
+
+    def ratio(self, index):
+        if 0 <= index < len(self.ratios):
+            return self.ratios[index]
+        return 1.0
@@ -0,0 +1,110 @@
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal
+
+from animation import AnimationCache, animation_cache
+from stats import stats
+
+
+# Decodes one sprite on a pool thread and sends the frames back to the loader
+class DecodeTask(QtCore.QRunnable):
+    def __init__(self, path, loader):
+        super().__init__()
+        self.setAutoDelete(False)  # The loader keeps it until the frames arrive
+        self.path = path
+        self.loader = loader
+        self.deltas = loader.cache.delta  # Whether to find what changed between frames, see AnimationCache.build
+
+    def run(self):
+        frames = AnimationCache.read_frames(self.path, self.deltas)
+        try:
+            self.loader.decoded.emit(self.path, frames)
+        except RuntimeError:
+            pass  # The loader was deleted while decoding, nobody is waiting for the frames anymore
+
+
+# Loads sprites in the background, so spawning a buddy never waits for its GIFs to be decoded
+# Files are read and decoded into QImages on a thread pool, then turned into pixmaps on the GUI thread
+# one sprite per event loop turn. Sprites in the sprite bundle are already decoded and are loaded right away
+class SpriteLoader(QtCore.QObject):
+    decoded = pyqtSignal(str, object)  # Emitted from the pool threads, delivered on the GUI thread
+
+    REQUEST_PRIORITY = 1  # Sprites a buddy is waiting for go before prefetched ones
+    PREFETCH_PRIORITY = 0
+
+    def __init__(self, cache=animation_cache, threads=2, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(threads)
+
+        self.tasks = {}  # Path -> task that's queued or running
+        self.waiting = []  # [paths still missing, callback] for every request that isn't done
+
+        self.decoded.connect(self.finish)
+
+        # Wait for the running tasks before the application goes away, so no thread emits into a deleted loader
+        app = QtCore.QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.shutdown)
+
+    # Load the sprites and call the callback once all of them are in the cache
+    # The callback is called right away if they already are
+    def request(self, paths, callback):
+        missing = set()
+        for path in paths:
+            if path in self.cache.animations:
+                continue
+            if self.cache.bundled(path):
+                self.cache.get(path)
+                continue
+
+            missing.add(path)
+            task = self.tasks.get(path)
+            if task is None:
+                self.start(path, self.REQUEST_PRIORITY)
+            elif self.pool.tryTake(task):
+                # Was only prefetched and hasn't started yet, move it to the front of the queue
+                self.pool.start(task, self.REQUEST_PRIORITY)
+
+        if missing:
+            self.waiting.append([missing, callback])
+        else:
+            callback()
+
+    # Decode sprites nobody asked for yet, when the pool has nothing better to do
+    def prefetch(self, paths):
+        for path in paths:
+            if path not in self.cache.animations and path not in self.tasks and not self.cache.bundled(path):
+                self.start(path, self.PREFETCH_PRIORITY)
+
+    def start(self, path, priority):
+        task = self.tasks[path] = DecodeTask(path, self)
+        self.pool.start(task, priority)
+
+    def finish(self, path, frames):
+        self.tasks.pop(path, None)
+        stats.count("sprites_decoded_async")
+
+        # The sprite may have been decoded on the spot in the meantime, the cached one stays so players
+        # that already use it keep the same frames
+        if path not in self.cache.animations:
+            self.cache.put(path, AnimationCache.build(path, *frames))
+
+        done = []
+        for request in self.waiting:
+            request[0].discard(path)
+            if not request[0]:
+                done.append(request)
+        for request in done:
+            self.waiting.remove(request)
+            request[1]()
+
+    def pending(self):
+        return len(self.tasks)
+
+    # Drop the queued tasks and wait for the running ones
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
+        self.tasks.clear()
+        self.waiting.clear()
@@ -1,12 +1,41 @@
+import time
+STARTUP_TIME = time.perf_counter()  # Taken before anything else is imported, for the startup profile
+
 from PyQt5 import QtWidgets, QtCore, QtGui
-from PyQt5.QtCore import Qt, QPoint, QThread, pyqtSlot
-from PyQt5.QtGui import QPixmap, QMovie
+from PyQt5.QtCore import Qt, QPoint, QThread, pyqtSignal, pyqtSlot
 from PyQt5.QtWidgets import QApplication, QLabel, QSystemTrayIcon, QAction, QMenu, QWidget, QDesktopWidget
 import sys
 import random
+import argparse
 import os
-import webbrowser
-from screeninfo import get_monitors
+from animation import AnimationPlayer, animation_cache, scaled_cache
+from scheduler import BuddyScheduler, PowerPolicy, POWER_POLICIES
+from buddy_model import SPEED, sprite_limits
+from behaviour import STATES, STATE_NAMES, WALK
+from spatial import BOUNCE, INTERACTIONS, NO_INTERACTION
+from desktop import DesktopGeometry
+from stats import stats, Stats
+from storage import write_json_atomic
+from bundle import SpriteBundle
+from loader import SpriteLoader
+from session import SessionStore
+from simulation import MODES
+from packs import THUMBNAIL_DIR, load_packs, thumbnail
+from recording import (read_header, TraceRecorder, TracePlayer, SPAWN, DESPAWN, PLACE, PICK, PRESS, DRAG, RELEASE,
+                       START, STATE, DIRECTION, LOOPS)
+
+
+# Character buttons in the selection window, pressed while their buddy is out
+CHARACTER_BUTTON_STYLE = ("QPushButton {\n"
+                          "    border: none;\n"
+                          "    background-color: #efefef;\n"
+                          "}\n"
+                          "\n"
+                          "QPushButton:checked{\n"
+                          "    border-top: 2px solid #535353;\n"
+                          "    border-left: 2px solid #535353;\n"
+                          "    background-color: #c6c6c6;\n"
+                          "}")
 
 
 # Get path for temp folder when the program is executed
@@ -30,23 +59,117 @@ class OpenWeb(QThread):
         self.function(*self.args, **self.kwargs)
 
 
+# webbrowser is only imported when a link is actually opened, it's slow to import and rarely used
 def open_about():
+    import webbrowser
     webbrowser.open("https://modestcarl.itch.io/homestuck-desktop-buddies", 2)
 
 
 def open_hs():
+    import webbrowser
     webbrowser.open("https://www.homestuck.com/", 2)
 
 
 def open_hs2():
+    import webbrowser
     webbrowser.open("https://www.homestuck2.com/", 2)
 
 
+# Times each phase of the startup, shown with --startup-profile
+class StartupProfile:
+    def __init__(self, start=STARTUP_TIME):
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    # End the current phase
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.start
+
+    def report(self):
+        lines = ["Startup profile (%s build)" % ("PyInstaller" if hasattr(sys, '_MEIPASS') else "source")]
+        for name, duration in self.phases:
+            lines.append("  %-24s %8.1f ms" % (name, duration * 1000))
+        lines.append("  %-24s %8.1f ms" % ("time to window shown", self.total() * 1000))
+        return "\n".join(lines)
+
+
+# Window with the performance counters, opened from the tray menu
+class StatsWindow(QWidget):
+    def __init__(self, selection, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.selection = selection
+
+        self.setWindowIcon(QtGui.QIcon(resource_path('graphics/logo.ico')))
+        self.setWindowTitle("Stats")
+        self.resize(560, 520)
+
+        self.text = QtWidgets.QPlainTextEdit(self)
+        self.text.setReadOnly(True)
+        self.text.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+
+        save_button = QtWidgets.QPushButton("Save JSON...", self)
+        save_button.clicked.connect(self.save)
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.text)
+        layout.addWidget(save_button)
+
+        # Refresh once a second, only while the window is open
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.refresh_timer.start(1000)
+
+    def hideEvent(self, event):
+        self.refresh_timer.stop()
+
+    def refresh(self):
+        self.text.setPlainText(Stats.format(stats.snapshot()))
+
+    def save(self):
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save stats", "buddy-stats.json", "JSON (*.json)")
+        if path:
+            write_json_atomic(path, stats.snapshot())
+
+
 class BuddySelection(QWidget):
-    def __init__(self, *args, **kwargs):
+    COLUMNS = 4  # Character buttons per row
+    ICON_SIZE = 160
+
+    def __init__(self, *args, overlay=False, stats_file=None, stats_interval=0, power_policy=None, scale=1.0,
+                 interactions=BOUNCE, seed=None, packs=None, **kwargs):
         super().__init__(*args, **kwargs)
+        # Installed characters by name, read from their packs' manifests through the cached index
+        self.packs = packs if packs is not None else load_packs(resource_path(""))
+        # Shared clock for every buddy's movement and state changes
+        self.scheduler = BuddyScheduler(self, policy=power_policy, interactions=interactions)
+        self.desktop = DesktopGeometry(self)  # Monitor layout, kept up to date when monitors change
+        self.loader = SpriteLoader(parent=self)  # Decodes the sprites in the background
+        self.scale = scale  # Starting size of the buddies, each one can be resized from its right click menu
+
+        # Every buddy has its own random stream derived from this seed, so a run can be done again
+        self.seed = seed if seed is not None else random.randrange(1 << 32)
+        self.trace = None  # Trace being recorded or replayed
+
+        # In overlay mode every buddy is painted on one shared window per monitor instead of its own window
+        # The overlay is only created when the first buddy is spawned
+        self.overlay_enabled = overlay
+        self.overlay = None
+
         self.init_ui()
         self.active_buddies = []  # Active buddies list to iterate through it to celebrate the update
+
+        # Extra instances spawned through spawn(), on top of the one per character the buttons control
+        self.crowd = []
+        self.crowd_pool = {}  # Character name -> despawned instances, reused by the next spawn
         self.want_to_close = False  # Check for overriding the close event
 
         # Creating the system tray icon
@@ -70,6 +193,10 @@ class BuddySelection(QWidget):
         about_action = QAction("About", self)
         about_action.triggered.connect(self.open_about)
 
+        # Action for showing the performance stats
+        stats_action = QAction("Stats", self)
+        stats_action.triggered.connect(self.show_stats)
+
         # Action for quiting
         quit_action = QAction("Exit", self)
         quit_action.triggered.connect(self.exit)
@@ -80,6 +207,7 @@ class BuddySelection(QWidget):
         tray_menu.addAction(open_hs_action)
         tray_menu.addAction(open_hs2_action)
         tray_menu.addAction(about_action)
+        tray_menu.addAction(stats_action)
         tray_menu.addAction(quit_action)
 
         self.tray_icon.setContextMenu(tray_menu)  # Adding the context menu to the tray icon
@@ -90,6 +218,82 @@ class BuddySelection(QWidget):
 
         self.minimized_once = False  # Variable for checking if the window has been minimized to tray once
 
+        self.stats_window = None  # Created the first time it's opened
+        self.register_stats()
+
+        self.update_checker = None  # Started by start_update_checker
+        self.session = None  # Saved buddies, set up by enable_session
+        self.control = None  # Local control socket, started by start_control
+        self.replay = None  # Trace player, started by start_replay
+        self.simulation = None  # Crowd simulated off the GUI thread, started by start_simulation
+
+        # Dump the stats to a file every so often, if asked to
+        self.stats_file = stats_file
+        if stats_file and stats_interval > 0:
+            self.stats_timer = QtCore.QTimer(self)
+            self.stats_timer.timeout.connect(self.dump_stats)
+            self.stats_timer.start(int(stats_interval * 1000))
+
+    # Live values for the stats, only computed when a snapshot is taken
+    def register_stats(self):
+        stats.gauge("active_buddies", lambda: len(self.active_buddies))
+        stats.gauge("walking_buddies", lambda: len(self.scheduler.walkers))
+        stats.gauge("pending_deadlines", lambda: len(self.scheduler.pending))
+        stats.gauge("scheduler_wakeups", lambda: self.scheduler.wakeups)
+        stats.gauge("wakeups_per_second", lambda: round(self.scheduler.wakeup_rate(), 1))
+        stats.gauge("tick_interval_ms", lambda: self.scheduler.tick_timer.interval())
+        stats.gauge("suspended_buddies", lambda: sum(not buddy.exposed for buddy in self.created_buddies()))
+        stats.gauge("active_timers", self.active_timer_count)
+        stats.gauge("playing_animations",
+                    lambda: sum(buddy.player.frame_timer.isActive() for buddy in self.created_buddies()))
+        stats.gauge("cached_animations", lambda: len(animation_cache.animations))
+        stats.gauge("animation_cache_hits", lambda: animation_cache.hits)
+        stats.gauge("animation_cache_misses", lambda: animation_cache.misses)
+        stats.gauge("frames_decoded", lambda: animation_cache.frames_decoded)
+        stats.gauge("frames_mapped",
+                    lambda: animation_cache.bundle.frames_mapped if animation_cache.bundle is not None else 0)
+        stats.gauge("frame_callbacks", lambda: AnimationPlayer.frame_callbacks)
+        stats.gauge("frame_pixels", lambda: AnimationPlayer.frame_pixels)
+        stats.gauge("frame_repaint_pixels", lambda: AnimationPlayer.repaint_pixels)
+        stats.gauge("animation_cache_mb",
+                    lambda: round(sum(animation.bytes() for animation in animation_cache.animations.values())
+                                  / (1024 * 1024), 1))
+        stats.gauge("player_surfaces_mb",
+                    lambda: round(sum(buddy.player.surface_bytes() for buddy in self.created_buddies())
+                                  / (1024 * 1024), 1))
+        stats.gauge("sprites_loading", self.loader.pending)
+        if self.scheduler.interactions is not None:
+            stats.gauge("buddy_meetings", lambda: self.scheduler.interactions.meetings)
+            stats.gauge("grid_cells", lambda: len(self.scheduler.model.grid.cells))
+        stats.gauge("scaled_cache_hits", lambda: scaled_cache.hits)
+        stats.gauge("scaled_cache_misses", lambda: scaled_cache.misses)
+        stats.gauge("scaled_cache_evictions", lambda: scaled_cache.evictions)
+        stats.gauge("scaled_cache_animations", lambda: len(scaled_cache.animations))
+        stats.gauge("scaled_cache_mb", lambda: round(scaled_cache.bytes / (1024 * 1024), 1))
+
+    # Buddies that were spawned at least once
+    def created_buddies(self):
+        buddies = list(self.buddies.values())
+        buddies += self.crowd
+        for pool in self.crowd_pool.values():
+            buddies += pool
+        return buddies
+
+    def active_timer_count(self):
+        timers = self.findChildren(QtCore.QTimer)
+        for buddy in self.created_buddies():
+            timers += buddy.findChildren(QtCore.QTimer)
+        return sum(timer.isActive() for timer in timers)
+
+    def show_stats(self):
+        if self.stats_window is None:
+            self.stats_window = StatsWindow(self)
+        self.stats_window.show()
+        self.stats_window.raise_()
+
+    def dump_stats(self):
+        write_json_atomic(self.stats_file, stats.snapshot())
+
     def show_hide(self, reason):
         # If the system tray icon was clicked, and the main window is hidden, show the main window
         if reason == QSystemTrayIcon.Trigger:
@@ -116,11 +320,12 @@ class BuddySelection(QWidget):
         self.setWindowIcon(QtGui.QIcon(resource_path('graphics/logo.ico')))
         self.setWindowTitle("Homestuck Desktop Buddies v1.0.0")
 
-        # Set window geometry and disable resizing
-        self.setGeometry(0, 0, 850, 240)
-        self.resize(850, 240)
-        self.setMinimumSize(QtCore.QSize(850, 240))
-        self.setMaximumSize(QtCore.QSize(850, 240))
+        # Set window geometry and disable resizing, one row of buttons is 240 pixels high
+        height = 240 * max(1, -(-len(self.packs) // self.COLUMNS))
+        self.setGeometry(0, 0, 850, height)
+        self.resize(850, height)
+        self.setMinimumSize(QtCore.QSize(850, height))
+        self.setMaximumSize(QtCore.QSize(850, height))
         self.setStyleSheet("background-color: #c6c6c6;")
 
         # Center window
@@ -131,7 +336,7 @@ class BuddySelection(QWidget):
 
         # Initialize the rest of the GUI
         self.grid_layout_widget = QtWidgets.QWidget(self)
-        self.grid_layout_widget.setGeometry(QtCore.QRect(60, 0, 730, 240))
+        self.grid_layout_widget.setGeometry(QtCore.QRect(60, 0, 730, height))
         self.grid_layout_widget.setObjectName("gridLayoutWidget")
         self.grid_layout = QtWidgets.QGridLayout(self.grid_layout_widget)
         self.grid_layout.setSizeConstraint(QtWidgets.QLayout.SetDefaultConstraint)
@@ -144,121 +349,36 @@ class BuddySelection(QWidget):
         self.frame.setFrameShape(QtWidgets.QFrame.NoFrame)
         self.frame.setFrameShadow(QtWidgets.QFrame.Raised)
         self.frame.setObjectName("frame")
-        self.frame.resize(730, 240)
+        self.frame.resize(730, height)
 
         self.grid_layout_widget_2 = QtWidgets.QWidget(self.frame)
-        self.grid_layout_widget_2.setGeometry(QtCore.QRect(9, 0, 711, 241))
+        self.grid_layout_widget_2.setGeometry(QtCore.QRect(9, 0, 711, height + 1))
         self.grid_layout_widget_2.setObjectName("gridLayoutWidget_2")
         self.grid_layout_2 = QtWidgets.QGridLayout(self.grid_layout_widget_2)
         self.grid_layout_2.setContentsMargins(0, 0, 0, 0)
         self.grid_layout_2.setObjectName("gridLayout_2")
 
-        icon = QtGui.QIcon()
-        icon.addPixmap(QtGui.QPixmap(resource_path("graphics/menu/logo.png")), QtGui.QIcon.Normal, QtGui.QIcon.Off)
-
-        self.john_button = QtWidgets.QPushButton(self.grid_layout_widget_2)
-        self.john_button.setStyleSheet("QPushButton {\n"
-                                      "    border: none;\n"
-                                      "    background-color: #efefef;\n"
-                                      "}\n"
-                                      "\n"
-                                      "QPushButton:checked{\n"
-                                      "    border-top: 2px solid #535353;\n"
-                                      "    border-left: 2px solid #535353;\n"
-                                      "    background-color: #c6c6c6;\n"
-                                      "}")
-        self.john_button.setText("")
-        john_icon = QtGui.QIcon()
-        john_icon.addPixmap(QtGui.QPixmap(resource_path("graphics/menu/john-icon.png")), QtGui.QIcon.Normal,
-                        QtGui.QIcon.Off)
-        self.john_button.setIcon(john_icon)
-        self.john_button.setIconSize(QtCore.QSize(160, 160))
-        self.john_button.setCheckable(True)
-        self.john_button.setChecked(False)
-        self.john_button.setAutoRepeat(False)
-        self.john_button.setFlat(True)
-        self.john_button.setObjectName("johnButton")
-        self.grid_layout_2.addWidget(self.john_button, 0, 0, 1, 1)
-
-        self.rose_button = QtWidgets.QPushButton(self.grid_layout_widget_2)
-        self.rose_button.setStyleSheet("QPushButton {\n"
-                                       "    border: none;\n"
-                                       "    background-color: #efefef;\n"
-                                       "}\n"
-                                       "\n"
-                                       "QPushButton:checked{\n"
-                                       "    border-top: 2px solid #535353;\n"
-                                       "    border-left: 2px solid #535353;\n"
-                                       "    background-color: #c6c6c6;\n"
-                                       "}")
-        self.rose_button.setText("")
-        rose_icon = QtGui.QIcon()
-        rose_icon.addPixmap(QtGui.QPixmap(resource_path("graphics/menu/rose-icon.png")), QtGui.QIcon.Normal,
-                            QtGui.QIcon.Off)
-        self.rose_button.setIcon(rose_icon)
-        self.rose_button.setIconSize(QtCore.QSize(160, 160))
-        self.rose_button.setCheckable(True)
-        self.rose_button.setFlat(True)
-        self.rose_button.setObjectName("roseButton")
-        self.grid_layout_2.addWidget(self.rose_button, 0, 1, 1, 1)
-
-        self.dave_button = QtWidgets.QPushButton(self.grid_layout_widget_2)
-        self.dave_button.setStyleSheet("QPushButton {\n"
-                                      "    border: none;\n"
-                                      "    background-color: #efefef;\n"
-                                      "}\n"
-                                      "\n"
-                                      "QPushButton:checked{\n"
-                                      "    border-top: 2px solid #535353;\n"
-                                      "    border-left: 2px solid #535353;\n"
-                                      "    background-color: #c6c6c6;\n"
-                                      "}")
-        self.dave_button.setText("")
-        dave_icon = QtGui.QIcon()
-        dave_icon.addPixmap(QtGui.QPixmap(resource_path("graphics/menu/dave-icon.png")), QtGui.QIcon.Normal,
-                        QtGui.QIcon.Off)
-        self.dave_button.setIcon(dave_icon)
-        self.dave_button.setIconSize(QtCore.QSize(160, 160))
-        self.dave_button.setCheckable(True)
-        self.dave_button.setFlat(True)
-        self.dave_button.setObjectName("daveButton")
-        self.grid_layout_2.addWidget(self.dave_button, 0, 2, 1, 1)
-
-        self.jade_button = QtWidgets.QPushButton(self.grid_layout_widget_2)
-        self.jade_button.setStyleSheet("QPushButton {\n"
-                                      "    border: none;\n"
-                                      "    background-color: #efefef;\n"
-                                      "}\n"
-                                      "\n"
-                                      "QPushButton:checked{\n"
-                                      "    border-top: 2px solid #535353;\n"
-                                      "    border-left: 2px solid #535353;\n"
-                                      "    background-color: #c6c6c6;\n"
-                                      "}")
-        self.jade_button.setText("")
-        icon3 = QtGui.QIcon()
-        icon3.addPixmap(QtGui.QPixmap(resource_path("graphics/menu/jade-icon.png")), QtGui.QIcon.Normal,
-                        QtGui.QIcon.Off)
-        self.jade_button.setIcon(icon3)
-        self.jade_button.setIconSize(QtCore.QSize(160, 160))
-        self.jade_button.setCheckable(True)
-        self.jade_button.setFlat(True)
-        self.jade_button.setObjectName("jadeButton")
-        self.grid_layout_2.addWidget(self.jade_button, 0, 3, 1, 1)
+        # One button per character pack, COLUMNS to a row, with the icons scaled once and cached
+        # The buddies are only created the first time their button is toggled
+        self.buddies = {}  # Character name -> its button's buddy
+        self.buttons = {}  # Character name -> button
+        ratio = self.desktop.ratio(self.desktop.primary)
+        for position, pack in enumerate(self.packs.values()):
+            button = QtWidgets.QPushButton(self.grid_layout_widget_2)
+            button.setStyleSheet(CHARACTER_BUTTON_STYLE)
+            button.setIcon(QtGui.QIcon(thumbnail(pack, self.ICON_SIZE, ratio, resource_path(THUMBNAIL_DIR))))
+            button.setIconSize(QtCore.QSize(self.ICON_SIZE, self.ICON_SIZE))
+            button.setToolTip(pack.title)
+            button.setCheckable(True)
+            button.setFlat(True)
+            button.setObjectName("%sButton" % pack.name)
+            button.installEventFilter(self)  # Sprites start loading when the mouse is over the button
+            button.toggled.connect(lambda checked, character=pack.name: self.toggle_character(character, checked))
+            self.grid_layout_2.addWidget(button, position // self.COLUMNS, position % self.COLUMNS, 1, 1)
+            self.buttons[pack.name] = button
 
         self.grid_layout.addWidget(self.frame, 0, 0, 1, 1)
 
-        # Instance the available buddies and connect their respective buttons to their spawn function
-        self.john = JohnBuddy()
-        self.rose = RoseBuddy()
-        self.dave = DaveBuddy()
-        self.jade = JadeBuddy()
-
-        self.john_button.toggled.connect(self.spawn_john)
-        self.rose_button.toggled.connect(self.spawn_rose)
-        self.dave_button.toggled.connect(self.spawn_dave)
-        self.jade_button.toggled.connect(self.spawn_jade)
-
     # Override close event for main window
     def closeEvent(self, event):
         if not self.want_to_close:  # Check if window should be minimized to tray or actually closed
@@ -287,172 +407,580 @@ class BuddySelection(QWidget):
     # Actual exit function, in case the program is closed from the system tray
     def exit(self):
         self.want_to_close = True  # Set this variable to True to not override the close event
-        self.worker.stop()  # Stop the thread to check for updates
+        if self.update_checker is not None:
+            self.update_checker.stop()  # Stop the thread to check for updates
+        if self.control is not None:
+            self.control.close()  # Stop taking commands
         self.close()  # Actually close the window
 
-    # Spawn the buddies
-    def spawn_john(self):
-        if self.john_button.isChecked():  # If the button is checked:
-            self.john.init_ui()  # Initialize the buddy's UI
-            self.john.show()  # Show the buddy
-            self.john.end_state()  # Select a random state for the buddy
-            self.active_buddies.append(self.john)  # Append the buddy to the active buddies list
-        else:  # If the button is unchecked
-            self.john.stop()  # Call the buddy's stop function
-            self.john.close()  # Close the buddy's window
-            self.active_buddies.remove(self.john)  # Remove the buddy form the active buddies list
-
-    # Same for the other buddies
-    def spawn_rose(self):
-        if self.rose_button.isChecked():
-            self.rose.init_ui()
-            self.rose.show()
-            self.rose.end_state()
-            self.active_buddies.append(self.rose)
-        else:
-            self.rose.stop()
-            self.rose.close()
-            self.active_buddies.remove(self.rose)
-
-    def spawn_dave(self):
-        if self.dave_button.isChecked():
-            self.dave.init_ui()
-            self.dave.show()
-            self.dave.end_state()
-            self.active_buddies.append(self.dave)
+    # Check the Homestuck^2 feed in the background, and celebrate when it updates
+    # The feed URL defaults to the real feed, another one can be given to test against a local server
+    def start_update_checker(self, url=None, interval=300):
+        from updates import UpdateChecker  # urllib is slow to import, so it's only imported once the window is up
+        self.update_checker = UpdateChecker(resource_path("data/last_update.json"), url, interval, parent=self)
+        self.update_checker.update_found.connect(self.celebrate_update)
+        self.update_checker.start()
+
+    # Let scripts spawn, move and query the buddies through a local socket, see control.py for the protocol
+    def start_control(self, name=None):
+        from control import ControlServer, CONTROL_NAME  # QtNetwork is only loaded when it's used
+        self.control = ControlServer(self, name or CONTROL_NAME, parent=self)
+        return self.control.listen()
+
+    # Simulate crowds on a worker thread or process instead of the scheduler, see simulation.py
+    # Simulated buddies are always drawn on the overlay, and aren't saved, recorded or scripted
+    def start_simulation(self, mode):
+        from crowd import SimulatedCrowd
+        self.simulation = SimulatedCrowd(self, mode, seed=self.seed, parent=self)
+        self.simulation.start()
+        QApplication.instance().aboutToQuit.connect(self.simulation.stop)
+
+        stats.gauge("simulated_buddies", lambda: self.simulation.population)
+        stats.gauge("simulation_step_ms", lambda: round(self.simulation.timing()[0], 3))
+        stats.gauge("simulation_ticks", lambda: self.simulation.timing()[1])
+
+    # Homestuck^2 updated: every active buddy dances, and clicking the notification opens the new pages
+    def celebrate_update(self, update):
+        for buddy in self.active_buddies:
+            buddy.celebrate_update()
+
+        self.update_url = update.get("last_update_first_page_url") or "https://www.homestuck2.com/"
+        self.tray_icon.showMessage("Homestuck^2 updated!",
+                                   "%d new page(s), starting with %s" % (update.get("last_update_page_count", 1),
+                                                                         update.get("last_update_first_page_title", "")),
+                                   QtGui.QIcon(resource_path("graphics/logo-hs2.ico")))
+        self.tray_icon.messageClicked.connect(self.open_update)
+
+    def open_update(self):
+        self.tray_icon.messageClicked.disconnect(self.open_update)
+        import webbrowser
+        webbrowser.open(self.update_url, 2)
+
+    # Show a buddy in its own window, or on the overlay if it's enabled
+    def show_buddy(self, buddy):
+        if self.overlay_enabled:
+            self.overlay_renderer().add(buddy)
         else:
-            self.dave.stop()
-            self.dave.close()
-            self.active_buddies.remove(self.dave)
-
-    def spawn_jade(self):
-        if self.jade_button.isChecked():
-            self.jade.init_ui()
-            self.jade.show()
-            self.jade.end_state()
-            self.active_buddies.append(self.jade)
+            buddy.show()
+        if self.trace is not None:
+            self.trace.record(buddy, SPAWN, list(self.packs).index(buddy.character), buddy in self.crowd)
+            self.trace.record(buddy, PLACE, self.scheduler.model.x[buddy.index], self.scheduler.model.y[buddy.index])
+        buddy.session_changed.connect(self.session_changed)
+        self.session_changed()
+
+    def hide_buddy(self, buddy):
+        if self.overlay_enabled:
+            self.overlay.remove(buddy)
         else:
-            self.jade.stop()
-            self.jade.close()
-            self.active_buddies.remove(self.jade)
+            buddy.close()
+        if self.trace is not None:
+            self.trace.record(buddy, DESPAWN)
+        buddy.session_changed.disconnect(self.session_changed)
+        self.session_changed()
+
+    # Overlay windows, created the first time a buddy is drawn on them
+    def overlay_renderer(self):
+        if self.overlay is None:
+            from overlay import OverlayRenderer
+            self.overlay = OverlayRenderer(self.desktop, self)
+        return self.overlay
+
+    # Save the buddies that are out, where they are and what they're doing, and bring them back on the next launch
+    def enable_session(self, path):
+        self.session = SessionStore(path, self.session_snapshot, parent=self)
+        QApplication.instance().aboutToQuit.connect(self.session.flush)
+
+    def session_changed(self):
+        if self.session is not None:
+            self.session.changed()
+
+    def session_snapshot(self):
+        buddies = []
+        for buddy in self.active_buddies:
+            entry = buddy.session_entry()
+            entry["crowd"] = buddy in self.crowd
+            buddies.append(entry)
+        return {"buddies": buddies}
+
+    # Spawn the buddies of the last session again, crowd instances too unless crowd is False
+    def restore_session(self, crowd=True):
+        session = self.session.load() if self.session is not None else None
+        if session is None:
+            return
+
+        buttons = self.buttons
+        for entry in session.get("buddies", []):
+            try:
+                character = entry["character"]
+                if entry.get("crowd"):
+                    if crowd:
+                        self.spawn(character)[0].restore(entry)
+                elif not buttons[character].isChecked():
+                    buttons[character].setChecked(True)
+                    self.buddies[character].restore(entry)
+            except (KeyError, TypeError, ValueError):
+                continue  # Skip entries from a damaged or hand edited file
+
+    # The buddy stands on its idle frame until the rest of its sprites are decoded in the background
+    def start_buddy(self, buddy):
+        def loaded():
+            # Unless it was despawned or picked up in the meantime
+            if buddy in self.active_buddies and buddy.state == "IDLE":
+                # When it starts goes in the trace, a replay starts it at that time instead
+                if self.trace is None or self.trace.input(buddy, START):
+                    buddy.start()
+
+        self.loader.request(buddy.sprites(), loaded)
+
+    # Sprites are only loaded for characters that are used, starting when the mouse is over their button
+    # so they're often decoded by the time it's clicked
+    def eventFilter(self, watched, event):
+        if event.type() == QtCore.QEvent.Enter:
+            character = watched.objectName()[:-len("Button")]
+            if character in self.packs:
+                self.loader.prefetch(self.packs[character].sprites.values())
+        return False
+
+    # Create a buddy, with its random stream seeded from the selection's seed and its slot in the model
+    def make_buddy(self, character):
+        buddy = HomestuckBuddy(self.scheduler, self.desktop, self.packs[character], scale=self.scale)
+        buddy.rng.seed("%d/%s/%d" % (self.seed, character, buddy.index))
+        buddy.trace = self.trace
+        return buddy
+
+    # Record everything the buddies do to a trace file, to replay it later with start_replay
+    def start_recording(self, path):
+        interactions = self.scheduler.interactions
+        header = {"seed": self.seed, "characters": list(self.packs), "scale": self.scale,
+                  "interactions": interactions.rule if interactions is not None else NO_INTERACTION}
+        self.set_trace(TraceRecorder(path, self.scheduler.now, header))
+        QApplication.instance().aboutToQuit.connect(self.trace.close)
+
+    # Play a recorded trace back, the selection has to be made with the trace's seed and no buddies out yet
+    def start_replay(self, path, fast=False):
+        self.replay = TracePlayer(self, path, fast, parent=self)
+        self.set_trace(self.replay)
+        self.replay.start()
+        return self.replay
+
+    def set_trace(self, trace):
+        self.trace = trace
+        for buddy in self.created_buddies():
+            buddy.trace = trace
+
+    # Spawn count new instances of a character, each with its own state, at random places on the primary monitor
+    # Sprites are shared by every instance, only the window and the slot in the model are per instance
+    def spawn(self, character, count=1):
+        pool = self.crowd_pool.setdefault(character, [])
+        buddies = []
+        for _ in range(count):
+            buddy = pool.pop() if pool else self.make_buddy(character)
+            buddy.init_ui()
+            buddy.scatter(buddy.rng)
+            self.crowd.append(buddy)
+            self.show_buddy(buddy)
+            self.active_buddies.append(buddy)
+            self.start_buddy(buddy)
+            buddies.append(buddy)
+        return buddies
+
+    # Despawn an instance made by spawn(), it's kept around for the next spawn of the same character
+    def despawn(self, buddy):
+        buddy.stop()
+        self.hide_buddy(buddy)
+        self.crowd.remove(buddy)
+        self.active_buddies.remove(buddy)
+        self.crowd_pool[buddy.character].append(buddy)
+
+    # Despawn every instance made by spawn(), or only the ones of one character
+    def despawn_all(self, character=None):
+        for buddy in list(self.crowd):
+            if character is None or buddy.character == character:
+                self.despawn(buddy)
+
+    # Spawn or despawn the buddy of a character button
+    def toggle_character(self, character, checked):
+        buddy = self.buddies.get(character)
+        if checked:  # If the button is checked:
+            if buddy is None:  # Create the buddy the first time it's spawned
+                buddy = self.buddies[character] = self.make_buddy(character)
+            buddy.init_ui()  # Initialize the buddy's UI
+            self.show_buddy(buddy)  # Show the buddy
+            self.active_buddies.append(buddy)  # Append the buddy to the active buddies list
+            self.start_buddy(buddy)  # Select a random state for the buddy once its sprites are loaded
+        else:  # If the button is unchecked
+            buddy.stop()  # Call the buddy's stop function
+            self.hide_buddy(buddy)  # Close the buddy's window
+            self.active_buddies.remove(buddy)  # Remove the buddy form the active buddies list
 
 
 class HomestuckBuddy(QLabel):
-    def __init__(self, *args, **kwargs):
+    SCALES = (0.5, 0.75, 1.0, 1.5, 2.0)  # Sizes offered in the buddy's right click menu
+    window_icon = None
+
+    session_changed = pyqtSignal()  # The user moved or resized the buddy
+
+    def __init__(self, scheduler, desktop, pack, *args, scale=1.0, **kwargs):
         super().__init__(*args, **kwargs)
+        self.scheduler = scheduler  # Shared scheduler that moves the buddy and runs its state changes
+
+        # Shared monitor layout, the buddy walks around on one monitor at a time
+        self.desktop = desktop
+        self.monitor = desktop.primary
+        desktop.changed.connect(self.monitors_changed)
 
-        # Set the respective graphics, default to John
-        self.front_left_sprite = resource_path("graphics/john/john-front-left.png")
-        self.front_right_sprite = resource_path("graphics/john/john-front-right.png")
-        self.front_walk_left_sprite = resource_path("graphics/john/john-front-walk-left.gif")
-        self.front_walk_right_sprite = resource_path("graphics/john/john-front-walk-right.gif")
-        self.dance_sprite = resource_path("graphics/john/john-dance.gif")
-        self.abscond_sprite = resource_path("graphics/john/john-abscond.gif")
-        self.stupid_sprite = resource_path("graphics/john/john-stupid.gif")
+        # The behaviour lives in the scheduler's model, the buddy only renders what its slot says
+        self.model = scheduler.model
+        self.index = scheduler.add(self)
+
+        # Make the buddy window transparent, and disable the task bar icon by setting the flag "Qt.Tool"
+        # Only done once, the window is reused every time the buddy is spawned
+        self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.FramelessWindowHint | Qt.Tool)
+        self.setAttribute(Qt.WA_TranslucentBackground)
+
+        # The icon is only loaded once and shared by every buddy, loading it costs more memory than the buddy
+        if HomestuckBuddy.window_icon is None:
+            HomestuckBuddy.window_icon = QtGui.QIcon(resource_path('graphics/logo.ico'))
+        self.setWindowIcon(HomestuckBuddy.window_icon)
+
+        # Set the character's graphics from its pack: front_left_sprite, dance_sprite...
+        self.character = pack.name
+        self.sprite_paths = list(pack.sprites.values())
+        for sprite, path in pack.sprites.items():
+            setattr(self, sprite + "_sprite", path)
+
+        # States the buddy can pick, from the pack's manifest or the default ones
+        self.behaviour = pack.behaviour
 
         # Create variable to get the current press position when dragging
         self.__press_pos = QPoint()
 
+        # Overlay renderer drawing this buddy, None if the buddy has its own window
+        self.overlay = None
+
+        # False while nobody can see the buddy, its animation and state changes are paused until then
+        self.exposed = True
+
+        # State to go back to once the sprites are loaded, when the buddy is restored from the last session
+        self.resume_state = None
+
+        # Random stream for the buddy's decisions, seeded by the selection, and the trace recording or replaying them
+        self.rng = random.Random()
+        self.trace = None
+
+        # Animation player, frames are shared with every other buddy through the animation cache
+        self.player = AnimationPlayer(self, self)
+        self.player.animation_changed.connect(self.fit_to_sprite)
+
+        # Size of the buddy, frames are scaled once and shared with every buddy of the same size
+        self.scale = scale
+        self.update_scale()
+
+    # State, direction and movement are read from and written to the buddy's slot in the model
+    @property
+    def state(self):
+        return STATE_NAMES[self.model.state[self.index]]
+
+    @state.setter
+    def state(self, state):
+        self.model.state[self.index] = STATES[state]
+
+    @property
+    def previous_state(self):
+        return STATE_NAMES[self.model.previous_state[self.index]]
+
+    @previous_state.setter
+    def previous_state(self, state):
+        self.model.previous_state[self.index] = STATES[state]
+
+    @property
+    def dir_x(self):
+        return self.model.dir_x[self.index]
+
+    @property
+    def dir_y(self):
+        return self.model.dir_y[self.index]
+
+    @property
+    def moving(self):
+        return bool(self.model.moving[self.index])
+
+    @moving.setter
+    def moving(self, moving):
+        self.model.moving[self.index] = moving
+
+    # Position of the buddy, the top left corner of the uncropped sprite files
+    def frame_pos(self):
+        return QPoint(self.model.x[self.index], self.model.y[self.index])
+
+    # Area covered by the visible part of the current animation, where the buddy window goes
+    def sprite_rect(self):
+        animation = self.player.animation
+        return QtCore.QRect(self.frame_pos() + animation.offset, animation.size())
+
+    # Keep the buddy inside its monitor: its actual sprite bounces off that monitor's edges
+    def update_limits(self):
+        animation = self.player.animation
+        sprite = (animation.offset.x(), animation.offset.y(), animation.size().width(), animation.size().height())
+        self.model.set_bounds(self.index, *sprite_limits(self.desktop.monitor(self.monitor), sprite))
+        self.model.set_center(self.index, sprite[0] + sprite[2] // 2, sprite[1] + sprite[3] // 2)
+
+    # Resize the window to the current animation and only let clicks on its visible pixels through
+    def fit_to_sprite(self):
+        self.update_limits()
+
+        if self.overlay is None:
+            self.setGeometry(self.sprite_rect())
+            self.setMask(self.player.animation.mask)
+
+    # The player shows a new frame, the window draws whatever the player has in paintEvent
+    def setPixmap(self, pixmap):
+        if self.overlay is not None:
+            self.overlay.invalidate(self)
+        else:
+            self.update()
+
+    # Only parts of the frame changed, rects are relative to the sprite
+    def update_frame(self, rects):
+        if self.overlay is not None:
+            self.overlay.invalidate(self, rects)
+        else:
+            for rect in rects:
+                self.update(rect)
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.drawPixmap(0, 0, self.player.current_pixmap())
+
+    def move_to(self, x, y):
+        if self.overlay is not None:
+            self.overlay.invalidate(self)
+        else:
+            self.move(QPoint(x, y) + self.player.animation.offset)
+
+    # Pause the buddy while it's hidden or covered, and pick up where it left off once it's visible again
+    def set_exposed(self, exposed):
+        if exposed == self.exposed or not self.scheduler.policy.suspend_hidden:
+            return
+        self.exposed = exposed
+
+        if exposed:
+            self.player.resume()
+            self.scheduler.resume(self)
+        else:
+            self.scheduler.suspend(self)
+            self.player.pause()
+
+    # The window system tells the window, not the widget, when it's covered or uncovered
+    def showEvent(self, event):
+        super().showEvent(event)
+        window = self.windowHandle()
+        if window is not None:
+            window.removeEventFilter(self)
+            window.installEventFilter(self)
+        self.set_exposed(True)
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.set_exposed(False)
+
+    def eventFilter(self, watched, event):
+        if event.type() == QtCore.QEvent.Expose and self.isVisible():
+            self.set_exposed(watched.isExposed())
+        return False
+
+    def set_scale(self, scale):
+        self.scale = scale
+        self.update_scale()
+
+        # Keep the resized buddy inside its monitor
+        if self.player.animation is not None:
+            self.model.drag_to(self.index, self.model.x[self.index], self.model.y[self.index])
+            self.move_to(self.model.x[self.index], self.model.y[self.index])
+        self.session_changed.emit()
+
+    # Use frames scaled for the buddy's size and its monitor's pixel density
+    def update_scale(self):
+        self.player.set_scale(self.scale, self.desktop.ratio(self.monitor))
+
+    def contextMenuEvent(self, event):
+        self.show_menu(event.globalPos())
+
+    # Right click menu to resize the buddy
+    def show_menu(self, pos):
+        menu = QMenu()
+        for scale in self.SCALES:
+            action = menu.addAction("%d%%" % (scale * 100))
+            action.setCheckable(True)
+            action.setChecked(scale == self.scale)
+            action.triggered.connect(lambda checked, scale=scale: self.set_scale(scale))
+        menu.exec_(pos)
+
+    # Another buddy walked into this one, with the dance interaction they both stop and dance
+    def meet(self):
+        if self.state in ("WALK", "IDLE"):
+            self.force_state("DANCE")
+
     # If a new HS^2 update is detected, make the buddy perform their dance action
     def celebrate_update(self):
-        # Stop the current timers
-        self.timer.stop()
-        if self.move_timer is not None:
-            if self.move_timer.isActive():
-                self.move_timer.stop()
+        # Stop the current timers and pick the dance state for the buddy
+        self.force_state("DANCE")
 
-        # Pick the dance state for the buddy
-        self.pick_state("DANCE")
+    # Every sprite the buddy can play
+    def sprites(self):
+        return self.sprite_paths
 
+    # Reset the buddy every time it's spawned
+    # No timers or other objects are created here, so spawning over and over doesn't pile them up
     def init_ui(self):
-        # Make the buddy window transparent, and disable the task bar icon by setting the flag "Qt.Tool"
-        self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.FramelessWindowHint | Qt.Tool)
-        self.setAttribute(Qt.WA_TranslucentBackground)
-
-        self.setWindowIcon(QtGui.QIcon(resource_path('graphics/logo.ico')))
-
-        # Set the starting graphics
-        self.pixmap = QPixmap(self.front_left_sprite)
-        self.setPixmap(self.pixmap)
-
-        # Create the max width and height variables
-        self.max_width = 0
-        self.max_height = 0
-
-        # Loop through all current monitors to get the max width
-        for m in get_monitors():
-            self.max_width += m.width  # Add the current monitor width to the max width variable
-            current_height = m.height  # Get the current monitor height
-            self.max_height = min(current_height, m.height)  # In case monitor heights don't match, use the smallest one
-
-        # Set the state machine
-        self.state_list = ["WALK", "DANCE", "STUPID"]  # The state list
-        self.state = "IDLE"  # Set the current state
-        self.previous_state = self.state  # Set the previous state, variable to avoid repeating actions
-
-        # Set the direction values for moving
-        self.dir_x = -4
-        self.dir_y = 4
-
-        #Create the timers
-        self.timer = QtCore.QTimer(self)
-        self.move_timer = QtCore.QTimer(self)
-        self.change_state_timer = QtCore.QTimer(self)
+        # Reset the buddy's slot in the model: idle and facing left, on the primary monitor
+        self.model.add_at(self.index, 0, 0)
+        self.monitor = self.desktop.primary
+        self.update_scale()
+
+        # Set the starting graphics, centered on the monitor, and fit the window to them
+        self.player.play(self.front_left_sprite)
+        left, top, width, height = self.desktop.monitor(self.monitor)
+        sprite = self.player.animation
+        self.model.place(self.index,
+                         left + (width - sprite.size().width()) // 2 - sprite.offset.x(),
+                         top + (height - sprite.size().height()) // 2 - sprite.offset.y())
+        self.fit_to_sprite()
+
+    # Move the buddy to a random place where it fits on its monitor
+    def scatter(self, rng=random):
+        model = self.model
+        index = self.index
+        model.place(index, rng.randint(model.left[index], max(model.left[index], model.right[index])),
+                    rng.randint(model.top[index], max(model.top[index], model.bottom[index])))
+        self.move_to(model.x[index], model.y[index])
+
+    # Monitors were added, removed or resized: find which one the buddy is on now
+    def monitors_changed(self):
+        if self.player.animation is None:
+            return  # Never spawned
+
+        center = self.sprite_rect().center()
+        monitor = self.desktop.monitor_at(center.x(), center.y())
+        self.monitor = monitor if monitor is not None else self.desktop.primary
+        self.update_scale()
+        self.update_limits()
+
+    # Cancel the pending state change and stop moving
+    def stop_timers(self):
+        self.scheduler.remove(self)
         self.moving = False
-        self.setGeometry(960 - 150, 540 - 128, 650, 400)
 
     # Pick a state instead of randomly choosing one
     def pick_state(self, state):
-        self.state = state
-
-        self.timer.stop()
-        if self.state == "WALK" and not self.moving:
-            self.timer = QtCore.QTimer(self)
-            self.timer.setSingleShot(True)
-            self.timer.timeout.connect(self.walk)
-            self.timer.start(500)
-
-        elif self.state == "DANCE":
-            self.dance()
-        elif self.state == "STUPID":
-            self.timer = QtCore.QTimer(self)
-            self.timer.setSingleShot(True)
-            self.timer.timeout.connect(self.stupid)
-            self.timer.start(20)
-
-        # Set previous state to the current state
-        self.previous_state = self.state
+        spec = self.behaviour.spec(STATES[state])
+
+        # Walking still waits a bit before starting, everything else starts right away
+        state, delay = self.decide(STATE, spec.state, spec.delay(self.rng) if spec.walk else 0)
+        self.enter_state(self.behaviour.spec(state), delay)
+
+    # Drop what the buddy is doing for a state picked from outside its behaviour: another buddy, an update,
+    # a script. While a trace is replayed these only come from the trace
+    # Buddies whose behaviour doesn't have the state, like a pack that doesn't dance, carry on instead
+    def force_state(self, state):
+        if STATES.get(state) not in self.behaviour.specs:
+            return
+        if self.trace is not None and not self.trace.input(self, PICK, STATES[state]):
+            return
+        self.stop_timers()
+        self.pick_state(state)
+
+    # Random picks go through the trace when there is one, which records them or replaces them with recorded ones
+    def decide(self, kind, a, b=0):
+        if self.trace is None:
+            return a, b
+        return self.trace.decide(self, kind, a, b)
+
+    # First state after spawning, the one it had in the last session if it was restored
+    def start(self):
+        state, self.resume_state = self.resume_state, None
+        if state is not None:
+            self.pick_state(state)
+        else:
+            self.end_state()
 
-    # Randomly choose a sate
-    # I could probably use one function for randomly choosing and manually picking a state, I'll figure it out later
+    # Put the buddy back where it was in the last session, with the size, facing and state it had
+    def restore(self, entry):
+        if entry.get("scale", self.scale) != self.scale:
+            self.scale = entry["scale"]
+            self.update_scale()
+
+        # A monitor that isn't there anymore leaves the buddy where it spawned
+        self.teleport(entry["x"], entry["y"])
+
+        if entry.get("dir_x"):
+            self.model.dir_x[self.index] = SPEED if entry["dir_x"] > 0 else -SPEED
+
+        # Only states the behaviour can pick are restored, the buddy picks a new one otherwise
+        state = STATES.get(entry.get("state"))
+        if state in self.behaviour.specs:
+            if self.state == "IDLE":
+                self.resume_state = entry["state"]  # Still waiting for its sprites
+            else:
+                self.stop_timers()
+                self.pick_state(entry["state"])
+        else:
+            self.idle()
+
+    # Move the buddy to a position on any monitor, kept inside that monitor's limits
+    # Returns False and leaves the buddy where it is if the position isn't on a monitor
+    def teleport(self, x, y):
+        monitor = self.desktop.monitor_at(x + self.model.center_x[self.index], y + self.model.center_y[self.index])
+        if monitor is None:
+            return False
+
+        self.monitor = monitor
+        self.update_scale()
+        self.update_limits()
+        self.model.drag_to(self.index, x, y)
+        self.move_to(self.model.x[self.index], self.model.y[self.index])
+        if self.trace is not None:
+            self.trace.record(self, PLACE, self.model.x[self.index], self.model.y[self.index])
+        return True
+
+    # What's saved in the session
+    def session_entry(self):
+        return {
+            "character": self.character,
+            "x": self.model.x[self.index],
+            "y": self.model.y[self.index],
+            "dir_x": self.dir_x,
+            "state": self.state,
+            "scale": self.scale,
+        }
+
+    # Randomly choose a state from the behaviour table
     def end_state(self):
         self.idle()
-        self.state = random.choice(self.state_list)
-
-        self.timer.stop()
-        if self.state == "WALK" and not self.moving:
-            self.timer = QtCore.QTimer(self)
-            self.timer.setSingleShot(True)
-            self.timer.timeout.connect(self.walk)
-            self.timer.start(500)
-
-        # If the chosen state is "Dance" or "Stupid", choose again
-        elif self.state == "DANCE":
-            if self.previous_state == "DANCE":
-                self.end_state()
-                return
-            self.timer = QtCore.QTimer(self)
-            self.timer.setSingleShot(True)
-            self.timer.timeout.connect(self.dance)
-            self.timer.start(random.randint(1, 2) * 1000)
-        elif self.state == "STUPID":
-            if self.previous_state == "STUPID":
-                self.end_state()
-                return
-            self.timer = QtCore.QTimer(self)
-            self.timer.setSingleShot(True)
-            self.timer.timeout.connect(self.stupid)
-            self.timer.start(random.randint(1, 2) * 1000)
+        spec = self.behaviour.next_spec(self.model.previous_state[self.index], self.rng)
+        state, delay = self.decide(STATE, spec.state, spec.delay(self.rng))
+        self.enter_state(self.behaviour.spec(state), delay)
+
+    # Switch to a state and start it after the delay
+    def enter_state(self, spec, delay):
+        if stats.sampled("state_transitions"):
+            start = time.perf_counter()
+            self.switch_state(spec, delay)
+            stats.record("state_transition", (time.perf_counter() - start) * 1000)
+        else:
+            self.switch_state(spec, delay)
+
+    def switch_state(self, spec, delay):
+        self.state = spec.name
+
+        self.scheduler.cancel(self)
+        if spec.walk:
+            if not self.moving:
+                self.scheduler.schedule(self, delay, self.walk)
+        elif delay:
+            self.scheduler.schedule(self, delay, self.perform)
+        else:
+            self.perform()
 
         # Set previous state to the current state
         self.previous_state = self.state
@@ -460,236 +988,317 @@ class HomestuckBuddy(QLabel):
     # Move state
     def walk(self):
         # Select a random direction
-        self.dir_list = [4, -4]
-        self.dir_x = random.choice(self.dir_list)
-        self.dir_y = random.choice(self.dir_list)
+        self.model.start_walk(self.index, self.rng)
+        if self.trace is not None:
+            self.model.dir_x[self.index], self.model.dir_y[self.index] = self.decide(DIRECTION, self.dir_x, self.dir_y)
+        self.play_walk_animation()
+
+        # Stop walking after a while, and move on every scheduler tick until then
+        self.scheduler.schedule(self, self.behaviour.spec(WALK).duration, self.stop_walk)
+        self.scheduler.start_walking(self)
 
-        # Select the correct animation depending on the direction
+    # Select the correct walking animation depending on the direction
+    def play_walk_animation(self):
         if self.dir_x > 0:
-            self.gif = QMovie(self.front_walk_right_sprite)
+            self.player.play(self.front_walk_right_sprite)
         elif self.dir_x < 0:
-            self.gif = QMovie(self.front_walk_left_sprite)
-        self.setMovie(self.gif)
-        self.gif.start()
-
-        # Start the timers for the walk state
-        self.walk_timer = QtCore.QTimer(self)
-        self.walk_timer.setSingleShot(True)
-        self.walk_timer.timeout.connect(self.stop_walk)
-        self.walk_timer.start(2000)
-
-        self.move_timer = QtCore.QTimer(self)
-        self.move_timer.timeout.connect(self.walk_move)
-        self.move_timer.start(20)
-
-    # Move the character
-    def walk_move(self):
-        if self.state == "WALK":
-            self.moving = True
-            self.move(self.pos() + QPoint(self.dir_x, self.dir_y))
-
-            # Bounce off the screen limits
-            # Using magic numbers here, I'll fix it later
-            if self.pos().x() < -250:
-                self.gif = QMovie(self.front_walk_right_sprite)
-                self.setMovie(self.gif)
-                self.gif.start()
-                self.dir_x *= -1
-
-            if self.pos().x() > self.max_width - 400:
-                self.gif = QMovie(self.front_walk_left_sprite)
-                self.setMovie(self.gif)
-                self.gif.start()
-                self.dir_x *= -1
-
-            if self.pos().y() < -150:
-                self.dir_y *= -1
+            self.player.play(self.front_walk_left_sprite)
 
-            if self.pos().y() > self.max_height - 400:
-                self.dir_y *= -1
+    # Move the character to its position in the model, called by the scheduler after the model is stepped
+    def walk_move(self, turned=False):
+        self.move_to(self.model.x[self.index], self.model.y[self.index])
 
-        elif self.state == "DRAG":
-            self.stop_walk()
+        # Turn the animation around if the buddy bounced off the screen limits
+        if turned:
+            self.play_walk_animation()
 
     # Stop moving
     def stop_walk(self):
         self.moving = False
-        self.move_timer.stop()
+        self.scheduler.stop_walking(self)
         if self.state == "WALK":
-            self.gif.stop()
+            self.player.stop()
             self.end_state()
 
-    # THIS IS STUPID state
-    def stupid(self):
-        # Set the "THIS IS STUPID" animation
-        self.loop_count = 0  # Initialize the animation loop count
-        self.gif = QMovie(self.stupid_sprite)
-        self.setMovie(self.gif)
-        self.gif.start()
-
-        self.loop_limit = random.randint(3, 5)  # Randomly choose how many times the animation should loop
-
-        self.gif.updated.connect(self.check_for_anim_finished)  # Check every frame if the animation has finished
-
-    # Dance state
-    def dance(self):
-        # Same thing for the dance animation
-        self.loop_count = 0
+    # Animation states, like dance or "THIS IS STUPID"
+    def perform(self):
+        spec = self.behaviour.spec(self.model.state[self.index])
 
-        self.gif = QMovie(self.dance_sprite)
-        self.setMovie(self.gif)
-        self.gif.start()
+        # Set the state's animation
+        self.player.play(getattr(self, spec.sprite))
+        self.loop_limit = self.decide(LOOPS, spec.loop_limit(self.rng))[0]  # Randomly choose how many times to loop
 
-        self.loop_limit = random.randint(2, 3)
+        # The frame delays are already known, so schedule the end of the last loop once
+        # instead of checking on every frame if the animation has finished
+        self.scheduler.schedule(self, self.loop_limit * self.player.animation.duration(), self.finish_performance)
 
-        self.gif.updated.connect(self.check_for_anim_finished)
-
-    def check_for_anim_finished(self):
-        # Add to the loop count if the animation is finished
-        if self.gif.currentFrameNumber()+1 == self.gif.frameCount():
-            self.loop_count += 1
-
-        # If the loop count is greater than or equal to the loop limit, stop the animation and randomly choose a state
-        if self.loop_count >= self.loop_limit:
-            self.gif.stop()
-            self.end_state()
+    # Stop the animation after its last loop, and randomly choose a state
+    def finish_performance(self):
+        self.player.stop()
+        self.end_state()
 
     # Idle state
     def idle(self):
         # Choose the graphics depending on the direction the character is facing
         if self.dir_x > 0:
-            self.pixmap = QPixmap(self.front_right_sprite)
+            self.player.play(self.front_right_sprite)
         elif self.dir_x < 0:
-            self.pixmap = QPixmap(self.front_left_sprite)
-        self.setPixmap(self.pixmap)
+            self.player.play(self.front_left_sprite)
 
     # Drag state
     def drag(self):
         # Stop timers
-        self.timer.stop()
-        if self.move_timer is not None:
-            if self.move_timer.isActive():
-                self.move_timer.stop()
+        self.stop_timers()
 
         self.state = "DRAG"  # Change state to Drag
 
-        # Set the corresponding animations for the Drag state
-        self.gif = QMovie(self.abscond_sprite)
-        self.setMovie(self.gif)
-        self.gif.start()
+        # Set the corresponding animations for the Drag state, packs without one keep the sprite they're facing
+        self.player.play(getattr(self, "abscond_sprite", None) or
+                         (self.front_right_sprite if self.dir_x > 0 else self.front_left_sprite))
 
     def release_drag(self):
         # Stop the drag animation, and randomly choose a state
-        self.gif.stop()
+        self.player.stop()
         self.idle()
         self.end_state()
 
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
-            # If the left mouse button is pressed over the character, call the drag state
-            self.__press_pos = event.pos()
-            self.drag()
+            self.press(event.globalPos() - self.frame_pos())
 
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.LeftButton:
-            # If the character is released, call the releaseDrag function
-            self.__press_pos = QPoint()
-            self.release_drag()
+            self.release()
 
     def mouseMoveEvent(self, event):
-        if not self.__press_pos.isNull():
-            # Check against screen limits. If it's not colliding, move the character
-            # Using magic numbers here too, I'll fix it later
-            if (not event.globalX() - self.__press_pos.x() < -250
-                    and not event.globalX() - self.__press_pos.x() > self.max_width - 400
-                    and not event.globalY() - self.__press_pos.y() < -150
-                    and not event.globalY() - self.__press_pos.y() > self.max_height - 400):
-               self.move(self.pos() + (event.pos() - self.__press_pos))
-
-    # Stop function called when the character is despawned
-    # Instead of creating a new character object every time, it's just hidden until it's called again
-    def stop(self):
-        self.timer.stop()
-        if self.move_timer is not None:
-            if self.move_timer.isActive():
-                self.move_timer.stop()
-        self.state = "STOP"
-
-
-class JohnBuddy(HomestuckBuddy):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        self.drag_move(event.globalPos())
 
-        # Assign the corresponding graphics
-        self.front_left_sprite = resource_path("graphics/john/john-front-left.png")
-        self.front_right_sprite = resource_path("graphics/john/john-front-right.png")
-        self.front_walk_left_sprite = resource_path("graphics/john/john-front-walk-left.gif")
-        self.front_walk_right_sprite = resource_path("graphics/john/john-front-walk-right.gif")
-        self.dance_sprite = resource_path("graphics/john/john-dance.gif")
-        self.abscond_sprite = resource_path("graphics/john/john-abscond.gif")
-        self.stupid_sprite = resource_path("graphics/john/john-stupid.gif")
+    # Mouse handling, shared by the buddy window and the overlay
+    # The press position is relative to the buddy's position
+    def press(self, pos):
+        if self.trace is not None and not self.trace.input(self, PRESS, pos.x(), pos.y()):
+            return
 
-        self.init_ui()
+        # If the left mouse button is pressed over the character, call the drag state
+        self.__press_pos = pos
+        self.drag()
 
+    def release(self):
+        if self.trace is not None and not self.trace.input(self, RELEASE):
+            return
 
-class RoseBuddy(HomestuckBuddy):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        # If the character is released, call the releaseDrag function
+        self.__press_pos = QPoint()
+        self.release_drag()
+        self.session_changed.emit()
 
-        # Assign the corresponding graphics
-        self.front_left_sprite = resource_path("graphics/rose/rose-front-left.png")
-        self.front_right_sprite = resource_path("graphics/rose/rose-front-right.png")
-        self.front_walk_left_sprite = resource_path("graphics/rose/rose-front-walk-left.gif")
-        self.front_walk_right_sprite = resource_path("graphics/rose/rose-front-walk-right.gif")
-        self.dance_sprite = resource_path("graphics/rose/rose-laptop.gif")
-        self.abscond_sprite = resource_path("graphics/rose/rose-abscond.gif")
-        self.stupid_sprite = resource_path("graphics/rose/rose-facepalm.gif")
+    def drag_move(self, global_pos):
+        if not self.__press_pos.isNull():
+            if self.trace is not None and not self.trace.input(self, DRAG, global_pos.x(), global_pos.y()):
+                return
 
-        self.init_ui()
+            # The buddy moves to whichever monitor the mouse is on
+            monitor = self.desktop.monitor_at(global_pos.x(), global_pos.y())
+            if monitor is not None and monitor != self.monitor:
+                self.monitor = monitor
+                self.update_scale()
+                self.update_limits()
 
+            # Keep the character inside the monitor's limits
+            new_pos = global_pos - self.__press_pos
+            self.model.drag_to(self.index, new_pos.x(), new_pos.y())
+            self.move_to(self.model.x[self.index], self.model.y[self.index])
 
-class DaveBuddy(HomestuckBuddy):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    # Stop function called when the character is despawned
+    # Instead of creating a new character object every time, it's just hidden until it's called again
+    def stop(self):
+        self.stop_timers()
+        self.player.stop()
+        self.__press_pos = QPoint()
+        self.resume_state = None
+        self.state = "STOP"
 
-        # Assign the corresponding graphics
-        self.front_left_sprite = resource_path("graphics/dave/dave-front-left.png")
-        self.front_right_sprite = resource_path("graphics/dave/dave-front-right.png")
-        self.front_walk_left_sprite = resource_path("graphics/dave/dave-front-walk-left.gif")
-        self.front_walk_right_sprite = resource_path("graphics/dave/dave-front-walk-right.gif")
-        self.dance_sprite = resource_path("graphics/dave/dave-jump.gif")
-        self.abscond_sprite = resource_path("graphics/dave/dave-abscond.gif")
-        self.stupid_sprite = resource_path("graphics/dave/dave-roll.gif")
 
-        self.init_ui()
+# CHARACTER=N from the command line, the character is checked once the packs are loaded
+def crowd_argument(value):
+    character, _, count = value.partition("=")
+    character = character.strip().lower()
+    try:
+        count = int(count) if count else 1
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not a number of buddies" % count)
+    return character, count
 
 
-class JadeBuddy(HomestuckBuddy):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+# Quit cleanly on Ctrl+C or a kill, so the session, a trace being recorded and the simulation worker get closed
+# Python only runs signal handlers between bytecodes, which never happens while the event loop waits, so signals
+# also wake the event loop up through a socket
+def quit_on_signals(app):
+    import signal
+    import socket
 
-        # Assign the corresponding graphics
-        self.front_left_sprite = resource_path("graphics/jade/jade-front-left.png")
-        self.front_right_sprite = resource_path("graphics/jade/jade-front-right.png")
-        self.front_walk_left_sprite = resource_path("graphics/jade/jade-front-walk-left.gif")
-        self.front_walk_right_sprite = resource_path("graphics/jade/jade-front-walk-right.gif")
-        self.dance_sprite = resource_path("graphics/jade/jade-bass.gif")
-        self.abscond_sprite = resource_path("graphics/jade/jade-abscond.gif")
-        self.stupid_sprite = resource_path("graphics/jade/jade-sleep.gif")
+    reader, writer = socket.socketpair()
+    reader.setblocking(False)
+    writer.setblocking(False)
+    signal.set_wakeup_fd(writer.fileno())
+    notifier = QtCore.QSocketNotifier(reader.fileno(), QtCore.QSocketNotifier.Read, app)
+    notifier.activated.connect(lambda: reader.recv(64))
+    app.signal_sockets = (reader, writer)  # Closed when garbage collected otherwise
 
-        self.init_ui()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: app.quit())
 
 
 def main():
+    profile = StartupProfile()
+    profile.mark("imports")
+
     random.seed(None)  # Randomize the seed
 
+    parser = argparse.ArgumentParser(description="Homestuck Desktop Buddies")
+    parser.add_argument("--overlay", action="store_true",
+                        help="draw every buddy on one transparent window per monitor")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="print how long each startup phase took once the window is shown, then exit")
+    parser.add_argument("--startup-budget", type=float, metavar="MS",
+                        help="with --startup-profile, exit with an error if startup took longer than this")
+    parser.add_argument("--stats-file", metavar="PATH", help="file to dump the performance stats to as JSON")
+    parser.add_argument("--stats-interval", type=float, default=0, metavar="SECONDS",
+                        help="dump the stats to --stats-file this often")
+    parser.add_argument("--power-policy", choices=sorted(POWER_POLICIES), default="balanced",
+                        help="performance: always full speed, balanced/saver: slower updates when the mouse "
+                             "hasn't moved for a while, and pause buddies nobody can see")
+    parser.add_argument("--idle-interval", type=int, metavar="MS",
+                        help="milliseconds between updates once idle, overrides the power policy")
+    parser.add_argument("--idle-after", type=float, metavar="SECONDS",
+                        help="seconds without mouse movement before slowing down, overrides the power policy")
+    parser.add_argument("--no-bundle", action="store_true",
+                        help="decode every sprite from its file even if the sprite bundle was built")
+    parser.add_argument("--scale", type=float, default=1.0, help="starting size of the buddies, 1 is native size")
+    parser.add_argument("--delta-frames", action="store_true",
+                        help="keep animations as keyframes plus the rectangles that change, and only repaint those. "
+                             "Less frame memory, one extra frame per buddy")
+    parser.add_argument("--frame-cache-mb", type=float, default=128, metavar="MB",
+                        help="memory budget for the frames of resized buddies")
+    parser.add_argument("--crowd", type=crowd_argument, action="append", default=[], metavar="CHARACTER=N",
+                        help="spawn N extra instances of a character (john, rose, dave, jade or any other pack), "
+                             "can be repeated. "
+                             "Use with --overlay for large crowds")
+    parser.add_argument("--simulation", choices=MODES,
+                        help="simulate the --crowd buddies on a worker thread or process and only draw them on the "
+                             "GUI thread, on the overlay. They aren't saved in the session or recorded")
+    parser.add_argument("--interactions", choices=INTERACTIONS, default=BOUNCE,
+                        help="what buddies do when they walk into each other")
+    parser.add_argument("--update-feed", metavar="URL", help="RSS feed checked for new Homestuck^2 pages, "
+                                                             "defaults to the Homestuck^2 feed")
+    parser.add_argument("--update-interval", type=float, default=300, metavar="SECONDS",
+                        help="time between feed checks, longer after errors")
+    parser.add_argument("--no-update-check", action="store_true", help="don't check for Homestuck^2 updates")
+    parser.add_argument("--session-file", metavar="PATH",
+                        help="where the buddies are saved between launches, defaults to data/session.json")
+    parser.add_argument("--no-session", action="store_true",
+                        help="don't bring back the buddies of the last session, or save this one")
+    parser.add_argument("--seed", type=int, help="seed for the buddies' random picks, random by default")
+    parser.add_argument("--record", metavar="PATH",
+                        help="record everything the buddies do to a trace file, starting without the last session")
+    parser.add_argument("--replay", metavar="PATH", help="play a recorded trace back, then exit")
+    parser.add_argument("--replay-fast", action="store_true",
+                        help="with --replay, play the trace as fast as possible instead of in real time")
+    parser.add_argument("--control", nargs="?", const="", metavar="NAME",
+                        help="take commands from tools/control.py on a local socket, "
+                             "named homestuck-buddies unless a name is given")
+    args, qt_args = parser.parse_known_args()
+
+    policy = POWER_POLICIES[args.power_policy]
+    if args.idle_interval is not None or args.idle_after is not None:
+        policy = PowerPolicy(args.idle_interval if args.idle_interval is not None else policy.idle_interval,
+                             args.idle_after if args.idle_after is not None else policy.idle_after,
+                             policy.suspend_hidden)
+
+    # A replay sets the buddies up the way they were when the trace was recorded
+    seed, interactions, scale = args.seed, args.interactions, args.scale
+    if args.replay:
+        try:
+            header = read_header(args.replay)
+        except (OSError, ValueError) as error:
+            parser.error("can't read the trace: %s" % error)
+        seed, interactions, scale = header["seed"], header["interactions"], header["scale"]
+
+    # Installed characters, from the cached pack index unless a pack changed
+    packs = load_packs(resource_path(""))
+    profile.mark("character packs")
+    for character, _ in args.crowd:
+        if character not in packs:
+            parser.error("unknown character %r, choose from %s" % (character, ", ".join(packs)))
+
     # Create the application
-    app = QApplication(sys.argv)
-    w = BuddySelection()
+    app = QApplication(sys.argv[:1] + qt_args)
+    quit_on_signals(app)
+    profile.mark("QApplication")
+
+    # Sprites come from the pre-decoded bundle if tools/build_bundle.py was run, and from their files otherwise
+    if not args.no_bundle:
+        animation_cache.bundle = SpriteBundle.open(resource_path(""))
+        profile.mark("sprite bundle")
+    scaled_cache.set_budget(int(args.frame_cache_mb * 1024 * 1024))
+    animation_cache.delta = args.delta_frames
+    w = BuddySelection(overlay=args.overlay, stats_file=args.stats_file, stats_interval=args.stats_interval,
+                       power_policy=policy, scale=scale, interactions=interactions, seed=seed, packs=packs)
+    profile.mark("selection window")
     w.show()
-
-    return app.exec_()
+    profile.mark("show")
+
+    # The last session comes back once the window is up. Crowd instances only come back without --crowd
+    if not args.no_session and not args.startup_profile and not args.record and not args.replay:
+        w.enable_session(args.session_file or resource_path("data/session.json"))
+        QtCore.QTimer.singleShot(0, lambda: w.restore_session(crowd=not args.crowd))
+
+    # Recording starts before the crowd spawns so the trace has them, a replay spawns what the trace says
+    if args.record:
+        w.start_recording(args.record)
+    if args.replay:
+        replay = w.start_replay(args.replay, args.replay_fast)
+        replay.finished.connect(lambda: (print(replay.summary()), app.quit()))
+    elif args.simulation:
+        w.start_simulation(args.simulation)
+        for character, count in args.crowd:
+            w.simulation.spawn(character, count)
+    else:
+        for character, count in args.crowd:
+            w.spawn(character, count)
+
+    if args.control is not None:
+        try:
+            print("Listening for commands on", w.start_control(args.control))
+        except OSError as error:
+            print(error, file=sys.stderr)
+
+    # Once the window is up, check for updates in the background
+    if not args.no_update_check and not args.startup_profile and not args.replay:
+        QtCore.QTimer.singleShot(0, lambda: w.start_update_checker(args.update_feed, args.update_interval))
+
+    if args.startup_profile:
+        # The first event loop turn is when the window actually gets shown and painted
+        def report():
+            profile.mark("first event loop turn")
+            print(profile.report())
+            over_budget = args.startup_budget is not None and profile.total() * 1000 > args.startup_budget
+            app.exit(1 if over_budget else 0)
+
+        QtCore.QTimer.singleShot(0, report)
+
+    code = app.exec_()
+
+    # Final stats dump, so short runs also leave their stats behind
+    if args.stats_file:
+        w.dump_stats()
+
+    return code
 
 
 if __name__ == '__main__':
+    # The --simulation process worker of a PyInstaller build is this executable started again, which has to run
+    # the worker instead of opening the buddies a second time
+    import multiprocessing
+    multiprocessing.freeze_support()
     sys.exit(main())
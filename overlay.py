@@ -0,0 +1,198 @@
+from PyQt5 import QtCore
+from PyQt5.QtCore import Qt, QRect
+from PyQt5.QtGui import QPainter, QRegion
+from PyQt5.QtWidgets import QWidget
+
+
+# Transparent window covering one monitor, painting every buddy that's on it
+class BuddyOverlay(QWidget):
+    def __init__(self, renderer, monitor, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.renderer = renderer
+
+        # Same window setup as a buddy window: transparent, on top and without a task bar icon
+        self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.FramelessWindowHint | Qt.Tool)
+        self.setAttribute(Qt.WA_TranslucentBackground)
+        self.setGeometry(QRect(*monitor))
+
+        self.grabbed = None  # Buddy being dragged with the mouse
+
+    # The window system tells the window, not the widget, when it's covered or uncovered
+    def showEvent(self, event):
+        super().showEvent(event)
+        window = self.windowHandle()
+        if window is not None:
+            window.removeEventFilter(self)
+            window.installEventFilter(self)
+
+    # Overlays are also hidden when they have nothing to draw, so only exposure changes while shown count
+    def eventFilter(self, watched, event):
+        if event.type() == QtCore.QEvent.Expose and self.isVisible():
+            self.renderer.set_exposed(self, watched.isExposed())
+        return False
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        origin = self.geometry().topLeft()
+        area = event.rect().translated(origin)
+
+        # Layers go below the buddies
+        for layer in self.renderer.layers:
+            layer.paint(painter, area, origin)
+
+        # Only draw the buddies that are inside the repainted area, in order so later buddies are on top
+        for buddy in self.renderer.buddies:
+            rect = self.renderer.rects[buddy]
+            if rect.intersects(area):
+                painter.drawPixmap(rect.topLeft() - origin, buddy.player.current_pixmap())
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.grabbed = self.renderer.buddy_at(event.globalPos())
+            if self.grabbed is not None:
+                self.grabbed.press(event.globalPos() - self.grabbed.frame_pos())
+
+    def mouseMoveEvent(self, event):
+        if self.grabbed is not None:
+            self.grabbed.drag_move(event.globalPos())
+
+    def mouseReleaseEvent(self, event):
+        if event.button() == Qt.LeftButton and self.grabbed is not None:
+            self.grabbed.release()
+            self.grabbed = None
+
+    def contextMenuEvent(self, event):
+        buddy = self.renderer.buddy_at(event.globalPos())
+        if buddy is not None:
+            buddy.show_menu(event.globalPos())
+
+
+# Renders every active buddy on one overlay window per monitor, instead of a window per buddy
+# Only the rectangles that changed are repainted, and the input mask only covers the buddies' pixels
+#
+# Layers draw many buddies that aren't added one by one, like a simulated crowd. A layer has
+# paint(painter, area, origin) with the area in desktop coordinates, mask(geometry) returning its input mask on
+# an overlay in the overlay's coordinates, and buddy_at(pos). It calls repaint and masks_changed itself
+class OverlayRenderer(QtCore.QObject):
+    def __init__(self, desktop, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.buddies = []  # Drawing order, the last buddy is on top
+        self.rects = {}  # Buddy -> sprite rectangle in desktop coordinates, as it was last painted
+        self.layers = []
+
+        # One overlay per monitor, rebuilt when the monitors change
+        self.desktop = desktop
+        self.overlays = []
+        self.create_overlays()
+        desktop.changed.connect(self.create_overlays)
+
+        # Masks are updated once per event loop turn, no matter how many buddies moved
+        self.mask_timer = QtCore.QTimer(self)
+        self.mask_timer.setSingleShot(True)
+        self.mask_timer.timeout.connect(self.update_masks)
+
+    def create_overlays(self):
+        for overlay in self.overlays:
+            overlay.hide()
+            overlay.deleteLater()
+        self.overlays = [BuddyOverlay(self, monitor) for monitor in self.desktop.monitors]
+
+        for rect in self.rects.values():
+            self.repaint(rect)
+
+    def add(self, buddy):
+        if buddy in self.rects:
+            return
+        buddy.overlay = self
+        self.buddies.append(buddy)
+        self.rects[buddy] = buddy.sprite_rect()
+        self.repaint(self.rects[buddy])
+
+    def remove(self, buddy):
+        if buddy not in self.rects:
+            return
+        self.buddies.remove(buddy)
+        self.repaint(self.rects.pop(buddy))
+
+    def add_layer(self, layer):
+        if layer not in self.layers:
+            self.layers.append(layer)
+
+    def remove_layer(self, layer):
+        if layer in self.layers:
+            self.layers.remove(layer)
+            for overlay in self.overlays:
+                overlay.update()
+            self.masks_changed()
+
+    # Called by a buddy when its frame or position changed
+    # areas are the parts of the sprite that changed, when only parts of the frame did and the buddy didn't move
+    def invalidate(self, buddy, areas=None):
+        old_rect = self.rects.get(buddy)
+        if old_rect is None:
+            return
+
+        new_rect = buddy.sprite_rect()
+        self.rects[buddy] = new_rect
+        if areas is not None and new_rect == old_rect:
+            # Same animation in the same place, so the mask can't have changed either
+            for area in areas:
+                self.repaint(area.translated(new_rect.topLeft()), masks=False)
+            return
+        if new_rect != old_rect:
+            self.repaint(old_rect)
+        self.repaint(new_rect)
+
+    def repaint(self, rect, masks=True):
+        for overlay in self.overlays:
+            geometry = overlay.geometry()
+            if rect.intersects(geometry):
+                overlay.update(rect.translated(-geometry.topLeft()))
+        if masks:
+            self.masks_changed()
+
+    # Update the input masks on the next event loop turn
+    def masks_changed(self):
+        self.mask_timer.start(0)
+
+    # Pause or resume the buddies on an overlay that got covered or uncovered
+    def set_exposed(self, overlay, exposed):
+        geometry = overlay.geometry()
+        for buddy, rect in self.rects.items():
+            if rect.intersects(geometry):
+                buddy.set_exposed(exposed)
+
+    # Let clicks outside of the buddies through to the windows below
+    def update_masks(self):
+        for overlay in self.overlays:
+            geometry = overlay.geometry()
+            region = QRegion()
+            for buddy, rect in self.rects.items():
+                if rect.intersects(geometry):
+                    region += buddy.player.animation.mask.translated(rect.topLeft() - geometry.topLeft())
+            for layer in self.layers:
+                region += layer.mask(geometry)
+
+            # An empty mask means no mask at all, so hide the overlay if there's nothing on it
+            if region.isEmpty():
+                overlay.hide()
+            else:
+                overlay.setMask(region)
+                overlay.show()
+
+    # Topmost buddy with a visible pixel at the given desktop position
+    def buddy_at(self, pos):
+        for buddy in reversed(self.buddies):
+            rect = self.rects[buddy]
+            if rect.contains(pos):
+                pixmap = buddy.player.current_pixmap()
+                image = pixmap.toImage()
+                local = (pos - rect.topLeft()) * pixmap.devicePixelRatio()  # HiDPI frames have more pixels
+                if image.valid(local) and image.pixelColor(local).alpha() > 0:
+                    return buddy
+        for layer in reversed(self.layers):
+            buddy = layer.buddy_at(pos)
+            if buddy is not None:
+                return buddy
+        return None
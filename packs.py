@@ -0,0 +1,165 @@
+import os
+import json
+
+from PyQt5.QtCore import Qt, QSize
+from PyQt5.QtGui import QImage, QImageReader, QPixmap
+
+from behaviour import DEFAULT_BEHAVIOUR, parse_behaviour
+from stats import stats
+from storage import write_json_atomic
+
+# Every character is a pack: a directory in PACKS_DIR with a manifest, its sprites and its menu icon
+#
+# character.json:
+# {
+#     "title": "John",                   Shown when hovering its button, defaults to the directory name
+#     "order": 0,                        Position in the selection window, then by name
+#     "icon": "icon.png",                Menu icon, scaled to the button
+#     "sprites": {"front_left": "john-front-left.png", ...}  Sprite name -> file
+#     "behaviour": [{"state": "WALK", ...}, ...]  States it picks, see parse_behaviour, defaults to DEFAULT_BEHAVIOUR
+# }
+#
+# Every pack has the sprites in SPRITES and the ones its behaviour plays. "abscond" is shown while the buddy is
+# dragged, packs without it keep showing the sprite they're facing.
+#
+# Paths are relative to the pack. The directory name is the character's name, used on the command line,
+# in the session file and by the control socket
+PACKS_DIR = "graphics"
+MANIFEST = "character.json"
+INDEX_FILE = "data/packs.json"
+THUMBNAIL_DIR = "data/thumbnails"
+INDEX_VERSION = 2
+
+# Sprites every pack has. Each sprite of a pack becomes the buddy's <name>_sprite attribute
+SPRITES = ("front_left", "front_right", "front_walk_left", "front_walk_right")
+
+
+class CharacterPack:
+    def __init__(self, name, title, icon, sprites, order=0, behaviour=DEFAULT_BEHAVIOUR):
+        self.name = name
+        self.title = title
+        self.icon = icon  # Absolute paths from here on
+        self.sprites = sprites  # Sprite name -> path
+        self.order = order
+        self.behaviour = behaviour
+
+
+# Read one manifest, paths in the result are relative to root
+def read_manifest(root, name):
+    directory = os.path.join(PACKS_DIR, name)
+    with open(os.path.join(root, directory, MANIFEST)) as file:
+        manifest = json.load(file)
+
+    sprites = manifest["sprites"]
+    if not isinstance(sprites, dict):
+        raise ValueError("%s: sprites has to map sprite names to files" % name)
+    table = manifest.get("behaviour")
+    behaviour = parse_behaviour(table) if table is not None else DEFAULT_BEHAVIOUR
+    missing = [sprite for sprite in SPRITES + tuple(behaviour.sprites()) if sprite not in sprites]
+    if missing:
+        raise ValueError("%s has no %s sprite" % (name, ", ".join(missing)))
+    return {
+        "name": name,
+        "title": manifest.get("title", name.capitalize()),
+        "order": manifest.get("order", 0),
+        "icon": os.path.join(directory, manifest["icon"]).replace(os.sep, "/"),
+        "sprites": {sprite: os.path.join(directory, path).replace(os.sep, "/") for sprite, path in sprites.items()},
+        "behaviour": table,
+    }
+
+
+# What the index was built from: the name, size and mtime of every manifest
+# Only stats the manifests, so checking it costs a lot less than reading them
+def pack_signature(root):
+    signature = []
+    try:
+        entries = list(os.scandir(os.path.join(root, PACKS_DIR)))
+    except OSError:
+        return signature
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        try:
+            manifest = os.stat(os.path.join(entry.path, MANIFEST))
+        except OSError:
+            continue  # Not a pack, like the menu graphics
+        signature.append([entry.name, manifest.st_size, manifest.st_mtime_ns])
+    return sorted(signature)
+
+
+# Read every manifest, skipping the broken ones
+def scan_packs(root, signature=None):
+    packs = []
+    for name, _, _ in signature if signature is not None else pack_signature(root):
+        try:
+            packs.append(read_manifest(root, name))
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print("Skipping character pack %s: %r" % (name, error))
+    return sorted(packs, key=lambda pack: (pack["order"], pack["name"]))
+
+
+# Installed packs by name, in selection window order
+# The manifests are only read again when a pack was added, removed or changed since the index was saved
+def load_packs(root, index_path=None):
+    index_path = index_path or os.path.join(root, INDEX_FILE)
+    signature = pack_signature(root)
+    try:
+        with open(index_path) as file:
+            index = json.load(file)
+        if index.get("version") != INDEX_VERSION or index.get("signature") != signature:
+            index = None
+    except (OSError, ValueError, AttributeError):
+        index = None
+
+    if index is None:
+        stats.count("pack_index_rebuilds")
+        index = {"version": INDEX_VERSION, "signature": signature, "packs": scan_packs(root, signature)}
+        try:
+            write_json_atomic(index_path, index)
+        except OSError:
+            pass  # Read only install, the manifests are read on every start instead
+
+    packs = {}
+    for entry in index["packs"]:
+        packs[entry["name"]] = CharacterPack(
+            entry["name"], entry["title"], os.path.join(root, entry["icon"]),
+            {sprite: os.path.join(root, path) for sprite, path in entry["sprites"].items()}, entry["order"],
+            parse_behaviour(entry["behaviour"]) if entry["behaviour"] is not None else DEFAULT_BEHAVIOUR)
+    return packs
+
+
+# Menu icon of a pack at the size of its button, in device pixels
+# Icons that aren't already that size are scaled once and the result is kept in cache_dir, so big icons
+# aren't decoded and scaled on every start
+def thumbnail(pack, size, ratio=1.0, cache_dir=None):
+    pixels = QSize(round(size * ratio), round(size * ratio))
+    reader = QImageReader(pack.icon)  # Only reads the header until read() is called
+
+    cached = None
+    if reader.size() != pixels and cache_dir is not None:
+        cached = os.path.join(cache_dir, "%s-%d.png" % (pack.name, pixels.width()))
+        try:
+            fresh = os.stat(cached).st_mtime_ns >= os.stat(pack.icon).st_mtime_ns
+        except OSError:
+            fresh = False
+        image = QImage(cached) if fresh else QImage()
+        if not image.isNull():
+            return device_pixmap(image, ratio)
+
+    image = reader.read()
+    if not image.isNull() and image.size() != pixels:
+        stats.count("thumbnails_scaled")
+        image = image.scaled(pixels, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        if cached is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                image.save(cached, "PNG")
+            except OSError:
+                pass
+    return device_pixmap(image, ratio)
+
+
+def device_pixmap(image, ratio):
+    pixmap = QPixmap.fromImage(image)
+    pixmap.setDevicePixelRatio(ratio)
+    return pixmap
@@ -0,0 +1,304 @@
+import json
+import time
+import struct
+from collections import deque
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import QPoint, pyqtSignal
+
+from behaviour import STATE_NAMES, STATES
+from scheduler import VirtualClock
+from stats import stats
+
+# A trace of everything a run of the buddies did, to play the same run back later
+#
+# Layout: MAGIC, little endian uint32 length of the JSON header, the header, then fixed size events
+# The header has the seed of the buddies' random streams, the settings that change their behaviour, and the
+# names of the characters and states the events refer to by number
+# Events are: milliseconds since the start, buddy slot, kind, and two 32 bit arguments that depend on the kind
+MAGIC = b"HSTRACE3"
+HEADER = struct.Struct("<8sI")
+EVENT = struct.Struct("<IHBii")
+
+# Input: things that happen to a buddy, replayed at the time they were recorded
+SPAWN = 1  # Character, 1 for a crowd instance
+DESPAWN = 2
+PLACE = 3  # x, y
+PICK = 4  # State forced from outside the behaviour
+PRESS = 5  # x, y of the mouse relative to the buddy
+DRAG = 6  # x, y of the mouse on the desktop
+RELEASE = 7
+END = 8  # When the recording stopped
+START = 9  # Its sprites were loaded and it picked its first state, which depends on how long decoding took
+
+# Decisions: what a buddy randomly picked, replayed in order whenever the buddy picks again
+STATE = 16  # State, delay before it starts
+DIRECTION = 17  # Walking direction x, y
+LOOPS = 18  # Times the animation loops
+
+INPUTS = {SPAWN, DESPAWN, PLACE, PICK, PRESS, DRAG, RELEASE, END, START}
+
+
+def parse_header(data, path):
+    try:
+        magic, length = HEADER.unpack_from(data, 0)
+    except struct.error:
+        magic = length = None
+    if magic != MAGIC:
+        raise ValueError("%s is not a buddy trace" % path)
+    return json.loads(data[HEADER.size:HEADER.size + length].decode("utf-8")), HEADER.size + length
+
+
+# Header of a trace, to set the buddies up the way they were recorded before replaying it
+def read_header(path):
+    with open(path, "rb") as file:
+        data = file.read(HEADER.size)
+        if len(data) == HEADER.size:
+            data += file.read(HEADER.unpack_from(data, 0)[1])
+    return parse_header(data, path)[0]
+
+
+def read_trace(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    header, start = parse_header(data, path)
+    end = start + (len(data) - start) // EVENT.size * EVENT.size  # A crash can leave half an event at the end
+    return header, list(EVENT.iter_unpack(data[start:end]))
+
+
+# Writes a trace while the buddies run
+# Events are packed into a buffer and written in big chunks, so recording costs no I/O per event. The buffer is
+# also written every second, so a run that gets killed still leaves a trace that can be replayed up to there
+class TraceRecorder:
+    FLUSH_SIZE = 64 * 1024
+    FLUSH_INTERVAL = 1000  # Milliseconds
+
+    def __init__(self, path, clock, header):
+        self.clock = clock  # Function returning the time in milliseconds
+        self.start = clock()
+        self.buffer = bytearray()
+        self.events = 0
+
+        header = dict(header, states=STATE_NAMES)
+        header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, len(header)))
+        self.file.write(header)
+        self.file.flush()
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(self.FLUSH_INTERVAL)
+
+    def record(self, buddy, kind, a=0, b=0):
+        self.buffer += EVENT.pack(self.clock() - self.start, buddy.index, kind, a, b)
+        self.events += 1
+        stats.count("trace_events")
+        if len(self.buffer) >= self.FLUSH_SIZE:
+            self.flush()
+
+    # Input from the user or a script, always goes through while recording
+    def input(self, buddy, kind, a=0, b=0):
+        self.record(buddy, kind, a, b)
+        return True
+
+    def decide(self, buddy, kind, a, b=0):
+        self.record(buddy, kind, a, b)
+        return a, b
+
+    def flush(self):
+        if self.file is not None and self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer.clear()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.timer.stop()
+        self.buffer += EVENT.pack(self.clock() - self.start, 0, END, 0, 0)
+        self.flush()
+        self.file.close()
+        self.file = None
+
+
+# Plays a trace back on the buddies of a selection
+# Inputs are applied at the time they were recorded, and every random pick of a buddy is replaced by the one it
+# made in the recording. The buddies only take input from the trace while it plays, the mouse can't drag them
+# A pick that doesn't match the recording, like a buddy deciding at a slightly different moment than it did, falls
+# back to the buddy's own random stream, which has the recorded seed, and is counted as a divergence
+#
+# At normal speed the trace takes as long as the recording did. Fast replays drive the scheduler on a virtual
+# clock instead, jumping straight to the next thing that happens, with the event loop run once per step
+class TracePlayer(QtCore.QObject):
+    finished = pyqtSignal()
+
+    def __init__(self, selection, path, fast=False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.selection = selection
+        self.fast = fast
+        self.header, events = read_trace(path)
+
+        # Events refer to characters and states by number, the numbers of this build may be different
+        characters = self.header["characters"]
+        states = [STATES.get(name) for name in self.header["states"]]
+
+        self.inputs = []  # (time, recorded slot, kind, a, b) in order
+        self.recorded = {}  # Recorded slot -> deque of its decisions
+        for time_ms, index, kind, a, b in events:
+            if kind in (PICK, STATE):
+                a = states[a]
+            if kind == SPAWN:
+                a = characters[a] if 0 <= a < len(characters) else None
+            if kind in INPUTS:
+                self.inputs.append((time_ms, index, kind, a, b))
+            else:
+                self.recorded.setdefault(index, deque()).append((kind, a, b))
+
+        # A recording that was killed has no END, it plays up to the last event that got written
+        if events and events[-1][2] != END:
+            self.inputs.append((events[-1][0], 0, END, 0, 0))
+
+        self.buddies = {}  # Recorded slot -> buddy playing it
+        self.decisions = {}  # Buddy -> deque of its recorded decisions
+        self.position = 0
+        self.applying = None  # Event being applied, the buddies only take input from it
+        self.divergences = 0
+        self.base = 0
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.apply_due)
+
+    def duration(self):
+        return self.inputs[-1][0] if self.inputs else 0
+
+    def start(self):
+        self.wall_start = time.perf_counter()
+        if self.fast:
+            QtCore.QTimer.singleShot(0, self.run_fast)
+        else:
+            self.base = self.selection.scheduler.now()
+            self.apply_due()
+
+    # Apply the inputs that are due, and wait for the next one
+    def apply_due(self):
+        now = self.selection.scheduler.now() - self.base
+        while self.position < len(self.inputs) and self.inputs[self.position][0] <= now:
+            self.apply(self.inputs[self.position])
+            self.position += 1
+
+        if self.position < len(self.inputs):
+            if not self.fast:
+                self.timer.start(max(0, self.inputs[self.position][0] - now))
+        else:
+            self.finish()
+
+    def run_fast(self):
+        scheduler = self.selection.scheduler
+        clock = scheduler.clock = VirtualClock(scheduler.now())
+        scheduler.last_tick = scheduler.last_activity = scheduler.last_activity_check = clock.now
+        self.base = clock.now
+        app = QtCore.QCoreApplication.instance()
+
+        while self.position < len(self.inputs):
+            # Jump to whatever comes first: the next input, deadline, or movement step
+            due = self.base + self.inputs[self.position][0]
+            if scheduler.deadlines:
+                due = min(due, scheduler.deadlines[0][0])
+            if scheduler.walkers:
+                due = min(due, scheduler.last_tick + scheduler.TICK_INTERVAL)
+            clock.now = max(clock.now, due)
+
+            # Inputs go first, buddies that met were recorded before the deadlines of the same tick ran
+            self.apply_due()
+            if scheduler.walkers:
+                scheduler.tick()
+            else:
+                scheduler.run_deadlines()
+            app.processEvents()
+
+    def apply(self, event):
+        time_ms, index, kind, a, b = event
+        selection = self.selection
+        self.applying = event
+        try:
+            if kind == SPAWN:
+                if a not in selection.packs:
+                    self.divergences += 1  # Recorded with a character pack that isn't installed
+                elif b:
+                    selection.spawn(a)
+                else:
+                    selection.buttons[a].setChecked(True)
+                return
+            if kind == END:
+                return
+
+            buddy = self.buddies.get(index)
+            if buddy is None:
+                self.divergences += 1  # Input for a buddy that isn't out
+                return
+            if kind == DESPAWN:
+                if buddy in selection.crowd:
+                    selection.despawn(buddy)
+                else:
+                    selection.buttons[buddy.character].setChecked(False)
+            elif kind == START:
+                # The loader may not be done when replaying faster, or without the sprite bundle it was recorded
+                # with, so the sprites are decoded on the spot. Its own start once they're loaded is ignored
+                for path in buddy.sprites():
+                    selection.loader.cache.get(path)
+                if buddy.state == "IDLE":
+                    buddy.start()
+            elif kind == PLACE:
+                buddy.teleport(a, b)
+            elif kind == PICK:
+                if a not in buddy.behaviour.specs:
+                    self.divergences += 1  # Recorded with a state its behaviour doesn't have in this build
+                else:
+                    buddy.force_state(STATE_NAMES[a])
+            elif kind == PRESS:
+                buddy.press(QPoint(a, b))
+            elif kind == DRAG:
+                buddy.drag_move(QPoint(a, b))
+            elif kind == RELEASE:
+                buddy.release()
+        finally:
+            self.applying = None
+
+    # The selection tells the trace about spawns, which is when a buddy takes over its recorded slot
+    def record(self, buddy, kind, a=0, b=0):
+        if kind == SPAWN and self.applying is not None and self.applying[2] == SPAWN:
+            index = self.applying[1]
+            self.buddies[index] = buddy
+            self.decisions[buddy] = self.recorded.setdefault(index, deque())
+
+    def input(self, buddy, kind, a=0, b=0):
+        return self.applying is not None
+
+    def decide(self, buddy, kind, a, b=0):
+        decisions = self.decisions.get(buddy)
+        if decisions and decisions[0][0] == kind:
+            if kind == STATE and decisions[0][1] not in buddy.behaviour.specs:
+                # Recorded with a state its behaviour doesn't have in this build, None if no behaviour has it
+                decisions.popleft()
+                self.divergences += 1
+                stats.count("replay_divergences")
+                return a, b
+            _, a, b = decisions.popleft()
+            stats.count("replay_decisions")
+        elif self.selection.scheduler.now() - self.base < self.duration() - self.selection.scheduler.TICK_INTERVAL:
+            self.divergences += 1
+            stats.count("replay_divergences")
+        # Picks due within a tick of the recording stopping may not have run yet when it stopped, so they're
+        # missing from the trace rather than diverging
+        return a, b
+
+    def finish(self):
+        self.timer.stop()
+        self.wall_time = time.perf_counter() - self.wall_start
+        self.finished.emit()
+
+    def summary(self):
+        return ("Replayed %.1f s of buddies in %.1f s (%d inputs, %d divergences)"
+                % (self.duration() / 1000, self.wall_time, len(self.inputs), self.divergences))
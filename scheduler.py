@@ -0,0 +1,281 @@
+import time
+import heapq
+import itertools
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QCursor
+
+from buddy_model import BuddyModel
+from spatial import DANCE, NO_INTERACTION, Interactions, SpatialGrid
+from stats import stats
+
+
+# How hard the scheduler tries to save power
+# idle_interval: milliseconds between ticks once the user has been idle for idle_after seconds
+# The buddies still walk at the same speed, just in bigger and less frequent steps
+# suspend_hidden: pause the animation and movement of buddies nobody can see
+class PowerPolicy:
+    def __init__(self, idle_interval=20, idle_after=0, suspend_hidden=False):
+        self.idle_interval = idle_interval
+        self.idle_after = idle_after
+        self.suspend_hidden = suspend_hidden
+
+
+POWER_POLICIES = {
+    "performance": PowerPolicy(),
+    "balanced": PowerPolicy(idle_interval=60, idle_after=120, suspend_hidden=True),
+    "saver": PowerPolicy(idle_interval=100, idle_after=30, suspend_hidden=True),
+}
+
+
+# Stands in for the scheduler's QElapsedTimer when time is moved by hand, like in fast replays
+class VirtualClock:
+    def __init__(self, now=0):
+        self.now = now
+
+    def elapsed(self):
+        return self.now
+
+
+# Central clock for every buddy
+# Walking buddies are moved in one pass on a shared fixed timestep tick, and state changes are kept as
+# deadlines in a priority queue, so N buddies cost one wakeup per frame instead of N timers
+class BuddyScheduler(QtCore.QObject):
+    TICK_INTERVAL = 20  # Milliseconds per movement step, same speed as the old per-buddy move timer
+    MAX_CATCH_UP = 5  # Max steps to run in one tick if the event loop was blocked for a while
+    ACTIVITY_CHECK = 1000  # Milliseconds between checks for mouse movement
+
+    def __init__(self, *args, policy=None, interactions=NO_INTERACTION, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.policy = policy if policy is not None else POWER_POLICIES["balanced"]
+
+        self.model = BuddyModel()  # Positions, directions and states of every buddy
+        self.buddies = {}  # Slot index in the model -> buddy
+        self.walkers = []  # Buddies that are currently walking
+        self.deadlines = []  # Heap of (due time, sequence number, buddy, callback)
+        self.pending = {}  # Buddy -> sequence number of its only valid deadline, older entries are ignored
+        self.callbacks = {}  # Buddy -> (due time, callback) of its valid deadline
+        self.suspended = {}  # Hidden buddy -> [time left on its deadline, callback, walking]
+        self.sequence = itertools.count()
+
+        # What buddies do when they meet, found through a spatial grid of the buddies' positions
+        self.interactions = None
+        if interactions != NO_INTERACTION:
+            self.model.grid = SpatialGrid()
+            self.interactions = Interactions(self.model, interactions)
+
+        self.clock = QtCore.QElapsedTimer()
+        self.clock.start()
+        self.last_tick = 0
+        self.lag = 0
+
+        # Movement tick, only running while someone is walking
+        self.tick_timer = QtCore.QTimer(self)
+        self.tick_timer.setTimerType(Qt.PreciseTimer)
+        self.tick_timer.timeout.connect(self.tick)
+
+        # Deadline timer, only used while nobody is walking. Otherwise deadlines are checked on each tick
+        self.deadline_timer = QtCore.QTimer(self)
+        self.deadline_timer.setSingleShot(True)
+        self.deadline_timer.timeout.connect(self.run_deadlines)
+
+        self.wakeups = 0
+        self.last_rate = (0, 0)  # Wakeups and time of the last wakeup_rate call
+
+        # Mouse position, to tell if the user is idle
+        self.last_cursor = None
+        self.last_activity = 0
+        self.last_activity_check = 0
+
+    def now(self):
+        return self.clock.elapsed()
+
+    # Give a new buddy its slot in the model
+    def add(self, buddy):
+        index = self.model.add()
+        self.buddies[index] = buddy
+        return index
+
+    # Call the callback after the delay in milliseconds, replacing any state deadline the buddy already had
+    def schedule(self, buddy, delay, callback):
+        # Suspended buddies keep the deadline until they're visible again
+        if buddy in self.suspended:
+            self.suspended[buddy][:2] = [delay, callback]
+            return
+
+        self.cancel(buddy)
+        seq = next(self.sequence)
+        due = self.now() + delay
+        self.pending[buddy] = seq
+        self.callbacks[buddy] = (due, callback)
+        heapq.heappush(self.deadlines, (due, seq, buddy, callback))
+        self.rearm()
+
+    def cancel(self, buddy):
+        self.pending.pop(buddy, None)
+        self.callbacks.pop(buddy, None)
+        if buddy in self.suspended:
+            self.suspended[buddy][:2] = [None, None]
+
+        # Cancelled deadlines stay in the heap until they're due, rebuild it if they start piling up
+        if len(self.deadlines) > 2 * len(self.pending) + 16:
+            self.deadlines = [entry for entry in self.deadlines if self.pending.get(entry[2]) == entry[1]]
+            heapq.heapify(self.deadlines)
+
+    def start_walking(self, buddy):
+        if buddy in self.suspended:
+            self.suspended[buddy][2] = True
+            return
+        if buddy in self.walkers:
+            return
+        self.walkers.append(buddy)
+        if not self.tick_timer.isActive():
+            self.last_tick = self.now()
+            self.lag = 0
+            self.last_activity = self.last_activity_check = self.last_tick
+            self.tick_timer.start(self.TICK_INTERVAL)
+        self.rearm()
+
+    def stop_walking(self, buddy):
+        if buddy in self.suspended:
+            self.suspended[buddy][2] = False
+        if buddy in self.walkers:
+            self.walkers.remove(buddy)
+        if not self.walkers:
+            self.tick_timer.stop()
+        self.rearm()
+
+    # Forget everything about a buddy, used when it's despawned
+    def remove(self, buddy):
+        self.cancel(buddy)
+        self.stop_walking(buddy)
+
+    # Freeze a buddy's deadline and movement while it's hidden, so it picks up where it left off
+    def suspend(self, buddy):
+        if buddy in self.suspended:
+            return
+
+        due, callback = self.callbacks.get(buddy, (None, None))
+        walking = buddy in self.walkers
+        self.cancel(buddy)
+        self.stop_walking(buddy)
+        if walking:
+            self.model.stop_walk(buddy.index)
+
+        remaining = max(due - self.now(), 0) if due is not None else None
+        self.suspended[buddy] = [remaining, callback, walking]
+
+    def resume(self, buddy):
+        if buddy not in self.suspended:
+            return
+
+        remaining, callback, walking = self.suspended.pop(buddy)
+        if callback is not None:
+            self.schedule(buddy, remaining, callback)
+        if walking:
+            self.model.moving[buddy.index] = 1
+            self.start_walking(buddy)
+
+    # Wakeups per second since the last call
+    def wakeup_rate(self):
+        wakeups, then = self.last_rate
+        now = self.now()
+        self.last_rate = (self.wakeups, now)
+        if now == then:
+            return 0.0
+        return (self.wakeups - wakeups) * 1000.0 / (now - then)
+
+    # Slow the tick down once the mouse hasn't moved for a while, and speed it back up when it does
+    def adapt_tick_rate(self, now):
+        if self.policy.idle_interval <= self.TICK_INTERVAL or now - self.last_activity_check < self.ACTIVITY_CHECK:
+            return
+        self.last_activity_check = now
+
+        cursor = QCursor.pos()
+        if cursor != self.last_cursor:
+            self.last_cursor = cursor
+            self.last_activity = now
+
+        idle = now - self.last_activity >= self.policy.idle_after * 1000
+        interval = self.policy.idle_interval if idle else self.TICK_INTERVAL
+        if self.tick_timer.interval() != interval:
+            self.tick_timer.setInterval(interval)
+
+    def tick(self):
+        self.wakeups += 1
+        now = self.now()
+        stats.record("tick_interval", now - self.last_tick)  # Should stay close to TICK_INTERVAL
+        self.lag += now - self.last_tick
+        self.last_tick = now
+
+        # Run as many fixed steps as the elapsed time needs, so speed doesn't depend on timer jitter
+        # or on the tick rate
+        max_steps = max(self.MAX_CATCH_UP, 2 * self.tick_timer.interval() // self.TICK_INTERVAL)
+        steps = self.lag // self.TICK_INTERVAL
+        if steps > max_steps:
+            steps = max_steps
+            self.lag %= self.TICK_INTERVAL  # Drop the backlog instead of teleporting the buddies
+        else:
+            self.lag -= steps * self.TICK_INTERVAL
+
+        self.advance(steps)
+        self.run_deadlines(count_wakeup=False)
+        self.adapt_tick_rate(now)
+
+    # Step the model for every walker at once, then move the windows to where the model says
+    def advance(self, steps=1):
+        if not steps:
+            return
+        if stats.sampled("movement_steps"):
+            start = time.perf_counter()
+            self.move_walkers(steps)
+            stats.record("movement_step", (time.perf_counter() - start) * 1000)
+        else:
+            self.move_walkers(steps)
+
+    def move_walkers(self, steps):
+        turned = set()
+        indices = [buddy.index for buddy in self.walkers]
+        for _ in range(steps):
+            turned ^= self.model.step_walking(indices)
+
+        met = ()
+        if self.interactions is not None and steps:
+            met, bounced = self.interactions.update(indices)
+            turned ^= bounced
+
+        for buddy in self.walkers:
+            buddy.walk_move(buddy.index in turned)
+
+        # Meeting changes what the buddies do, so it waits until every walker moved
+        if self.interactions is not None and self.interactions.rule == DANCE:
+            for pair in met:
+                for index in pair:
+                    self.buddies[index].meet()
+
+    def run_deadlines(self, count_wakeup=True):
+        if count_wakeup:
+            self.wakeups += 1
+
+        now = self.now()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            due, seq, buddy, callback = heapq.heappop(self.deadlines)
+            if self.pending.get(buddy) != seq:
+                continue  # Cancelled or replaced
+            del self.pending[buddy]
+            del self.callbacks[buddy]
+            callback()
+
+        self.rearm()
+
+    # Drop cancelled deadlines at the top of the heap, and arm the deadline timer for the next one if needed
+    def rearm(self):
+        while self.deadlines and self.pending.get(self.deadlines[0][2]) != self.deadlines[0][1]:
+            heapq.heappop(self.deadlines)
+
+        if self.tick_timer.isActive() or not self.deadlines:
+            self.deadline_timer.stop()
+            return
+
+        self.deadline_timer.start(max(self.deadlines[0][0] - self.now(), 0))
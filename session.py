@@ -0,0 +1,76 @@
+import json
+
+from PyQt5 import QtCore
+
+from storage import write_json_atomic
+
+SESSION_VERSION = 1
+
+
+# Writes one snapshot on the writer thread
+class WriteTask(QtCore.QRunnable):
+    def __init__(self, path, snapshot):
+        super().__init__()
+        self.path = path
+        self.snapshot = snapshot
+
+    def run(self):
+        try:
+            write_json_atomic(self.path, self.snapshot)
+        except OSError:
+            pass  # Not being able to save the session isn't worth crashing over, the next save tries again
+
+
+# Saves the buddies' session: which buddies are out, where they are and what they're doing
+# Changes are coalesced: a save happens DELAY after the last change, and at most MAX_DELAY after the first one,
+# so a burst of changes is one write. The snapshot is taken on the GUI thread, which is just reading the model,
+# and written to disk on a writer thread, one write at a time and in order
+class SessionStore(QtCore.QObject):
+    DELAY = 1000  # Milliseconds
+    MAX_DELAY = 10000
+
+    def __init__(self, path, snapshot, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self.snapshot = snapshot  # Function returning the session to save
+        self.writes = 0
+
+        self.clock = QtCore.QElapsedTimer()
+        self.clock.start()
+        self.first_change = None  # Time of the first change that wasn't saved yet
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.save)
+
+        self.writer = QtCore.QThreadPool(self)
+        self.writer.setMaxThreadCount(1)
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                session = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(session, dict) or session.get("version") != SESSION_VERSION:
+            return None
+        return session
+
+    def changed(self):
+        now = self.clock.elapsed()
+        if self.first_change is None:
+            self.first_change = now
+        self.timer.start(max(0, min(self.DELAY, self.first_change + self.MAX_DELAY - now)))
+
+    def save(self):
+        self.timer.stop()
+        self.first_change = None
+        snapshot = self.snapshot()
+        snapshot["version"] = SESSION_VERSION
+        self.writes += 1
+        self.writer.start(WriteTask(self.path, snapshot))
+
+    # Save now and wait for the write, used when quitting
+    def flush(self):
+        self.save()
+        self.writer.waitForDone()
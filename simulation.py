@@ -0,0 +1,310 @@
+import time
+import random
+import struct
+import threading
+from array import array
+
+from behaviour import DRAG
+from buddy_model import Simulation
+
+# The crowd can be simulated away from the GUI thread: a worker steps the behaviour and movement with the Qt-free
+# Simulation, and publishes where every buddy is and what it's doing into a shared frame after each tick.
+# The GUI only reads the newest frame and paints it. What the user does to a buddy goes back to the worker
+# through an input queue. With a worker process the simulation runs on another core, a worker thread still
+# shares the GIL with the GUI but keeps the simulation's bursts out of the event loop.
+#
+# Neither side ever waits for the other: the frame is double buffered behind sequence numbers, and the
+# input queue is a single producer, single consumer ring. Both live in one block of memory, a bytearray
+# for a thread, or shared memory for a process.
+
+THREAD = "thread"
+PROCESS = "process"
+MODES = (THREAD, PROCESS)
+
+MAX_BUDDIES = 16384  # Slots in the shared frame, the frame is sized once when the worker starts
+FREE = 255  # Character of a slot that has no buddy in it
+
+# Messages to the worker: kind, character, slot, then up to 4 numbers
+LIMITS = 1  # character, left, top, right, bottom: where the character's buddies can walk
+LOOP = 2  # character, state in a, one loop of that state's animation in milliseconds in b
+SPAWN = 3  # character, how many in a
+DESPAWN = 4  # slot
+GRAB = 5  # slot, the user picked it up
+MOVE = 6  # slot, x, y while it's dragged
+DROP = 7  # slot
+
+CONTROL = struct.Struct("<?7xdQ")  # Stop flag, set by the GUI, then milliseconds the last tick took and ticks
+TIMING = struct.Struct("<dQ")  # The part of CONTROL only the worker writes
+BUFFER = struct.Struct("<QI4x")  # Sequence number, odd while it's being written, and slots in use
+MESSAGE = struct.Struct("<BBHiiii")
+QUEUE = struct.Struct("<QQ")  # Messages written and read so far, each only ever moved by one side
+QUEUE_LENGTH = 4096
+
+# Columns of a frame buffer, in order: name, array type code
+COLUMNS = (("x", "i"), ("y", "i"), ("dir_x", "b"), ("state", "B"), ("moving", "B"), ("character", "B"))
+
+
+# Sizes of everything in the shared block for a capacity
+def buffer_size(capacity):
+    return BUFFER.size + sum(array(code).itemsize for _, code in COLUMNS) * capacity
+
+
+def block_size(capacity):
+    return CONTROL.size + 2 * buffer_size(capacity) + QUEUE.size + QUEUE_LENGTH * MESSAGE.size
+
+
+# What the GUI reads: every column as an array, up to the slots in use
+class Snapshot:
+    def __init__(self, sequence=0):
+        self.sequence = sequence
+        for name, code in COLUMNS:
+            setattr(self, name, array(code))
+
+
+# Where and what every buddy is, written by the worker and read by the GUI
+# The worker writes the buffer the GUI isn't reading, and marks it odd while it's halfway written.
+# The GUI copies the newest even buffer out and checks its sequence didn't move while copying,
+# so it never sees a half written frame and never holds the worker up
+class SharedFrame:
+    def __init__(self, view, capacity):
+        self.view = view
+        self.capacity = capacity
+        self.size = buffer_size(capacity)
+        self.written = 0  # Frames published, on the worker's side
+
+        # Byte offsets of every column in a buffer
+        self.columns = []
+        offset = BUFFER.size
+        for name, code in COLUMNS:
+            itemsize = array(code).itemsize
+            self.columns.append((name, code, offset, itemsize))
+            offset += itemsize * capacity
+
+    def buffer(self, index):
+        return CONTROL.size + index * self.size
+
+    def stopping(self):
+        return CONTROL.unpack_from(self.view, 0)[0]
+
+    def stop(self):
+        struct.pack_into("<?", self.view, 0, True)
+
+    def timing(self):
+        return CONTROL.unpack_from(self.view, 0)[1:]
+
+    def set_timing(self, step, ticks):
+        TIMING.pack_into(self.view, CONTROL.size - TIMING.size, step, ticks)
+
+    # Worker side: columns are arrays with one entry per slot, like the model's
+    def publish(self, columns, count):
+        self.written += 1
+        start = self.buffer(self.written % 2)
+        sequence = 2 * self.written
+        BUFFER.pack_into(self.view, start, sequence - 1, count)
+        for name, _, offset, itemsize in self.columns:
+            offset += start
+            self.view[offset:offset + itemsize * count] = memoryview(columns[name]).cast("B")[:itemsize * count]
+        BUFFER.pack_into(self.view, start, sequence, count)
+
+    # GUI side: the newest complete frame, or None if there's nothing newer than the sequence number
+    def read(self, newer_than=0):
+        for _ in range(3):
+            headers = [BUFFER.unpack_from(self.view, self.buffer(i)) + (i,) for i in range(2)]
+            complete = [header for header in headers if header[0] % 2 == 0]
+            if not complete:
+                continue
+            sequence, count, index = max(complete)
+            if sequence <= newer_than:
+                return None
+
+            start = self.buffer(index)
+            snapshot = Snapshot(sequence)
+            for name, _, offset, itemsize in self.columns:
+                offset += start
+                getattr(snapshot, name).frombytes(self.view[offset:offset + itemsize * count])
+
+            # The worker started writing this buffer again while it was copied, try the other one
+            if BUFFER.unpack_from(self.view, start)[0] == sequence:
+                return snapshot
+        return None
+
+
+# Messages from the GUI to the worker, a ring where only the GUI moves the write count and only the
+# worker moves the read count. A full queue drops the message instead of waiting
+class InputQueue:
+    def __init__(self, view, offset):
+        self.view = view
+        self.offset = offset
+        self.records = offset + QUEUE.size
+
+    def put(self, kind, character=0, slot=0, a=0, b=0, c=0, d=0):
+        written, read = QUEUE.unpack_from(self.view, self.offset)
+        if written - read >= QUEUE_LENGTH:
+            return False
+        MESSAGE.pack_into(self.view, self.records + (written % QUEUE_LENGTH) * MESSAGE.size,
+                          kind, character, slot, a, b, c, d)
+        struct.pack_into("<Q", self.view, self.offset, written + 1)
+        return True
+
+    def drain(self):
+        written, read = QUEUE.unpack_from(self.view, self.offset)
+        messages = [MESSAGE.unpack_from(self.view, self.records + (i % QUEUE_LENGTH) * MESSAGE.size)
+                    for i in range(read, written)]
+        struct.pack_into("<Q", self.view, self.offset + 8, written)
+        return messages
+
+
+# The Simulation with what the worker needs on top: several characters, each with its own behaviour, limits and
+# animation lengths, and buddies the user can pick up
+class CrowdSimulation(Simulation):
+    def __init__(self, capacity, behaviours=(), *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.capacity = capacity
+        self.behaviours = behaviours  # Behaviour of every character, by index
+        self.character = array("B")
+        self.limits = {}  # Character -> (left, top, right, bottom)
+        self.durations = {}  # Character -> {state: loop duration}
+        self.count = 0  # Buddies out
+
+    def apply(self, kind, character, slot, a, b, c, d):
+        model = self.model
+        if kind == LIMITS:
+            self.limits[character] = (a, b, c, d)
+        elif kind == LOOP:
+            self.durations.setdefault(character, {})[a] = b
+        elif kind == SPAWN:
+            left, top, right, bottom = self.limits.get(character, (0, 0, 0, 0))
+            for _ in range(min(a, self.capacity - self.count)):
+                self.spawn(self.rng.randint(left, max(left, right)), self.rng.randint(top, max(top, bottom)),
+                           (left, top, right, bottom), character)
+        elif slot >= len(self.character) or self.character[slot] == FREE:
+            return  # Already gone
+        elif kind == DESPAWN:
+            self.despawn(slot)
+            self.character[slot] = FREE
+        elif kind == GRAB:
+            self.pending.pop(slot, None)
+            model.stop_walk(slot)
+            model.state[slot] = DRAG
+        elif kind == MOVE and model.state[slot] == DRAG:
+            model.drag_to(slot, a, b)
+        elif kind == DROP and model.state[slot] == DRAG:
+            self.end_state(slot)
+
+    # The character is set before the buddy picks its first state, which depends on the character's behaviour
+    def spawn(self, x, y, bounds, character=0):
+        self.count += 1
+        index = self.model.add(x, y, bounds)
+        if index == len(self.character):
+            self.character.append(character)
+        else:
+            self.character[index] = character
+        self.end_state(index)
+        return index
+
+    def despawn(self, index):
+        self.count -= 1
+        super().despawn(index)
+
+    def behaviour_of(self, index):
+        character = self.character[index]
+        return self.behaviours[character] if character < len(self.behaviours) else self.behaviour
+
+    def play_loops(self, index):
+        spec = self.behaviour_of(index).spec(self.model.state[index])
+        duration = self.durations.get(self.character[index], {}).get(spec.state, self.LOOP_DURATION)
+        self.schedule(index, spec.loop_limit(self.rng) * duration, self.end_state)
+
+
+# Steps the simulation every tick_interval of real time until the frame says to stop
+def run_worker(view, capacity, seed=None, behaviours=(), tick_interval=Simulation.TICK_INTERVAL):
+    frame = SharedFrame(view, capacity)
+    inputs = InputQueue(view, CONTROL.size + 2 * frame.size)
+    simulation = CrowdSimulation(capacity, behaviours, rng=random.Random(seed))
+    simulation.TICK_INTERVAL = tick_interval
+    model = simulation.model
+    ticks = 0
+
+    interval = tick_interval / 1000
+    next_tick = time.perf_counter()
+    while not frame.stopping():
+        start = time.perf_counter()
+        for message in inputs.drain():
+            simulation.apply(*message)
+        simulation.tick()
+        frame.publish({"x": model.x, "y": model.y, "dir_x": model.dir_x, "state": model.state,
+                       "moving": model.moving, "character": simulation.character}, len(simulation.character))
+        ticks += 1
+        frame.set_timing((time.perf_counter() - start) * 1000, ticks)
+
+        # Fixed timestep, but a worker that fell behind starts over instead of running a burst of ticks
+        next_tick += interval
+        delay = next_tick - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -interval * 5:
+            next_tick = time.perf_counter()
+
+
+# Entry point of a worker process, attaching to the parent's shared memory
+# The worker shares the parent's resource tracker, so the memory is only removed once the parent unlinks it
+# Behaviours are pickled with the state ids of the parent, so the states of the frame mean the same on both sides
+def run_process(name, capacity, seed=None, behaviours=()):
+    from multiprocessing import shared_memory
+
+    memory = shared_memory.SharedMemory(name)
+    try:
+        run_worker(memory.buf, capacity, seed, behaviours)
+    finally:
+        memory.close()
+
+
+# Owns the worker and the block it shares with the GUI
+# behaviours has the Behaviour of every character the GUI sends, by the index it uses for them
+class SimulationWorker:
+    def __init__(self, mode=THREAD, capacity=MAX_BUDDIES, seed=None, behaviours=()):
+        if mode not in MODES:
+            raise ValueError("unknown simulation mode %r" % mode)
+        self.mode = mode
+        self.capacity = capacity
+        self.memory = None
+
+        size = block_size(capacity)
+        if mode == PROCESS:
+            import multiprocessing
+            from multiprocessing import shared_memory
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            view = self.memory.buf
+            # A fresh interpreter instead of a fork, forking a process with Qt running in it isn't safe
+            self.worker = multiprocessing.get_context("spawn").Process(
+                target=run_process, args=(self.memory.name, capacity, seed, behaviours), name="buddy simulation",
+                daemon=True)
+        else:
+            view = memoryview(bytearray(size))
+            self.worker = threading.Thread(target=run_worker, args=(view, capacity, seed, behaviours),
+                                           name="buddy simulation", daemon=True)
+        self.view = view
+        self.frame = SharedFrame(view, capacity)
+        self.inputs = InputQueue(view, CONTROL.size + 2 * self.frame.size)
+
+    def start(self):
+        self.worker.start()
+
+    # False once the worker ended without being stopped, like a worker process that was killed
+    def alive(self):
+        return self.view is None or self.frame.stopping() or self.worker.is_alive()
+
+    def stop(self, timeout=2):
+        if self.view is None:
+            return  # Already stopped
+        self.frame.stop()
+        if self.worker.is_alive():
+            self.worker.join(timeout)
+        if self.memory is not None:
+            if self.worker.is_alive():
+                self.worker.terminate()
+                self.worker.join(timeout)
+            self.view = self.frame.view = self.inputs.view = None
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
@@ -0,0 +1,121 @@
+from behaviour import STOP
+
+# What happens when two buddies meet
+NO_INTERACTION = "none"
+BOUNCE = "bounce"  # Walking buddies turn away from each other
+DANCE = "dance"  # Both buddies stop and dance
+INTERACTIONS = (NO_INTERACTION, BOUNCE, DANCE)
+
+
+# Uniform grid of square cells, each holding the buddies whose center is in it
+# Moving a buddy only touches the grid when it crosses into another cell, and looking for the buddies
+# near a point only looks at the cells around it, so nothing ever compares every pair of buddies
+class SpatialGrid:
+    def __init__(self, cell_size=96):
+        self.cell_size = cell_size
+        self.cells = {}  # (column, row) -> set of buddy indices
+        self.cell_of = {}  # Buddy index -> (column, row) it's in
+
+    def __len__(self):
+        return len(self.cell_of)
+
+    def move(self, index, x, y):
+        cell = (x // self.cell_size, y // self.cell_size)
+        old = self.cell_of.get(index)
+        if old == cell:
+            return
+
+        if old is not None:
+            self.discard(index, old)
+        self.cell_of[index] = cell
+        members = self.cells.get(cell)
+        if members is None:
+            members = self.cells[cell] = set()
+        members.add(index)
+
+    def remove(self, index):
+        old = self.cell_of.pop(index, None)
+        if old is not None:
+            self.discard(index, old)
+
+    def discard(self, index, cell):
+        members = self.cells[cell]
+        members.discard(index)
+        if not members:
+            del self.cells[cell]
+
+    # Buddies in the cells touching the square of the given radius around the point
+    # Candidates only, the caller checks the actual distance
+    def near(self, x, y, radius):
+        size = self.cell_size
+        cells = self.cells
+        for column in range((x - radius) // size, (x + radius) // size + 1):
+            for row in range((y - radius) // size, (y + radius) // size + 1):
+                members = cells.get((column, row))
+                if members:
+                    yield from members
+
+
+# Finds walking buddies that meet another buddy, and applies the interaction rule to them
+# Two buddies meet when their centers get closer than radius, and they only meet again after moving apart
+class Interactions:
+    def __init__(self, model, rule=BOUNCE, radius=64):
+        self.model = model
+        self.rule = rule
+        self.radius = radius
+        self.contacts = set()  # (smaller index, larger index) of buddies that are close to each other
+        self.meetings = 0
+
+    def close(self, a, b):
+        model = self.model
+        dx = model.x[a] + model.center_x[a] - model.x[b] - model.center_x[b]
+        dy = model.y[a] + model.center_y[a] - model.y[b] - model.center_y[b]
+        return dx * dx + dy * dy < self.radius * self.radius
+
+    # Call after the walkers moved. Returns the pairs that just met, and the buddies that turned around
+    # horizontally because of them
+    def update(self, walkers):
+        model = self.model
+        grid = model.grid
+        state = model.state
+        radius = self.radius
+
+        found = set()
+        for a in walkers:
+            x = model.x[a] + model.center_x[a]
+            y = model.y[a] + model.center_y[a]
+            for b in grid.near(x, y, radius):
+                if b != a and state[b] != STOP and self.close(a, b):
+                    found.add((a, b) if a < b else (b, a))
+
+        # Buddies that stopped next to each other are still in contact
+        for pair in self.contacts:
+            if pair not in found and state[pair[0]] != STOP and state[pair[1]] != STOP and self.close(*pair):
+                found.add(pair)
+
+        met = found - self.contacts
+        self.contacts = found
+        self.meetings += len(met)
+
+        turned = set()
+        if self.rule == BOUNCE:
+            for a, b in met:
+                turned ^= self.bounce(a, b)
+        return met, turned
+
+    # Point the walking buddies of the pair away from each other
+    # Standing buddies keep their direction, it's the way they're facing
+    def bounce(self, a, b):
+        model = self.model
+        turned = set()
+        a_left = model.x[a] + model.center_x[a] < model.x[b] + model.center_x[b]
+        a_above = model.y[a] + model.center_y[a] < model.y[b] + model.center_y[b]
+        for index, left, above in ((a, a_left, a_above), (b, not a_left, not a_above)):
+            if not model.moving[index]:
+                continue
+            dir_x = -abs(model.dir_x[index]) if left else abs(model.dir_x[index])
+            if dir_x != model.dir_x[index]:
+                model.dir_x[index] = dir_x
+                turned.add(index)
+            model.dir_y[index] = -abs(model.dir_y[index]) if above else abs(model.dir_y[index])
+        return turned
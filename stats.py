@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+from array import array
+
+
+# Resident memory of the process in bytes, 0 if it can't be read
+def rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    # Windows and macOS only have the peak through resource, or nothing at all
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+    except ImportError:
+        return 0
+
+
+# Fixed size ring buffer of the last measurements, allocated once so recording never allocates
+class Series:
+    def __init__(self, size=1024):
+        self.values = array('d', bytes(8 * size))
+        self.size = size
+        self.count = 0  # Total measurements, including the ones already overwritten
+
+    def add(self, value):
+        self.values[self.count % self.size] = value
+        self.count += 1
+
+    def summary(self):
+        kept = sorted(self.values[:min(self.count, self.size)])
+        if not kept:
+            return {"count": 0}
+
+        def percentile(fraction):
+            return kept[min(int(fraction * len(kept)), len(kept) - 1)]
+
+        return {
+            "count": self.count,
+            "mean": sum(kept) / len(kept),
+            "p50": percentile(0.5),
+            "p90": percentile(0.9),
+            "p99": percentile(0.99),
+            "max": kept[-1],
+        }
+
+
+# Performance counters, cheap enough to leave on all the time
+# Timings are only taken for one event out of SAMPLE_EVERY, and kept in ring buffers
+class Stats:
+    SAMPLE_EVERY = 8
+
+    def __init__(self):
+        self.series = {}
+        self.counters = {}
+        self.gauges = {}  # Name -> function returning the current value, only called for snapshots
+        self.started = time.time()
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Count the event, and return True if this one should be timed
+    def sampled(self, name):
+        count = self.counters.get(name, 0) + 1
+        self.counters[name] = count
+        return count % self.SAMPLE_EVERY == 0
+
+    # Record a measurement in milliseconds
+    def record(self, name, value):
+        series = self.series.get(name)
+        if series is None:
+            series = self.series[name] = Series()
+        series.add(value)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "rss_bytes": rss(),
+            "counters": dict(self.counters),
+            "gauges": {name: function() for name, function in self.gauges.items()},
+            "timings_ms": {name: series.summary() for name, series in self.series.items()},
+        }
+
+    # Human readable version of a snapshot, for the stats window
+    @staticmethod
+    def format(snapshot):
+        lines = ["Memory: %.1f MB" % (snapshot["rss_bytes"] / (1024 * 1024)),
+                 "Uptime: %d s" % snapshot["uptime"], ""]
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append("%-28s %s" % (name, value))
+        lines.append("")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("%-28s %d" % (name, value))
+        lines.append("")
+        lines.append("%-28s %8s %8s %8s %8s" % ("timing (ms)", "p50", "p90", "p99", "max"))
+        for name, summary in sorted(snapshot["timings_ms"].items()):
+            if summary["count"]:
+                lines.append("%-28s %8.3f %8.3f %8.3f %8.3f" % (name, summary["p50"], summary["p90"],
+                                                               summary["p99"], summary["max"]))
+        return "\n".join(lines)
+
+
+stats = Stats()
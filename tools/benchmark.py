@@ -0,0 +1,298 @@
+# Offscreen benchmarks for the buddies
+# Results are written as JSON, and can be compared against the results of another commit
+#
+# Usage: python tools/benchmark.py [--output results.json] [--compare baseline.json] [--threshold 0.25]
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import subprocess
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # Sprites are loaded relative to the repo
+
+from PyQt5 import QtCore
+from PyQt5.QtWidgets import QApplication
+
+import main
+from animation import AnimationCache
+from behaviour import DEFAULT_BEHAVIOUR
+from buddy_model import BuddyModel
+from spatial import SpatialGrid, Interactions
+from bundle import SpriteBundle
+from packs import MANIFEST, PACKS_DIR, SPRITES, load_packs, scan_packs
+
+
+# Run the function a number of times and keep the timings in milliseconds
+def measure(function, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return summary(timings)
+
+
+def summary(timings):
+    timings = sorted(timings)
+    return {
+        "median_ms": timings[len(timings) // 2],
+        "min_ms": timings[0],
+        "max_ms": timings[-1],
+        "runs": len(timings),
+    }
+
+
+# Cold start in a new process, until the selection window is shown
+def bench_cold_start(results, repeat):
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "main.py", "--startup-profile"], capture_output=True, text=True,
+                                env=dict(os.environ, QT_QPA_PLATFORM="offscreen")).stdout
+        for line in output.splitlines():
+            if "time to window shown" in line:
+                timings.append(float(line.split()[-2]))
+    if timings:
+        results["cold_start"] = summary(timings)
+
+
+def bench_selection_window(results, app, repeat):
+    def create():
+        selection = main.BuddySelection()
+        selection.show()
+        app.processEvents()
+        selection.tray_icon.hide()
+        selection.deleteLater()
+
+    results["selection_window"] = measure(create, repeat)
+
+
+def bench_spawn(results, app, selection, repeat):
+    button = selection.buttons["john"]
+
+    # First spawn creates the buddy
+    results["spawn_first"] = measure(lambda: button.setChecked(True), 1)
+    button.setChecked(False)
+
+    results["spawn_toggle_on"] = measure(lambda: button.setChecked(True), repeat,
+                                         setup=lambda: button.setChecked(False))
+    results["spawn_toggle_off"] = measure(lambda: button.setChecked(False), repeat,
+                                          setup=lambda: button.setChecked(True))
+    button.setChecked(True)
+    app.processEvents()
+
+
+def bench_transitions(results, selection, repeat):
+    buddy = selection.buddies["john"]
+
+    def drag():
+        buddy.press(QtCore.QPoint(10, 10))
+        buddy.release()
+
+    results["transition_walk"] = measure(buddy.walk, repeat, setup=buddy.stop_timers)
+    results["transition_dance"] = measure(lambda: buddy.pick_state("DANCE"), repeat)
+    results["transition_stupid"] = measure(lambda: buddy.pick_state("STUPID"), repeat)
+    results["transition_drag"] = measure(drag, repeat)
+    results["transition_end_state"] = measure(buddy.end_state, repeat)
+
+
+# One movement step of the shared tick, with every buddy walking
+def bench_ticks(results, app, selection, counts, repeat):
+    packs = list(selection.packs.values())
+    for count in counts:
+        scheduler = main.BuddyScheduler()
+        buddies = []
+        for i in range(count):
+            buddy = main.HomestuckBuddy(scheduler, selection.desktop, packs[i % len(packs)])
+            buddy.init_ui()
+            buddy.show()
+            buddy.walk()
+            buddies.append(buddy)
+        app.processEvents()
+
+        results["tick_%d_buddies" % count] = measure(scheduler.advance, repeat)
+
+        for buddy in buddies:
+            buddy.stop()
+            buddy.close()
+            buddy.deleteLater()
+        scheduler.deleteLater()
+        app.processEvents()
+
+
+# Crowds spawned by name on the overlay, and one movement step with all of them walking
+def bench_crowd(results, app, counts, repeat):
+    for count in counts:
+        selection = main.BuddySelection(overlay=True)
+        results["crowd_spawn_%d" % count] = measure(lambda: selection.spawn("john", count), 1)
+        for buddy in selection.crowd:
+            buddy.stop_timers()
+            buddy.walk()
+        app.processEvents()
+        results["crowd_tick_%d" % count] = measure(selection.scheduler.advance, repeat)
+
+        selection.despawn_all()
+        selection.tray_icon.hide()
+        selection.deleteLater()
+        app.processEvents()
+
+
+# Crowds simulated by a worker process: what's left on the GUI thread per frame, copying the newest frame out of
+# shared memory and catching the buddies up with it. Should grow far slower than crowd_tick with the count
+def bench_simulation(results, app, counts, repeat):
+    for count in counts:
+        selection = main.BuddySelection(overlay=True)
+        selection.start_simulation("process")
+        crowd = selection.simulation
+        crowd.timer.stop()  # Refreshed by hand below
+        crowd.spawn("john", count)
+
+        deadline = time.perf_counter() + 30
+        while crowd.population < count and time.perf_counter() < deadline:
+            app.processEvents()
+            crowd.refresh()
+            time.sleep(0.01)
+
+        results["simulation_read_%d" % count] = measure(lambda: crowd.worker.frame.read(), repeat)
+        results["simulation_refresh_%d" % count] = measure(crowd.refresh, repeat, setup=lambda: time.sleep(0.02))
+
+        crowd.stop()
+        selection.tray_icon.hide()
+        selection.deleteLater()
+        app.processEvents()
+
+
+# Movement step plus meeting checks through the spatial grid, without Qt, for thousands of buddies
+# The area grows with the count so the crowd is always as dense, the cost per buddy should stay flat
+def bench_interactions(results, counts, repeat):
+    rng = random.Random(0)
+    for count in counts:
+        model = BuddyModel()
+        model.grid = SpatialGrid()
+        interactions = Interactions(model)
+        side = int((count * 200 * 200) ** 0.5)  # About one buddy per 200x200 pixels
+        for _ in range(count):
+            index = model.add(rng.randrange(side), rng.randrange(side), (0, 0, side, side))
+            model.set_center(index, 75, 110)
+            model.start_walk(index, rng)
+        indices = list(range(count))
+
+        def step():
+            model.step_walking(indices)
+            interactions.update(indices)
+
+        results["interactions_%d_buddies" % count] = measure(step, repeat)
+
+
+# Decoding each sprite from its file, and loading it from the sprite bundle if it was built
+def bench_decode(results, repeat):
+    bundle = SpriteBundle.open(ROOT)
+    for path in sorted(path for pack in scan_packs(ROOT) for path in pack["sprites"].values()):
+        name = os.path.splitext(os.path.basename(path))[0]
+        results["decode_%s" % name] = measure(lambda: AnimationCache.decode(path), repeat)
+        if bundle is not None:
+            full_path = os.path.join(ROOT, path)
+            results["bundle_%s" % name] = measure(lambda: bundle.animation(full_path), repeat)
+
+
+# Loading the character packs with many of them installed, from the index and by reading every manifest
+def bench_packs(results, counts, repeat):
+    sprites = SPRITES + tuple(DEFAULT_BEHAVIOUR.sprites())
+    for count in counts:
+        with tempfile.TemporaryDirectory() as root:
+            for i in range(count):
+                directory = os.path.join(root, PACKS_DIR, "pack%d" % i)
+                os.makedirs(directory)
+                with open(os.path.join(directory, MANIFEST), "w") as file:
+                    json.dump({"icon": "icon.png", "sprites": {sprite: sprite + ".gif" for sprite in sprites}}, file)
+
+            load_packs(root)  # Builds the index
+            results["packs_indexed_%d" % count] = measure(lambda: load_packs(root), repeat)
+            results["packs_scanned_%d" % count] = measure(lambda: scan_packs(root), repeat)
+
+
+# Compare against older results, returns the benchmarks that got slower than the threshold allows
+def regressions(results, baseline, threshold):
+    slower = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result["median_ms"] > old["median_ms"] * (1 + threshold):
+            slower.append((name, old["median_ms"], result["median_ms"]))
+    return slower
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Buddy benchmarks")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="fail if a median is this much slower than in the compared results (0.25 = 25%%)")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--counts", default="1,4,64,1024", help="buddy counts for the tick benchmark")
+    parser.add_argument("--crowds", default="16,128", help="buddy counts for the crowd benchmark")
+    parser.add_argument("--simulation-counts", default="128,1024",
+                        help="buddy counts for the simulation worker benchmark")
+    parser.add_argument("--interaction-counts", default="256,1024,4096",
+                        help="buddy counts for the interaction benchmark")
+    parser.add_argument("--pack-counts", default="4,64,512", help="installed pack counts for the pack benchmark")
+    parser.add_argument("--skip-cold-start", action="store_true")
+    args = parser.parse_args()
+
+    random.seed(0)
+    results = {}
+
+    if not args.skip_cold_start:
+        bench_cold_start(results, 5)
+
+    app = QApplication(sys.argv[:1])
+    bench_decode(results, 5)
+    bench_packs(results, [int(count) for count in args.pack_counts.split(",")], args.repeat)
+    bench_selection_window(results, app, 5)
+
+    selection = main.BuddySelection()
+    bench_spawn(results, app, selection, args.repeat)
+    bench_transitions(results, selection, args.repeat)
+    bench_ticks(results, app, selection, [int(count) for count in args.counts.split(",")], args.repeat)
+    bench_crowd(results, app, [int(count) for count in args.crowds.split(",")], args.repeat)
+    bench_simulation(results, app, [int(count) for count in args.simulation_counts.split(",")], args.repeat)
+    bench_interactions(results, [int(count) for count in args.interaction_counts.split(",")], args.repeat)
+
+    for name, result in results.items():
+        print("%-32s %10.3f ms" % (name, result["median_ms"]))
+
+    output = {
+        "meta": {
+            "python": sys.version.split()[0],
+            "qt": QtCore.QT_VERSION_STR,
+            "platform": sys.platform,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "benchmarks": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["benchmarks"]
+        slower = regressions(results, baseline, args.threshold)
+        for name, old, new in slower:
+            print("REGRESSION: %s %.3f ms -> %.3f ms" % (name, old, new))
+        if slower:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_benchmark())
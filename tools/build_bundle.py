@@ -0,0 +1,37 @@
+# Packs the sprites of every character pack into graphics/sprites.bundle, already decoded and cropped
+# Run it before building the executable, and again after changing any sprite. Sprites that changed since
+# the bundle was built are decoded from their files as usual, so a stale bundle is slower, not wrong
+#
+# Usage: python tools/build_bundle.py [--output graphics/sprites.bundle]
+import os
+import sys
+import argparse
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PyQt5.QtGui import QGuiApplication
+
+from bundle import BUNDLE_FILE, build_bundle
+from packs import scan_packs
+
+
+# Every sprite of every character pack, menu icons are loaded by the selection window as icons instead
+def sprite_paths(root):
+    return sorted({path.replace("/", os.sep) for pack in scan_packs(root) for path in pack["sprites"].values()})
+
+
+def main_build():
+    parser = argparse.ArgumentParser(description="Build the pre-decoded sprite bundle")
+    parser.add_argument("--output", default=os.path.join(ROOT, BUNDLE_FILE))
+    args = parser.parse_args()
+
+    app = QGuiApplication(sys.argv[:1])
+    count = build_bundle(ROOT, sprite_paths(ROOT), args.output)
+    print("%d sprites, %.1f KB -> %s" % (count, os.path.getsize(args.output) / 1024, args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_build())
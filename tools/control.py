@@ -0,0 +1,113 @@
+# Sends commands to running buddies started with --control, and prints the replies
+#
+# Commands are JSON objects, or a shorthand: the command name followed by key=value arguments, where values
+# are read as JSON when they can be. Every command is sent on its own line, or all together as one batch
+# with --batch, which the buddies apply in a single event loop turn. "-" reads JSON lines from stdin.
+#
+# Usage: python tools/control.py [--name NAME] [--batch] [--repeat N] [--quiet] COMMAND...
+#   python tools/control.py "spawn character=dave count=100"
+#   python tools/control.py --batch "state character=dave state=DANCE" "move buddy=3 x=200 y=100"
+#   python tools/control.py --repeat 500 --quiet "list character=jade"
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt5.QtNetwork import QLocalSocket
+
+from control import CONTROL_NAME
+
+
+# One command from the command line
+def parse_command(text):
+    text = text.strip()
+    if text.startswith("{"):
+        return json.loads(text)
+
+    name, *arguments = text.split()
+    command = {"cmd": name}
+    for argument in arguments:
+        key, separator, value = argument.partition("=")
+        if not separator:
+            raise ValueError("expected key=value, got %r" % argument)
+        try:
+            command[key] = json.loads(value)
+        except ValueError:
+            command[key] = value  # Plain strings don't need quotes
+    return command
+
+
+class ControlClient:
+    TIMEOUT = 10000  # Milliseconds
+
+    def __init__(self, name=CONTROL_NAME):
+        self.socket = QLocalSocket()
+        self.socket.connectToServer(name)
+        if not self.socket.waitForConnected(self.TIMEOUT):
+            raise OSError("can't connect to %s: %s" % (name, self.socket.errorString()))
+        self.buffer = b""
+
+    # Send lines and wait for one reply per line
+    def send(self, lines):
+        self.socket.write(b"".join(line.encode("utf-8") + b"\n" for line in lines))
+        self.socket.waitForBytesWritten(self.TIMEOUT)
+
+        replies = []
+        while len(replies) < len(lines):
+            if b"\n" not in self.buffer:
+                if not self.socket.waitForReadyRead(self.TIMEOUT):
+                    raise OSError("no reply: %s" % self.socket.errorString())
+                self.buffer += bytes(self.socket.readAll())
+                continue
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            replies.append(json.loads(line.decode("utf-8")))
+        return replies
+
+    def close(self):
+        self.socket.disconnectFromServer()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send commands to the buddies")
+    parser.add_argument("commands", nargs="+", metavar="COMMAND", help='"cmd key=value ...", a JSON object, or -')
+    parser.add_argument("--name", default=CONTROL_NAME, help="name given to --control")
+    parser.add_argument("--batch", action="store_true", help="send every command as one batch")
+    parser.add_argument("--repeat", type=int, default=1, help="send the commands this many times")
+    parser.add_argument("--quiet", action="store_true", help="only print errors and the throughput")
+    args = parser.parse_args()
+
+    commands = []
+    for text in args.commands:
+        if text == "-":
+            commands += [json.loads(line) for line in sys.stdin if line.strip()]
+        else:
+            commands.append(parse_command(text))
+    if args.batch:
+        lines = [json.dumps(commands)]
+    else:
+        lines = [json.dumps(command) for command in commands]
+
+    client = ControlClient(args.name)
+    failed = 0
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for reply in client.send(lines):
+            results = reply if isinstance(reply, list) else [reply]
+            failed += sum(not result.get("ok") for result in results)
+            if not args.quiet or any(not result.get("ok") for result in results):
+                print(json.dumps(reply))
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    if args.repeat > 1 or args.quiet:
+        sent = len(commands) * args.repeat
+        print("%d commands in %.3f s, %.0f commands/s" % (sent, elapsed, sent / elapsed if elapsed else 0),
+              file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
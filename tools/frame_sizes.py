@@ -0,0 +1,77 @@
+# Compares whole frames against delta encoded frames for every sprite of every character pack:
+# the bytes each animation takes in memory, and the share of the frame repainted on an average frame
+#
+# Usage: python tools/frame_sizes.py [--scale 1.0] [--ratio 1.0] [--json]
+import os
+import sys
+import json
+import argparse
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PyQt5.QtGui import QGuiApplication
+
+from animation import AnimationCache, ScaledAnimationCache
+from packs import scan_packs
+
+
+# Share of the frame repainted per frame, averaged over one loop. Whole frames repaint everything
+def repaint_share(animation):
+    size = animation.size()
+    full = size.width() * size.height()
+    if animation.rects is None or not full:
+        return 1.0
+    areas = [sum(rect.width() * rect.height() for rect in animation.repaint_rects(index))
+             for index in range(animation.frame_count())]
+    return sum(areas) / (full * len(areas))
+
+
+def measure(path, scale, ratio):
+    full = AnimationCache.decode(path)
+    delta = AnimationCache.build(path, *AnimationCache.read_frames(path, deltas=True))
+    if (scale, ratio) != (1, 1):
+        full = ScaledAnimationCache.scale(full, scale, ratio)
+        delta = ScaledAnimationCache.scale(delta, scale, ratio)
+    return {
+        "frames": full.frame_count(),
+        "keyframes": sum(delta.is_keyframe(index) for index in range(delta.frame_count())),
+        "full_bytes": full.bytes(),
+        "delta_bytes": delta.bytes(),
+        "full_repaint": 1.0,
+        "delta_repaint": round(repaint_share(delta), 3),
+    }
+
+
+def main_sizes():
+    parser = argparse.ArgumentParser(description="Frame memory and repaint area, whole frames against deltas")
+    parser.add_argument("--scale", type=float, default=1.0, help="buddy size the frames are scaled to")
+    parser.add_argument("--ratio", type=float, default=1.0, help="device pixel ratio of the screen")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    app = QGuiApplication(sys.argv[:1])
+    results = {}
+    for pack in scan_packs(ROOT):
+        for path in pack["sprites"].values():
+            results[path] = measure(os.path.join(ROOT, path), args.scale, args.ratio)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    print("%-40s %6s %5s %10s %10s %8s" % ("sprite", "frames", "keys", "full KB", "delta KB", "repaint"))
+    for path, result in results.items():
+        print("%-40s %6d %5d %10.1f %10.1f %7.1f%%" % (
+            path, result["frames"], result["keyframes"], result["full_bytes"] / 1024, result["delta_bytes"] / 1024,
+            result["delta_repaint"] * 100))
+    full = sum(result["full_bytes"] for result in results.values())
+    delta = sum(result["delta_bytes"] for result in results.values())
+    print("total: %.1f KB whole frames, %.1f KB delta encoded (%.0f%%)" % (full / 1024, delta / 1024,
+                                                                           100 * delta / full if full else 0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_sizes())
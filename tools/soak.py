@@ -0,0 +1,111 @@
+# Soak test for the buddies: runs thousands of state transitions offscreen and checks that
+# the number of Qt objects and the memory used don't keep going up
+#
+# Usage: python tools/soak.py [--transitions N] [--max-rss-growth MB]
+import os
+import sys
+import random
+import argparse
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # Sprites are loaded relative to the repo
+
+from PyQt5 import QtCore
+from PyQt5.QtWidgets import QApplication
+
+import main
+from stats import rss
+
+
+def object_count(selection):
+    return len(selection.findChildren(QtCore.QObject)) + sum(
+        len(buddy.findChildren(QtCore.QObject)) for buddy in buddies(selection))
+
+
+def buddies(selection):
+    return list(selection.buddies.values())
+
+
+def run_transitions(app, selection, count, rng):
+    characters = list(selection.buttons)
+    for i in range(count):
+        character = rng.choice(characters)
+        button = selection.buttons[character]
+        buddy = selection.buddies.get(character)
+        action = rng.randrange(8)
+
+        if action == 0 or not button.isChecked():
+            button.toggle()  # Spawn or despawn
+        elif action == 1:
+            buddy.pick_state(rng.choice(["WALK", "DANCE", "STUPID"]))
+        elif action == 2:
+            buddy.end_state()
+        elif action == 3:
+            buddy.walk()
+            for _ in range(rng.randint(1, 10)):
+                selection.scheduler.tick()
+        elif action == 4:
+            buddy.pick_state("STUPID")
+        elif action == 5:
+            buddy.pick_state("DANCE")
+        elif action == 6:
+            buddy.press(QtCore.QPoint(10, 10))
+            buddy.drag_move(buddy.frame_pos() + QtCore.QPoint(rng.randint(-20, 30), rng.randint(-20, 30)))
+            buddy.release()
+        else:
+            buddy.celebrate_update()
+
+        # Let deleteLater and queued events run now and then, like the real event loop would
+        if i % 50 == 0:
+            app.processEvents()
+
+
+def main_soak():
+    parser = argparse.ArgumentParser(description="Buddy state transition soak test")
+    parser.add_argument("--transitions", type=int, default=20000)
+    parser.add_argument("--max-rss-growth", type=float, default=8.0, help="allowed memory growth in MB")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    selection = main.BuddySelection()
+    rng = random.Random(args.seed)
+
+    # Buddies are created the first time they're spawned, so spawn them all once
+    for button in selection.buttons.values():
+        button.setChecked(True)
+
+    # Warm up first, so every sprite is already decoded and cached before measuring
+    run_transitions(app, selection, 2000, rng)
+    app.processEvents()
+    start_objects = object_count(selection)
+    start_rss = rss()
+
+    run_transitions(app, selection, args.transitions, rng)
+    app.processEvents()
+    end_objects = object_count(selection)
+    end_rss = rss()
+
+    rss_growth = (end_rss - start_rss) / (1024 * 1024)
+    print("transitions: %d" % args.transitions)
+    print("qt objects: %d -> %d" % (start_objects, end_objects))
+    print("pending deadlines: %d" % len(selection.scheduler.deadlines))
+    print("rss: %.1f MB -> %.1f MB (%+.1f MB)" % (start_rss / (1024 * 1024), end_rss / (1024 * 1024), rss_growth))
+
+    failed = False
+    if end_objects > start_objects:
+        print("FAIL: Qt object count went up")
+        failed = True
+    if rss_growth > args.max_rss_growth:
+        print("FAIL: memory went up by more than %.1f MB" % args.max_rss_growth)
+        failed = True
+    if len(selection.scheduler.deadlines) > 2 * len(buddies(selection)) + 16:
+        print("FAIL: cancelled deadlines are piling up")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_soak())
@@ -0,0 +1,162 @@
+import json
+import random
+import http.client
+import threading
+import urllib.error
+import urllib.request
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from xml.etree import ElementTree
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal
+
+from stats import stats
+from storage import write_json_atomic
+
+FEED_URL = "https://www.homestuck2.com/story/rss"
+
+
+# Feed dates as timezone aware datetimes, None if missing or malformed
+def parse_date(value):
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return date if date.tzinfo is not None else date.replace(tzinfo=timezone.utc)
+
+
+# New entries at the top of an RSS feed, newest first
+# The feed is parsed as it's downloaded, and reading stops at the first entry that was already seen,
+# so a feed with one new page only costs the bytes up to that page
+def new_entries(stream, last_link=None, last_date=None):
+    entries = []
+    for _, element in ElementTree.iterparse(stream, events=("end",)):
+        if element.tag != "item":
+            continue
+
+        entry = {
+            "title": element.findtext("title", ""),
+            "link": element.findtext("link", ""),
+            "date": element.findtext("pubDate", ""),
+        }
+        element.clear()
+
+        if last_link is not None and entry["link"] == last_link:
+            break
+        date = parse_date(entry["date"])
+        if last_date is not None and date is not None and date <= last_date:
+            break
+        entries.append(entry)
+    return entries
+
+
+# Checks the Homestuck^2 feed for new pages every so often, on a background thread
+# Requests are conditional, so a feed that didn't change costs one small 304 response. When the feed can't
+# be reached, the wait between tries doubles up to max_interval, with jitter so many clients don't retry in sync
+class UpdateChecker(QtCore.QObject):
+    update_found = pyqtSignal(dict)  # The new contents of the state file, delivered on the GUI thread
+
+    TIMEOUT = 10  # Seconds to wait for the server
+
+    def __init__(self, state_path, url=None, interval=300, max_interval=3600, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.state_path = state_path
+        self.url = url or FEED_URL
+        self.interval = interval
+        self.max_interval = max_interval
+        self.failures = 0
+        self.stopping = threading.Event()
+        self.state = self.load_state()
+
+        # A daemon thread instead of a QThread, so a slow request never holds up quitting
+        self.thread = threading.Thread(target=self.run, name="update checker", daemon=True)
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.check()
+                self.failures = 0
+            except (OSError, http.client.HTTPException, ElementTree.ParseError, ValueError):
+                self.failures += 1
+                stats.count("update_errors")
+            self.stopping.wait(self.next_delay())
+
+    # Seconds until the next check: the interval, or an exponential backoff with full jitter after failures
+    def next_delay(self):
+        if not self.failures:
+            return self.interval
+        return random.uniform(self.interval, min(self.max_interval, self.interval * 2 ** self.failures))
+
+    # One conditional request, returns the new entries
+    def check(self):
+        request = urllib.request.Request(self.url, headers={"User-Agent": "Homestuck Desktop Buddies"})
+        if self.state.get("etag"):
+            request.add_header("If-None-Match", self.state["etag"])
+        if self.state.get("last_modified"):
+            request.add_header("If-Modified-Since", self.state["last_modified"])
+
+        stats.count("update_requests")
+        try:
+            response = urllib.request.urlopen(request, timeout=self.TIMEOUT)
+        except urllib.error.HTTPError as error:
+            if error.code == 304:
+                stats.count("update_not_modified")
+                return []
+            raise
+
+        with response:
+            counter = CountingReader(response)
+            first_check = "last_update_url" not in self.state and "last_update_date" not in self.state
+            entries = new_entries(counter, self.state.get("last_update_url"),
+                                  parse_date(self.state.get("last_update_date")))
+            stats.count("update_bytes", counter.bytes)
+            headers = response.headers
+
+        state = dict(self.state)
+        state["etag"] = headers.get("ETag")
+        state["last_modified"] = headers.get("Last-Modified")
+        if entries:
+            # Same fields as before, the first page is the oldest of the new ones
+            state.update({
+                "last_update_date": entries[0]["date"],
+                "last_update_url": entries[0]["link"],
+                "last_update_first_page": entries[-1]["link"].rstrip("/").rsplit("/", 1)[-1],
+                "last_update_first_page_title": entries[-1]["title"],
+                "last_update_first_page_url": entries[-1]["link"],
+                "last_update_page_count": len(entries),
+            })
+        if state != self.state:
+            write_json_atomic(self.state_path, state)
+            self.state = state
+
+        # The first check only learns where the feed is, there's nothing to celebrate yet
+        if entries and not first_check:
+            stats.count("updates_found")
+            self.update_found.emit(state)
+        return entries
+
+
+# Counts the bytes read from the response, including the ones the parser never needed
+class CountingReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes += len(data)
+        return data